@@ -9,19 +9,36 @@ class CommandHandler:
             "add_pipe": AddPipeCommand,
             "add_valve": AddValveCommand,
             "add_pump": AddPumpCommand,
+            "add_junction": AddJunctionCommand,
+            "set_pipe_delay": SetPipeDelayCommand,
+            "set_container_geometry": SetContainerGeometryCommand,
             "add_container": AddContainerCommand,
             "run_next_step": RunNextStepCommand,
+            "run_adaptive": RunAdaptiveCommand,
+            "run_until": RunUntilCommand,
+            "flush_logs": FlushLogsCommand,
+            "set_async_logging": SetAsyncLoggingCommand,
+            "get_log_metrics": GetLogMetricsCommand,
+            "set_log_format": SetLogFormatCommand,
             "control_valve": ControlValveCommand,
             "control_pump": ControlPumpCommand,
             "get_state": GetStateCommand,
             "set_container": SetContainerStateCommand,
+            "solve_steady_state": SolveSteadyStateCommand,
             "quit":QuitCommand,
             "get_id_list":GetListOfIdsCommand,
             "get_containers_list":GetContainersOfActiveElementCommand,
             "serialize":SerializeCommand,
             "deserialize":DeserializeCommand,
             "delete_object":DeleteObjectCommand,
-            "set_ramping_params":SetRampingParamsCommand
+            "set_ramping_params":SetRampingParamsCommand,
+            "set_step_engine":SetStepEngineCommand,
+            "set_quiescence_detection":SetQuiescenceDetectionCommand,
+            "get_component_statistics":GetComponentStatisticsCommand,
+            "evaluate_rollouts":EvaluateRolloutsCommand,
+            "fork":ForkCommand,
+            "fork_many":ForkCommand,
+            "drop_forks":DropForksCommand
         }
         if "command" in packageDict:            
             command = packageDict['command'].lower()
@@ -38,7 +55,7 @@ class CommandHandler:
         
     def processPacket(self, packetDict):
         packet = self.__getSpecificPacketInstance(packetDict)
-        self.action = packet.execute()
+        self.action = None if packet.isRejected() else packet.execute()
         self.response = None
         if packet.isValid() or self.sendInvalidCommands:
             self.response = packet.generateResponse()
@@ -3,21 +3,45 @@
 
 from SimulatorFacades import GenericSimulatorFacade
 from utilities import str2bool, bool2str
+from fluidsim_engines import UnknownStepEngine, InvalidCondition
+from fluidsim_ensemble import InvalidParameter
 
 class Command(object):
+    # The commands which can be sent to a fork (ForkedSimulatorFacade) with a forkid
+    forkable = False
+    rejected = False
+
     def __copyKeysIfOnlyFirstHas(self, dict1, dict2, keys):
         for key in keys:
             if key in dict1 and key not in dict2:
                 dict2[key] = dict1[key]
 
     def __init__(self, packageDict, simulator):
-        self.simulator = GenericSimulatorFacade(simulator)
+        # With a forkid the command is executed on that fork of the simulator
+        self.rootSimulator = GenericSimulatorFacade(simulator)
         self.valid = True        
         self.packageDict = packageDict
         self.resp = {}
+        if 'forkid' in packageDict:
+            if not self.forkable:
+                self.__reject("The '"+str(packageDict.get('command'))+"' command is not supported on forks")
+            else:
+                try:
+                    simulator = self.rootSimulator.getFork(packageDict['forkid'])
+                except (KeyError, ValueError, TypeError):
+                    self.__reject("Wrong fork id")
+        self.simulator = GenericSimulatorFacade(simulator)
+
+    def __reject(self, problem):
+        # A rejected command isn't executed, the response tells the problem
+        self.rejected = True
+        self.resp['error'] = problem
     
     def isValid(self):
         return self.valid
+
+    def isRejected(self):
+        return self.rejected
     
     def generateResponse(self):
         resp = self.resp
@@ -56,6 +80,8 @@ class AddContainerCommand(Command):
         self.resp['containerid'] = containerId
 
 class GetStateCommand(Command):
+    forkable = True
+
     @staticmethod
     def buildDict(objectID):
         return {'command':'get_state', 'objectid':objectID}
@@ -68,6 +94,8 @@ class GetStateCommand(Command):
         self.resp['descriptor'] = self.simulator.getFluidsimObjectDescription(self.id)
 
 class GetListOfIdsCommand(Command):
+    forkable = True
+
     @staticmethod
     def buildDict():
         return {'command':'get_id_list'}
@@ -79,6 +107,8 @@ class GetListOfIdsCommand(Command):
         self.resp['idlist'] = self.simulator.getListOfIds()
 
 class GetContainersOfActiveElementCommand(Command):
+    forkable = True
+
     @staticmethod
     def buildDict(activeElementID):
         return {'command':'get_containers_list', 'activeelementid':activeElementID}
@@ -160,9 +190,67 @@ class AddPumpCommand(AddActuatorCommand):
         self.maxPressure = float(packageDict['maxpressure'])
         self.simulatorFunction = GenericSimulatorFacade.addPump
         self.parameters = (self.id1, self.id2, self.radius, self.length, self.height, self.maxPressure)
+
+class AddJunctionCommand(Command):
+    @staticmethod
+    def buildDict(containerIDs, radii, lengths, height):
+        return {'command':'add_junction', 'containers':containerIDs, 'radii':radii, 'lengths':lengths, 'height':height}
+
+    def __init__(self, packageDict, simulator):
+        super(AddJunctionCommand, self).__init__(packageDict, simulator)
+        self.containerIDs = [int(ID) for ID in packageDict['containers']]
+        self.radii = [float(radius) for radius in packageDict['radii']]
+        self.lengths = [float(length) for length in packageDict['lengths']]
+        self.height = float(packageDict['height'])
+
+    def execute(self):
+        if len(self.containerIDs) < 2 or len(self.radii) != len(self.containerIDs) or len(self.lengths) != len(self.containerIDs) or min(self.lengths) <= 0:
+            self.resp['error'] = "A junction needs at least two branches, with a radius and a positive length for each container"
+            return
+        try:
+            self.resp['actuatorid'] = self.simulator.addJunction(self.containerIDs, self.radii, self.lengths, self.height)
+        except IndexError:
+            self.resp['error'] = "Wrong container id"
+        except TypeError as e:
+            self.resp['error'] = str(e)
         
 
+class SetPipeDelayCommand(Command):
+    @staticmethod
+    def buildDict(activeElementID, delay):
+        return {'command':'set_pipe_delay', 'activeelementid':activeElementID, 'delay':delay}
+
+    def __init__(self, packageDict, simulator):
+        super(SetPipeDelayCommand, self).__init__(packageDict, simulator)
+        self.activeElementID = int(packageDict['activeelementid'])
+        self.delay = float(packageDict['delay'])
+
+    def execute(self):
+        try:
+            self.simulator.setPipeDelay(self.activeElementID, self.delay)
+        except (IndexError, ValueError, TypeError) as e:
+            self.resp['error'] = str(e)
+
+class SetContainerGeometryCommand(Command):
+    @staticmethod
+    def buildDict(containerID, levels, volumes):
+        return {'command':'set_container_geometry', 'containerid':containerID, 'levels':levels, 'volumes':volumes}
+
+    def __init__(self, packageDict, simulator):
+        super(SetContainerGeometryCommand, self).__init__(packageDict, simulator)
+        self.containerID = int(packageDict['containerid'])
+        self.levels = [float(level) for level in packageDict['levels']]
+        self.volumes = [float(volume) for volume in packageDict['volumes']]
+
+    def execute(self):
+        try:
+            self.simulator.setContainerGeometry(self.containerID, self.levels, self.volumes)
+        except (IndexError, ValueError) as e:
+            self.resp['error'] = str(e)
+
 class ActuatorCommand(Command):
+    forkable = True
+
     ACTION_MAP = {}
 
     @staticmethod
@@ -184,7 +272,7 @@ class ActuatorCommand(Command):
         if self.action in self.ACTION_MAP:
             try:
                 self.ACTION_MAP[self.action](self.simulator, self.actuatorId, self.percentPoint)
-            except IndexError:
+            except (IndexError, KeyError):
                 self.resp['error'] = "Wrong actuator id"
         else:
             self.resp['error'] = "Given '"+self.action+"' is invalid action. Possible actions are: "+str(ACTION_MAP.keys())
@@ -221,6 +309,8 @@ class ControlPumpCommand(ActuatorCommand):
         super(ControlPumpCommand, self).__init__(packageDict, ControlPumpCommand.SET_ACTION, simulator)
 
 class RunNextStepCommand(Command):
+    forkable = True
+
     @staticmethod
     def buildDict(delta, repeat):
         return {'command':'run_next_step', 'delta':delta, 'repeat':repeat}
@@ -233,7 +323,108 @@ class RunNextStepCommand(Command):
     def execute(self):
         self.simulator.run(self.delta, self.repeat)
 
+class FlushLogsCommand(Command):
+    @staticmethod
+    def buildDict():
+        return {'command':'flush_logs'}
+
+    def execute(self):
+        self.simulator.flushLogs()
+
+class SetAsyncLoggingCommand(Command):
+    @staticmethod
+    def buildDict(queueSize, overflow='block'):
+        return {'command':'set_async_logging', 'queuesize':queueSize, 'overflow':overflow}
+
+    def __init__(self, packageDict, simulator):
+        super(SetAsyncLoggingCommand, self).__init__(packageDict, simulator)
+        self.queueSize = packageDict.get('queuesize')
+        self.overflow = packageDict.get('overflow', 'block')
+
+    def execute(self):
+        try:
+            self.simulator.setAsyncLogging(self.queueSize, self.overflow)
+        except ValueError as e:
+            self.resp['error'] = str(e)
+
+class SetLogFormatCommand(Command):
+    @staticmethod
+    def buildDict(logFormat):
+        return {'command':'set_log_format', 'format':logFormat}
+
+    def __init__(self, packageDict, simulator):
+        super(SetLogFormatCommand, self).__init__(packageDict, simulator)
+        self.logFormat = packageDict['format']
+
+    def execute(self):
+        try:
+            self.simulator.setLogFormat(self.logFormat)
+        except ValueError as e:
+            self.resp['error'] = str(e)
+
+class GetLogMetricsCommand(Command):
+    @staticmethod
+    def buildDict():
+        return {'command':'get_log_metrics'}
+
+    def execute(self):
+        self.resp['metrics'] = self.simulator.getLogMetrics()
+
+class RunUntilCommand(Command):
+    @staticmethod
+    def buildDict(deltaT, conditions, maxTime, timeTolerance=None):
+        ret = {'command':'run_until', 'delta':deltaT, 'conditions':conditions, 'maxtime':maxTime}
+        if timeTolerance is not None:
+            ret['timetolerance'] = timeTolerance
+        return ret
+
+    def __init__(self, packageDict, simulator):
+        super(RunUntilCommand, self).__init__(packageDict, simulator)
+        self.delta = float(packageDict['delta'])
+        self.conditions = packageDict['conditions']
+        self.maxTime = float(packageDict['maxtime'])
+        self.timeTolerance = float(packageDict['timetolerance']) if 'timetolerance' in packageDict else None
+
+    def execute(self):
+        try:
+            self.resp['result'] = self.simulator.runUntil(self.delta, self.conditions, self.maxTime, self.timeTolerance)
+        except (InvalidCondition, KeyError, ValueError) as e:
+            self.resp['error'] = str(e)
+
+class RunAdaptiveCommand(Command):
+    @staticmethod
+    def buildDict(duration, tolerance):
+        return {'command':'run_adaptive', 'duration':duration, 'tolerance':tolerance}
+
+    def __init__(self, packageDict, simulator):
+        super(RunAdaptiveCommand, self).__init__(packageDict, simulator)
+        self.duration = float(packageDict['duration'])
+        self.tolerance = float(packageDict['tolerance'])
+
+    def execute(self):
+        try:
+            self.resp['steps'] = self.simulator.runAdaptive(self.duration, self.tolerance)
+        except TypeError as e:
+            self.resp['error'] = str(e)
+
+class SolveSteadyStateCommand(Command):
+    @staticmethod
+    def buildDict(apply):
+        return {'command':'solve_steady_state', 'apply':bool2str(apply)}
+
+    def __init__(self, packageDict, simulator):
+        super(SolveSteadyStateCommand, self).__init__(packageDict, simulator)
+        self.apply = ('apply' in packageDict) and str2bool(packageDict['apply'])
+
+    def execute(self):
+        try:
+            self.resp['steadystate'] = self.simulator.solveSteadyState(self.apply)
+        except TypeError as e:
+            self.resp['error'] = str(e)
+
 class SetContainerStateCommand(Command):
+    forkable = True
+
     @staticmethod
     def buildDict(containerId, temperature, level):
         return {'command':'set_container', 'containerid':containerId, 'temperature':temperature, 'level':level}
@@ -260,7 +451,105 @@ class SetRampingParamsCommand(Command):
     def execute(self):
         self.simulator.setRampingParams(self.rampingId, self.params)
 
+class SetStepEngineCommand(Command):
+    @staticmethod
+    def buildDict(engineName, options=None):
+        return {'command':'set_step_engine', 'engine':engineName, 'options':options or {}}
+
+    def __init__(self, packageDict, simulator):
+        super(SetStepEngineCommand, self).__init__(packageDict, simulator)
+        self.engineName = packageDict['engine']
+        self.options = packageDict.get('options', {})
+
+    def execute(self):
+        try:
+            self.simulator.setStepEngine(self.engineName, self.options)
+        except (UnknownStepEngine, TypeError, ValueError) as e:
+            self.resp['error'] = str(e)
+
+class SetQuiescenceDetectionCommand(Command):
+    @staticmethod
+    def buildDict(tolerance, checkPeriod=10):
+        return {'command':'set_quiescence_detection', 'tolerance':tolerance, 'checkperiod':checkPeriod}
+
+    def __init__(self, packageDict, simulator):
+        super(SetQuiescenceDetectionCommand, self).__init__(packageDict, simulator)
+        self.tolerance = packageDict.get('tolerance')
+        self.checkPeriod = int(packageDict['checkperiod']) if 'checkperiod' in packageDict else 10
+
+    def execute(self):
+        self.simulator.setQuiescenceDetection(self.tolerance, self.checkPeriod)
+
+class GetComponentStatisticsCommand(Command):
+    @staticmethod
+    def buildDict():
+        return {'command':'get_component_statistics'}
+
+    def __init__(self, packageDict, simulator):
+        super(GetComponentStatisticsCommand, self).__init__(packageDict, simulator)
+
+    def execute(self):
+        self.resp['components'] = self.simulator.getComponentStatistics()
+
+class EvaluateRolloutsCommand(Command):
+    @staticmethod
+    def buildDict(actuatorIDs, candidates, horizon, deltaT, cost, workers=None):
+        ret = {'command':'evaluate_rollouts', 'actuators':actuatorIDs, 'candidates':candidates,
+               'horizon':horizon, 'delta':deltaT, 'cost':cost}
+        if workers is not None:
+            ret['workers'] = workers
+        return ret
+
+    def __init__(self, packageDict, simulator):
+        super(EvaluateRolloutsCommand, self).__init__(packageDict, simulator)
+        self.actuatorIDs = packageDict['actuators']
+        self.candidates = packageDict['candidates']
+        self.horizon = float(packageDict['horizon'])
+        self.delta = float(packageDict['delta'])
+        self.cost = packageDict['cost']
+        self.workers = packageDict.get('workers')
+
+    def execute(self):
+        try:
+            self.resp['costs'] = self.simulator.evaluateRollouts(self.actuatorIDs, self.candidates, self.horizon, self.delta, self.cost, self.workers)
+        except (InvalidParameter, KeyError, ValueError, TypeError) as e:
+            self.resp['error'] = str(e)
+
+class ForkCommand(Command):
+    forkable = True
+
+    @staticmethod
+    def buildDict(count=1):
+        return {'command':'fork', 'count':count}
+
+    def __init__(self, packageDict, simulator):
+        super(ForkCommand, self).__init__(packageDict, simulator)
+        self.count = int(packageDict['count']) if 'count' in packageDict else 1
+        self.sourceForkID = packageDict.get('forkid')
+
+    def execute(self):
+        try:
+            self.resp['forkids'] = self.rootSimulator.registerForks(self.count, self.sourceForkID)
+        except TypeError as e:
+            self.resp['error'] = str(e)
+
+class DropForksCommand(Command):
+    forkable = True
+
+    @staticmethod
+    def buildDict(forkIDs):
+        return {'command':'drop_forks', 'forks':forkIDs}
+
+    def __init__(self, packageDict, simulator):
+        super(DropForksCommand, self).__init__(packageDict, simulator)
+        self.forkIDs = packageDict['forks']
+
+    def execute(self):
+        self.rootSimulator.dropForks(self.forkIDs)
+
 class QuitCommand(Command):
+    forkable = True
+
     @staticmethod
     def buildDict(forAll):
         return {'command':'quit', 'global':bool2str(forAll)}
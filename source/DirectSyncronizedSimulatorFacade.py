@@ -2,12 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import threading
-import dill # For pickling lambda functions.
 import pickle 
 
 from SimulatorFacades import AbstractSimulatorFacade
 from utilities import syncronize 
 from fluidsim_core import *
+from fluidsim_engines import createStepEngine, checkQuantity, InvalidCondition, AdaptiveStepEngine, ComponentStepEngine, VectorizedStepEngine
+from fluidsim_components import ComponentTracker
+from fluidsim_network import CompiledNetwork
+from fluidsim_steadystate import SteadyStateSolver
+from fluidsim_ensemble import Ensemble
+from fluidsim_rollout import RolloutEvaluator
+from fluidsim_logging import AsyncLogManager, ColumnarLogStore, COLUMNAR_LOG_NAME
+from ForkedSimulatorFacade import ForkedSimulatorFacade
 
 class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
     """
@@ -53,27 +60,63 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
         return self.__getFirstFreeIndex(self.activeElements)
 
     def serialize(self):
-        return pickle.dumps(self.pickablePart)
+        # The slotted fluidsim objects need at least the second pickle protocol
+        return pickle.dumps(self.pickablePart, pickle.HIGHEST_PROTOCOL)
         
     def deserialize(self, serial):
         self.pickablePart = pickle.loads(serial)
         self.containers = self.pickablePart['containers']
         self.activeElements = self.pickablePart['activeElements']
+        self.componentTracker.rebuild(self.containers, self.activeElements)
+        self.__topologyChanged()
         # Restoring loggers
+        self.__monitorAll()
+
+    def __monitorAll(self):
         for index, container in enumerate(self.containers):
-            self.logManager.monitor(self.__i2c(index), container)
+            if container is not None:
+                self.logManager.monitor(self.__i2c(index), container)
             
         for index, element in enumerate(self.activeElements):
-            self.logManager.monitor(str(self.__i2ae(index)), element)
+            if element is not None:
+                self.logManager.monitor(str(self.__i2ae(index)), element)
     
-    def __init__(self):
+    def __init__(self, stepEngine="sequential"):
         self.containers = []
         self.activeElements = []
         self.pickablePart = {'containers':self.containers, 'activeElements':self.activeElements}
         self.lock = threading.RLock()
         self.logManager = LogManager([FileLogHandler])
         self.simulationTime = 0
+        self.componentTracker = ComponentTracker()
+        self.stepEngine = createStepEngine(stepEngine)
+        self.adaptiveEngine = None
+        # Quiescence detection is off until setQuiescenceDetection is called
+        self.quiescenceTolerance = None
+        self.quiescenceCheckPeriod = 10
+        self.quiescent = False
+        # The forks, ensembles and rollouts share this compiled topology until the model is edited
+        self.sharedNetwork = None
+        self.forks = {}
+        self.nextForkID = 1
+
+    def __wake(self, obj=None):
+        # obj (or anything, if it's None) has changed, the next run has to step again
+        self.quiescent = False
+        self.stepEngine.touch(obj)
+
+    def __topologyChanged(self):
+        self.__wake()
+        self.sharedNetwork = None
+        self.stepEngine.invalidate()
+        if self.adaptiveEngine is not None:
+            self.adaptiveEngine.invalidate()
     
+    def __checkCompiledEngine(self, feature):
+        # The engine has to be replaced before the model gets something it can't compile
+        if isinstance(self.stepEngine, VectorizedStepEngine):
+            raise TypeError("The step engine compiles the model, it doesn't support "+feature+". Select another step engine first")
+
     def __newActiveElement(self, element):
         index = self.activeElements.push_back(element)
         return self.__i2ae(index)
@@ -89,6 +132,8 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
             container = Container(pressureCalculator)
         self.containers[index] = container
         self.logManager.monitor(self.__i2c(index), container)
+        self.componentTracker.addContainer(container)
+        self.__topologyChanged()
         return self.__i2c(index)
 
     def __addActiveElement(self, ID1, ID2, element):
@@ -99,6 +144,8 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
         cont2.attachPipe(element)
         self.activeElements[index] = element
         self.logManager.monitor(str(self.__i2ae(index)), element)
+        self.componentTracker.addPipe(element)
+        self.__topologyChanged()
         return self.__i2ae(index)
     
     @syncronize
@@ -116,33 +163,90 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
         pump = Pump(radius, length, height, maxPressure)
         return self.__addActiveElement(ID1, ID2, pump)
     
+    @syncronize
+    def addJunction(self, containerIDs, radii, lengths, height):
+        """
+        Adds a junction without storage between the containers, branch i goes to containerIDs[i].
+        The engines which compile the model (vectorized, multirate, adaptive, implicit, jit kernel),
+        the steady state solver, the forks and the ensembles don't support junctions,
+        it's refused while one of the compiled engines is the step engine.
+        """
+        containers = [self.__getObject(ID) for ID in containerIDs]
+        self.__checkCompiledEngine("junctions")
+        junction = Junction(radii, lengths, height)
+        index = self.__getFirstFreeActiveElementIndex()
+        for container in containers:
+            container.attachPipe(junction)
+        self.activeElements[index] = junction
+        self.logManager.monitor(str(self.__i2ae(index)), junction)
+        self.componentTracker.addPipe(junction)
+        self.__topologyChanged()
+        return self.__i2ae(index)
+
+    @syncronize
+    def setContainerGeometry(self, containerID, levels, volumes):
+        """
+        Gives the container a nonlinear level-volume curve (TabulatedPressureCalculator), the volume of its fluid is kept.
+        The jit kernel and the steady state solver support only prismatic containers.
+        """
+        container = self.__getObject(containerID)
+        if not isinstance(container, Container):
+            raise ValueError("Only containers have a geometry")
+        container.pressureCalculator = TabulatedPressureCalculator(levels, volumes)
+        container.pressureCalculator.setFluid(container.fluid)
+        # The compiled networks have the level tables
+        self.__topologyChanged()
+
+    @syncronize
+    def setPipeDelay(self, activeElementID, delay):
+        """
+        The fluid leaving the source of a pipe, valve or pump reaches the destiny after delay seconds (0: no delay).
+        The engines which compile the model don't support delayed pipes, a delay is refused while one of them is the step engine.
+        """
+        element = self.__getObject(activeElementID)
+        if not isinstance(element, Pipe):
+            raise ValueError("Only pipes, valves and pumps can have a delay")
+        if float(delay) < 0:
+            raise ValueError("The delay can't be negative")
+        if float(delay) > 0:
+            self.__checkCompiledEngine("delayed pipes")
+        element.setDelay(delay)
+        # The compiled engines have to know about the delay
+        self.__topologyChanged()
+
     @syncronize
     def setValveState(self, activeElementID, percent):
         valve = self.__getObject(activeElementID)
+        self.__wake(valve)
         valve.setPermeability(percent)
     
     @syncronize
     def openValve(self, activeElementID, percentPoint):
         valve = self.__getObject(activeElementID)
+        self.__wake(valve)
         valve.open(percentPoint)
     
     @syncronize
     def closeValve(self, activeElementID, percentPoint):
         valve = self.__getObject(activeElementID)
+        self.__wake(valve)
         valve.close(percentPoint)
     
     @syncronize
     def setPumpPerformance(self, activeElementID, percent):
         pump = self.__getObject(activeElementID)
+        self.__wake(pump)
         pump.setPerformance(percent)
 
     @syncronize
     def incPumpPerformance(self, activeElementID, percentPoint):
+        self.__wake()
         pump = self.__getObject(activeElemendID)
         pump.increasePerformance(percent)    
     
     @syncronize
     def decPumpPerformance(self, activeElementID, percentPoint):
+        self.__wake()
         pump = self.__getObject(activeElemendID)
         pump.decreasePerformance(percent)    
 
@@ -154,16 +258,229 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
     @syncronize    
     def setContainerState(self, containerID, fluidTemperature, fluidLevel):
         container = self.__getObject(containerID)
+        self.__wake(container)
         container.fluid.setTemperature(fluidTemperature)
         container.setLevel(fluidLevel)
     
     @syncronize    
     def run(self, deltaT, repeat=1):
-        for i in range(0, repeat):
-            for element in self.activeElements:
-                element.flow(deltaT)
-            self.simulationTime+=deltaT
-            self.logManager.createLog(self.simulationTime)
+        self.stepEngine.run(self, deltaT, repeat)
+
+    @syncronize
+    def flushLogs(self):
+        """ Writes out the buffered logs """
+        self.logManager.flush()
+
+    @syncronize
+    def setAsyncLogging(self, queueSize, overflow='block'):
+        """
+        With a positive queueSize run() only takes the samples, a writer thread writes them (see AsyncLogManager).
+        A None or non-positive queueSize switches back to writing in run().
+        """
+        if queueSize is None or int(queueSize) <= 0:
+            logManager = LogManager(self.logManager.logHandlerTypes)
+        else:
+            logManager = AsyncLogManager(self.logManager.logHandlerTypes, queueSize, overflow)
+        logManager.takeOver(self.logManager)
+        self.logManager = logManager
+
+    @syncronize
+    def setLogFormat(self, logFormat):
+        """
+        'csv': one CSV file for every object (the default)
+        'columnar': every signal in one binary file, see ColumnarLogStore and ColumnarLogReader
+        The logs are started again in the new format.
+        """
+        if logFormat == 'csv':
+            logHandlerTypes = [FileLogHandler]
+        elif logFormat == 'columnar':
+            logHandlerTypes = [ColumnarLogStore(self.logManager.prefix + COLUMNAR_LOG_NAME)]
+        else:
+            raise ValueError("Unknown log format '"+str(logFormat)+"'. Possible formats are: ('csv', 'columnar')")
+        self.logManager.flush()
+        for LogHandler in self.logManager.logHandlerTypes:
+            if isinstance(LogHandler, ColumnarLogStore):
+                LogHandler.close()
+        self.logManager.logHandlerTypes = logHandlerTypes
+        del self.logManager.logHandlers[:]
+        self.__monitorAll()
+
+    @syncronize
+    def getLogMetrics(self):
+        """ The depth of the log queue and the written and dropped records, or None without asynchronous logging """
+        if isinstance(self.logManager, AsyncLogManager):
+            return self.logManager.getMetrics()
+        return None
+
+    @syncronize
+    def runUntil(self, deltaT, conditions, maxTime, timeTolerance=None):
+        """
+        Runs until one of the conditions fires or maxTime passes.
+        A condition is a dict: {'objectid':ID, 'quantity':q, 'op':'above' or 'below', 'value':x}, where q is
+        waterlevel, volume or temperature for a container and stream for an active element.
+        Returns the indices of the fired conditions (empty if the time limit was reached),
+        the simulation time, the actual values of the conditions and the description of their objects.
+        """
+        parsed = []
+        for condition in conditions:
+            obj = self.__getObject(condition['objectid'])
+            if obj is None:
+                raise InvalidCondition("No object with ID "+str(condition['objectid']))
+            checkQuantity(obj, condition['quantity'])
+            if condition['op'] not in ('above', 'below'):
+                raise InvalidCondition("The op has to be 'above' or 'below'")
+            parsed.append((obj, condition['quantity'], condition['op'] == 'above', float(condition['value'])))
+        fired = self.stepEngine.runUntil(self, deltaT, parsed, maxTime, timeTolerance)
+        objects = {}
+        for condition, (obj, quantity, above, value) in zip(conditions, parsed):
+            objects[int(condition['objectid'])] = obj.getDescription()
+        return {'fired':fired,
+                'time':self.simulationTime,
+                'values':[self.stepEngine.getQuantity(obj, quantity) for obj, quantity, above, value in parsed],
+                'objects':objects}
+
+    @syncronize
+    def runAdaptive(self, duration, tolerance):
+        """ Advances duration simulated time with adaptive steps, returns the number of the internal steps """
+        if isinstance(self.stepEngine, AdaptiveStepEngine):
+            engine = self.stepEngine
+        else:
+            if self.adaptiveEngine is None:
+                self.adaptiveEngine = AdaptiveStepEngine()
+            engine = self.adaptiveEngine
+        return engine.advance(self, duration, tolerance)
+
+    @syncronize
+    def solveSteadyState(self, apply):
+        """
+        Computes the equilibrium for the setpoints of the valves and pumps.
+        If apply is true, the containers and the ramps are set to it, otherwise the model doesn't change.
+        """
+        network = CompiledNetwork(self.containers, self.activeElements)
+        result, streams = SteadyStateSolver(network).solve(network.gatherState())
+        if apply:
+            self.__wake()
+            network.scatterState(result)
+        containerIDs = dict((id(container), self.__i2c(index)) for index, container in enumerate(self.containers) if container is not None)
+        elementIDs = dict((id(element), self.__i2ae(index)) for index, element in enumerate(self.activeElements) if element is not None)
+        containers = {}
+        for index, container in enumerate(network.containers):
+            volume = float(result.volumes[index])
+            containers[containerIDs[id(container)]] = {'volume':volume, 'waterlevel':container.pressureCalculator.getWaterLevelFor(volume), 'temperature':float(result.temperatures[index])}
+        elementStreams = dict((elementIDs[id(element)], float(streams[index])) for index, element in enumerate(network.activeElements))
+        return {'containers':containers, 'streams':elementStreams}
+
+    def __getSharedNetwork(self):
+        if self.sharedNetwork is None:
+            self.sharedNetwork = CompiledNetwork(self.containers, self.activeElements)
+        return self.sharedNetwork
+
+    @syncronize
+    def createEnsemble(self, size):
+        """
+        Returns an Ensemble of size variants of the model, started from its actual state.
+        The ensemble is independent: stepping it doesn't change the model, and it isn't logged.
+        """
+        network = self.__getSharedNetwork()
+        containerIDs = dict((self.__i2c(index), container) for index, container in enumerate(self.containers) if container is not None)
+        elementIDs = dict((self.__i2ae(index), element) for index, element in enumerate(self.activeElements) if element is not None)
+        return Ensemble(network, size, containerIDs, elementIDs)
+
+    @syncronize
+    def evaluateRollouts(self, actuatorIDs, candidates, horizon, deltaT, cost, workers=None):
+        """
+        Simulates every candidate control sequence from the actual state and returns one cost per candidate
+        (see RolloutEvaluator). The model doesn't change.
+        """
+        evaluator = RolloutEvaluator(actuatorIDs, horizon, deltaT, cost, workers)
+        return evaluator.evaluate(self.createEnsemble, candidates)
+
+    @syncronize
+    def fork(self):
+        """ Returns an independent ForkedSimulatorFacade with the actual state, for what-if runs """
+        return self.forkMany(1)[0]
+
+    @syncronize
+    def forkMany(self, count):
+        network = self.__getSharedNetwork()
+        state = network.gatherState()
+        containerIDs = dict((self.__i2c(index), network.containerIndex[id(container)]) for index, container in enumerate(self.containers) if container is not None)
+        elementIDs = dict((self.__i2ae(index), network.activeElementIndex[id(element)]) for index, element in enumerate(self.activeElements) if element is not None)
+        return [ForkedSimulatorFacade(network, state.copy(), self.simulationTime, containerIDs, elementIDs) for i in range(0, count)]
+
+    @syncronize
+    def registerForks(self, count, sourceForkID=None):
+        """ Creates count forks of the simulator (or of a registered fork) for the protocol, returns their IDs """
+        source = self if sourceForkID is None else self.getFork(sourceForkID)
+        forkIDs = []
+        for fork in source.forkMany(count):
+            self.forks[self.nextForkID] = fork
+            forkIDs.append(self.nextForkID)
+            self.nextForkID += 1
+        return forkIDs
+
+    @syncronize
+    def getFork(self, forkID):
+        return self.forks[int(forkID)]
+
+    @syncronize
+    def dropForks(self, forkIDs):
+        for forkID in forkIDs:
+            self.forks.pop(int(forkID), None)
+
+    @syncronize
+    def setStepEngine(self, engineName, options=None):
+        stepEngine = createStepEngine(engineName, options)
+        try:
+            stepEngine.checkModel(self.containers, self.activeElements)
+        except TypeError:
+            stepEngine.close()
+            raise
+        self.stepEngine.close()
+        self.stepEngine = stepEngine
+        self.__wake()
+
+    @syncronize
+    def setQuiescenceDetection(self, tolerance, checkPeriod=10):
+        """
+        If every ramp is at its setpoint and every stream is below tolerance (volume per second),
+        run() only moves the simulation time forward (and creates the logs) until the next command
+        which changes the model. It is checked after every checkPeriod steps. A None or
+        non-positive tolerance switches it off.
+        """
+        if tolerance is None or float(tolerance) <= 0:
+            self.quiescenceTolerance = None
+        else:
+            self.quiescenceTolerance = float(tolerance)
+        self.quiescenceCheckPeriod = max(1, int(checkPeriod))
+        self.__wake()
+
+    @syncronize
+    def getComponentStatistics(self):
+        """
+        Returns the connected components of the model with their object IDs.
+        After a run with the 'components' step engine every component has its step time, and its
+        speedup: the part of the wall time while it was stepped. The sum of these is the speed-up of the run.
+        """
+        containerIDs = dict((id(container), self.__i2c(index)) for index, container in enumerate(self.containers) if container is not None)
+        elementIDs = dict((id(element), self.__i2ae(index)) for index, element in enumerate(self.activeElements) if element is not None)
+        if isinstance(self.stepEngine, ComponentStepEngine) and self.stepEngine.version == self.componentTracker.version:
+            wallTime, components = self.stepEngine.getStatistics()
+        else:
+            wallTime = None
+            components = [(containers, elements, None) for containers, elements in
+                          self.componentTracker.getComponents(self.containers, self.activeElements)]
+        ret = {'walltime':wallTime, 'components':[]}
+        for containers, elements, stepTime in components:
+            component = {'containers':[containerIDs[id(c)] for c in containers],
+                         'activeelements':[elementIDs[id(e)] for e in elements],
+                         'steptime':stepTime}
+            if wallTime:
+                component['speedup'] = stepTime / wallTime
+            ret['components'].append(component)
+        if wallTime:
+            ret['speedup'] = sum(component['speedup'] for component in ret['components'])
+        return ret
 
     @syncronize    
     def getListOfIds(self):
@@ -175,17 +492,14 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
     def getContainersOfActiveElement(self, activeElementID):
         index = self.__ae2i(activeElementID)
         activeElement = self.activeElements[index]
-        a = activeElement.getContainer1()
-        b = activeElement.getContainer2()
-        indexOfA = self.containers.index(a)
-        indexOfB = self.containers.index(b)
-        idOfA = self.__i2c(indexOfA)
-        idOfB = self.__i2c(indexOfB)
-        return [idOfA, idOfB]
+        # Two containers, or the containers of the branches of a junction
+        return [self.__i2c(self.containers.index(container)) for container in activeElement.getContainers()]
     
     @syncronize
     def deleteFluidsimObject(self, objectID):
         obj = self.__getObject(objectID)
+        self.componentTracker.removeObject(obj)
+        self.__topologyChanged()
         if self.__isActiveElementID(objectID):
             obj.destroy()
             self.activeElements[self.__ae2i(objectID)] = None
@@ -204,4 +518,5 @@ class DirectSyncronizedSimulatorFacade(AbstractSimulatorFacade):
     @syncronize
     def setRampingParams(self, objectID, rampParams):
         rampableId = self.__getObject(objectID)
+        self.__wake(rampableId)
         rampableId.ramp.setParams(rampParams)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from SimulatorFacades import AbstractSimulatorFacade
+
+class ForkedSimulatorFacade(AbstractSimulatorFacade):
+    """
+    A lightweight, independent copy of a simulator for what-if runs.
+    The compiled topology (CompiledNetwork) is shared by the forks of a simulator,
+    a fork owns only a copy of the state arrays. It can be run and its actuators and containers
+    can be set, but it can't be edited, and nothing is logged.
+    """
+    def __init__(self, network, state, simulationTime, containerIDs, elementIDs):
+        self.network = network
+        self.state = state
+        self.simulationTime = simulationTime
+        self.containerIDs = containerIDs  # ID -> index in the network
+        self.elementIDs = elementIDs
+        self.rampIndices = dict((index, rampIndex) for rampIndex, (index, element) in enumerate(network.valves + network.pumps))
+
+    def fork(self):
+        return ForkedSimulatorFacade(self.network, self.state.copy(), self.simulationTime, self.containerIDs, self.elementIDs)
+
+    def forkMany(self, count):
+        return [self.fork() for i in range(0, count)]
+
+    def __getRampIndex(self, activeElementID):
+        return self.rampIndices[self.elementIDs[int(activeElementID)]]
+
+    def __setSetpoint(self, activeElementID, percent):
+        rampIndex = self.__getRampIndex(activeElementID)
+        self.state.ramps.setpoints[rampIndex] = min(max(percent, self.network.minSetpoints[rampIndex]), 100)
+
+    def __getActValue(self, activeElementID):
+        return self.state.ramps.values[self.__getRampIndex(activeElementID)]
+
+    def setValveState(self, activeElementID, percent):
+        self.__setSetpoint(activeElementID, percent)
+
+    def openValve(self, activeElementID, percentPoint):
+        self.__setSetpoint(activeElementID, self.__getActValue(activeElementID) + percentPoint)
+
+    def closeValve(self, activeElementID, percentPoint):
+        self.__setSetpoint(activeElementID, self.__getActValue(activeElementID) - percentPoint)
+
+    def setPumpPerformance(self, activeElementID, percent):
+        self.__setSetpoint(activeElementID, percent)
+
+    def incPumpPerformance(self, activeElementID, percentPoint):
+        self.__setSetpoint(activeElementID, self.__getActValue(activeElementID) + percentPoint)
+
+    def decPumpPerformance(self, activeElementID, percentPoint):
+        self.__setSetpoint(activeElementID, self.__getActValue(activeElementID) - percentPoint)
+
+    def setContainerState(self, containerID, fluidTemperature, fluidLevel):
+        index = self.containerIDs[int(containerID)]
+        container = self.network.containers[index]
+        self.state.volumes[index] = container.pressureCalculator.getVolumeFor(float(fluidLevel))
+        self.state.temperatures[index] = float(fluidTemperature)
+
+    def run(self, deltaT, repeat=1):
+        deltaT = float(deltaT)
+        for i in range(0, repeat):
+            self.network.step(self.state, deltaT)
+            self.simulationTime += deltaT
+
+    def getFluidsimObjectDescription(self, objectID):
+        """ The description of the object in the original simulator, with the values of the fork """
+        objectID = int(objectID)
+        state = self.state
+        if objectID in self.containerIDs:
+            index = self.containerIDs[objectID]
+            container = self.network.containers[index]
+            ret = container.getDescription()
+            volume = float(state.volumes[index])
+            ret.update({'volume':volume, 'temperature':float(state.temperatures[index]),
+                        'waterlevel':container.pressureCalculator.getWaterLevelFor(volume)})
+            return ret
+        index = self.elementIDs[objectID]
+        ret = self.network.activeElements[index].getDescription()
+        # Like Pipe.getDescription, the stream is the magnitude
+        ret.update({'radius':float(state.radii[index]), 'stream':abs(float(self.network.getStreams(state)[index]))})
+        if index in self.rampIndices:
+            rampIndex = self.rampIndices[index]
+            actValue = float(state.ramps.values[rampIndex])
+            ret.update({'setpoint':float(state.ramps.setpoints[rampIndex]),
+                        ('permeability' if 'permeability' in ret else 'performance'):actValue})
+        return ret
+
+    def getListOfIds(self):
+        return sorted(self.elementIDs.keys()) + sorted(self.containerIDs.keys())
+
+    def getContainersOfActiveElement(self, activeElementID):
+        index = self.elementIDs[int(activeElementID)]
+        containerIDs = dict((containerIndex, ID) for ID, containerIndex in self.containerIDs.items())
+        return [containerIDs[int(self.network.fromIndex[index])], containerIDs[int(self.network.toIndex[index])]]
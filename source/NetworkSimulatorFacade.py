@@ -7,11 +7,15 @@ from SocketHandler import SocketHandler
 from SimulatorFacades import AbstractSimulatorFacade
 
 class NetworkSimulatorFacade(AbstractSimulatorFacade):
-    def __init__(self, socket):
-        self.socketHandler = SocketHandler(socket)
+    def __init__(self, socket, forkID=None, socketHandler=None):
+        # A facade with a forkID sends its commands to that fork of the server's simulator
+        self.socketHandler = socketHandler if socketHandler is not None else SocketHandler(socket)
+        self.forkID = forkID
 
     def __sendPacketWithReturn(self, returnLabel, commandClass, argsOfBuildDict):
         packet = commandClass.buildDict(*argsOfBuildDict)
+        if self.forkID is not None:
+            packet['forkid'] = self.forkID
         response = self.socketHandler.sendPacketAndGetAnswer(packet)
         if returnLabel is not None:
             return response[returnLabel]
@@ -31,6 +35,15 @@ class NetworkSimulatorFacade(AbstractSimulatorFacade):
     
     def addPump(self, ID1, ID2, radius, length, height, maxPressure):
         return self.__sendPacketWithReturn('actuatorid', AddPumpCommand, (ID1, ID2, radius, length, height, maxPressure))
+
+    def addJunction(self, containerIDs, radii, lengths, height):
+        return self.__sendPacketWithReturn('actuatorid', AddJunctionCommand, (containerIDs, radii, lengths, height))
+
+    def setPipeDelay(self, activeElementID, delay):
+        self.__sendPacket(SetPipeDelayCommand, (activeElementID, delay))
+
+    def setContainerGeometry(self, containerID, levels, volumes):
+        self.__sendPacket(SetContainerGeometryCommand, (containerID, levels, volumes))
     
     def setValveState(self, actuatorId, percent):
         self.__sendPacket(ControlValveCommand, (actuatorId, ControlValveCommand.SET_ACTION, percent))
@@ -58,6 +71,24 @@ class NetworkSimulatorFacade(AbstractSimulatorFacade):
 
     def run(self, deltaT, repeat=1):
         self.__sendPacket(RunNextStepCommand, (deltaT, repeat))
+
+    def runUntil(self, deltaT, conditions, maxTime, timeTolerance=None):
+        return self.__sendPacketWithReturn('result', RunUntilCommand, (deltaT, conditions, maxTime, timeTolerance))
+
+    def flushLogs(self):
+        self.__sendPacket(FlushLogsCommand, ())
+
+    def setAsyncLogging(self, queueSize, overflow='block'):
+        self.__sendPacket(SetAsyncLoggingCommand, (queueSize, overflow))
+
+    def getLogMetrics(self):
+        return self.__sendPacketWithReturn('metrics', GetLogMetricsCommand, ())
+
+    def setLogFormat(self, logFormat):
+        self.__sendPacket(SetLogFormatCommand, (logFormat,))
+
+    def runAdaptive(self, duration, tolerance):
+        return self.__sendPacketWithReturn('steps', RunAdaptiveCommand, (duration, tolerance))
     
     def getListOfIds(self):
         return self.__sendPacketWithReturn('idlist', GetListOfIdsCommand, ())
@@ -68,9 +99,37 @@ class NetworkSimulatorFacade(AbstractSimulatorFacade):
     def deleteFluidsimObject(self, objectID):
         return self.__sendPacketWithReturn('removed', DeleteObjectCommand, (objectID,))
 
+    def solveSteadyState(self, apply):
+        return self.__sendPacketWithReturn('steadystate', SolveSteadyStateCommand, (apply,))
+
     def setRampingParams(self, objectID, rampParams):
         self.__sendPacket(SetRampingParamsCommand, (rampParams,))
     
+    def setStepEngine(self, engineName, options=None):
+        self.__sendPacket(SetStepEngineCommand, (engineName, options))
+
+    def setQuiescenceDetection(self, tolerance, checkPeriod=10):
+        self.__sendPacket(SetQuiescenceDetectionCommand, (tolerance, checkPeriod))
+
+    def getComponentStatistics(self):
+        return self.__sendPacketWithReturn('components', GetComponentStatisticsCommand, ())
+
+    def createEnsemble(self, size): raise NotImplementedError()
+
+    def evaluateRollouts(self, actuatorIDs, candidates, horizon, deltaT, cost, workers=None):
+        return self.__sendPacketWithReturn('costs', EvaluateRolloutsCommand, (actuatorIDs, candidates, horizon, deltaT, cost, workers))
+
+    def fork(self):
+        return self.forkMany(1)[0]
+
+    def forkMany(self, count):
+        forkIDs = self.__sendPacketWithReturn('forkids', ForkCommand, (count,))
+        return [NetworkSimulatorFacade(None, forkID, self.socketHandler) for forkID in forkIDs]
+
+    def dropFork(self):
+        """ Frees the fork on the server, the facade can't be used after it """
+        self.__sendPacket(DropForksCommand, ([self.forkID],))
+
     def serialize(self): raise NotImplementedError()
     
     def deserialize(self, serial): raise NotImplementedError()
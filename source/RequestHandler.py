@@ -35,6 +35,7 @@ def buildRequestHandler(simulator):
                     elif action == "KILL":
                         self.keepRunning = False
                         RequestHandler.shutdownServer = True
+                        self.simulator.flushLogs()
                         self.server.shutdown()
                         
     return RequestHandler
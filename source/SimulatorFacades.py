@@ -68,6 +68,9 @@ class AbstractSimulatorFacade(object):
     def addPipe(self, ID1, ID2, radius, length, height): raise NotImplementedError()
     def addValve(self, ID1, ID2, minRadius, maxRadius, length, height): raise NotImplementedError()
     def addPump(self, ID1, ID2, radius, length, height, maxPressure): raise NotImplementedError()
+    def addJunction(self, containerIDs, radii, lengths, height): raise NotImplementedError()
+    def setPipeDelay(self, activeElementID, delay): raise NotImplementedError()
+    def setContainerGeometry(self, containerID, levels, volumes): raise NotImplementedError()
     def setValveState(self, activeElementID, percent): raise NotImplementedError()
     def openValve(self, activeElementID, percentPoint): raise NotImplementedError()
     def closeValve(self, activeElementID, percentPoint): raise NotImplementedError()
@@ -77,12 +80,29 @@ class AbstractSimulatorFacade(object):
     def getFluidsimObjectDescription(self, objectID): raise NotImplementedError()
     def setContainerState(self, containerID, fluidTemperature, fluidLevel): raise NotImplementedError()
     def run(self, deltaT, repeat=1): raise NotImplementedError()
+    def runUntil(self, deltaT, conditions, maxTime, timeTolerance=None): raise NotImplementedError()
+    def flushLogs(self): raise NotImplementedError()
+    def setAsyncLogging(self, queueSize, overflow='block'): raise NotImplementedError()
+    def getLogMetrics(self): raise NotImplementedError()
+    def setLogFormat(self, logFormat): raise NotImplementedError()
+    def runAdaptive(self, duration, tolerance): raise NotImplementedError()
+    def solveSteadyState(self, apply): raise NotImplementedError()
     def getListOfIds(self): raise NotImplementedError()
     def getContainersOfActiveElement(self, activeElementId): raise NotImplementedError()
     def serialize(self): raise NotImplementedError()
     def deserialize(self, serial): raise NotImplementedError()
     def deleteFluidsimObject(self, objectID): raise NotImplementedError()
     def setRampingParams(self, objectID, rampParams): raise NotImplementedError()
+    def setStepEngine(self, engineName, options=None): raise NotImplementedError()
+    def setQuiescenceDetection(self, tolerance, checkPeriod=10): raise NotImplementedError()
+    def getComponentStatistics(self): raise NotImplementedError()
+    def createEnsemble(self, size): raise NotImplementedError()
+    def evaluateRollouts(self, actuatorIDs, candidates, horizon, deltaT, cost, workers=None): raise NotImplementedError()
+    def fork(self): raise NotImplementedError()
+    def forkMany(self, count): raise NotImplementedError()
+    def registerForks(self, count, sourceForkID=None): raise NotImplementedError()
+    def getFork(self, forkID): raise NotImplementedError()
+    def dropForks(self, forkIDs): raise NotImplementedError()
 
 class GenericSimulatorFacade(AbstractSimulatorFacade):
     """
@@ -105,6 +125,15 @@ class GenericSimulatorFacade(AbstractSimulatorFacade):
     
     def addPump(self, ID1, ID2, radius, length, height, maxPressure):
         return self.sim.addPump(ID1, ID2, radius, length, height, maxPressure)
+
+    def addJunction(self, containerIDs, radii, lengths, height):
+        return self.sim.addJunction(containerIDs, radii, lengths, height)
+
+    def setPipeDelay(self, activeElementID, delay):
+        self.sim.setPipeDelay(activeElementID, delay)
+
+    def setContainerGeometry(self, containerID, levels, volumes):
+        self.sim.setContainerGeometry(containerID, levels, volumes)
         
     def setValveState(self, activeElementID, percent):
         return self.sim.setValveState(activeElementID, percent)
@@ -133,6 +162,27 @@ class GenericSimulatorFacade(AbstractSimulatorFacade):
     def run(self, deltaT, repeat=1):
         return self.sim.run(deltaT, repeat)
 
+    def runAdaptive(self, duration, tolerance):
+        return self.sim.runAdaptive(duration, tolerance)
+
+    def runUntil(self, deltaT, conditions, maxTime, timeTolerance=None):
+        return self.sim.runUntil(deltaT, conditions, maxTime, timeTolerance)
+
+    def flushLogs(self):
+        self.sim.flushLogs()
+
+    def setAsyncLogging(self, queueSize, overflow='block'):
+        self.sim.setAsyncLogging(queueSize, overflow)
+
+    def getLogMetrics(self):
+        return self.sim.getLogMetrics()
+
+    def setLogFormat(self, logFormat):
+        self.sim.setLogFormat(logFormat)
+
+    def solveSteadyState(self, apply):
+        return self.sim.solveSteadyState(apply)
+
     def getListOfIds(self):
         return self.sim.getListOfIds()
         
@@ -149,4 +199,35 @@ class GenericSimulatorFacade(AbstractSimulatorFacade):
         return self.sim.deleteFluidsimObject(objectID)
         
     def setRampingParams(self, objectID, rampParams):
-        return self.sim.setRampingParams(objectID, rampParams)    
+        return self.sim.setRampingParams(objectID, rampParams)
+
+    def setStepEngine(self, engineName, options=None):
+        return self.sim.setStepEngine(engineName, options)
+
+    def setQuiescenceDetection(self, tolerance, checkPeriod=10):
+        return self.sim.setQuiescenceDetection(tolerance, checkPeriod)
+
+    def getComponentStatistics(self):
+        return self.sim.getComponentStatistics()
+
+    def createEnsemble(self, size):
+        return self.sim.createEnsemble(size)
+
+    def evaluateRollouts(self, actuatorIDs, candidates, horizon, deltaT, cost, workers=None):
+        return self.sim.evaluateRollouts(actuatorIDs, candidates, horizon, deltaT, cost, workers)
+
+    def fork(self):
+        return self.sim.fork()
+
+    def forkMany(self, count):
+        return self.sim.forkMany(count)
+
+    def registerForks(self, count, sourceForkID=None):
+        return self.sim.registerForks(count, sourceForkID)
+
+    def getFork(self, forkID):
+        return self.sim.getFork(forkID)
+
+    def dropForks(self, forkIDs):
+        return self.sim.dropForks(forkIDs)
+    
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Measures the memory used by the fluidsim objects of a big model.
+# Usage: python benchmark_memory.py [number of containers]
+# A chain of containers is built, every 10th connection is a valve, every 10th is a pump,
+# the others are pipes. The result is in bytes per container and per active element.
+
+import sys
+import gc
+import types
+
+from DirectSyncronizedSimulatorFacade import DirectSyncronizedSimulatorFacade
+
+SHARED_TYPES = (type, types.ModuleType, types.CodeType, types.ClassType)
+
+def deepSizeOf(roots):
+    """
+    The size of everything reachable from the roots, except classes, modules and the globals of the functions.
+    Returns the total and a {type name: (instance count, bytes)} breakdown.
+    """
+    seen = set()
+    stack = list(roots)
+    breakdown = {}
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        count, size = breakdown.get(type(obj).__name__, (0, 0))
+        breakdown[type(obj).__name__] = (count+1, size+sys.getsizeof(obj))
+        if isinstance(obj, types.FunctionType):
+            stack.extend(cell.cell_contents for cell in (obj.func_closure or ()))
+            stack.extend(obj.func_defaults or ())
+        else:
+            stack.extend(gc.get_referents(obj))
+    return sum(size for count, size in breakdown.values()), breakdown
+
+def buildModel(containerCount):
+    simulator = DirectSyncronizedSimulatorFacade()
+    simulator.logManager.logHandlerTypes = []  # No log files for the benchmark
+    containerIDs = [simulator.addContainer(50, 10, False) for i in range(0, containerCount)]
+    for i in range(0, containerCount-1):
+        if i % 10 == 3:
+            simulator.addValve(containerIDs[i], containerIDs[i+1], 0, 0.1, 5, 0)
+        elif i % 10 == 7:
+            simulator.addPump(containerIDs[i], containerIDs[i+1], 0.05, 5, 0, 0.5)
+        else:
+            simulator.addPipe(containerIDs[i], containerIDs[i+1], 0.05, 5, 0)
+    return simulator
+
+if __name__ == "__main__":
+    containerCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    simulator = buildModel(containerCount)
+    elementCount = len([c for c in simulator.containers if c is not None]) + \
+                   len([e for e in simulator.activeElements if e is not None])
+    totalSize, breakdown = deepSizeOf([simulator.containers, simulator.activeElements])
+
+    print "Elements (containers and active elements): ", elementCount
+    print "Bytes per element:                         ", totalSize / elementCount
+    print ""
+    print "%-24s %10s %12s %10s" % ("type", "instances", "bytes", "B/element")
+    for name, (count, size) in sorted(breakdown.items(), key=lambda item: -item[1][1]):
+        print "%-24s %10d %12d %10.1f" % (name, count, size, float(size) / elementCount)
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Connected components of the container/pipe graph of a simulator.
+# The components don't exchange fluid, so they can be stepped independently.
+
+from fluidsim_core import StaticFluid
+
+class ComponentTracker(object):
+    """
+    Keeps the connected components of a model up to date while it's edited.
+    Two dynamic containers are in the same component if a chain of pipes joins them.
+    The static containers don't join components: a flow never changes them, so two components
+    sharing a static source or sink still don't affect each other.
+    A new pipe merges two components in the union-find at once. A deletion can split a component,
+    so after a deletion the union-find is rebuilt when the components are requested next time.
+    """
+    def __init__(self):
+        self.parents = {}  # id(container) -> id(parent container), only the dynamic containers
+        self.dirty = False
+        self.version = 0  # Changes with every edit, the engines cache their partitions by it
+        self.components = None
+
+    def __find(self, node):
+        parents = self.parents
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    def __union(self, a, b):
+        rootA, rootB = self.__find(a), self.__find(b)
+        if rootA != rootB:
+            self.parents[rootB] = rootA
+
+    def __changed(self):
+        self.version += 1
+        self.components = None
+
+    @staticmethod
+    def isJoining(container):
+        return not isinstance(container.fluid, StaticFluid)
+
+    def addContainer(self, container):
+        if self.isJoining(container):
+            self.parents[id(container)] = id(container)
+        self.__changed()
+
+    def __joinContainers(self, element):
+        joining = [container for container in element.getContainers() if self.isJoining(container)]
+        for container in joining[1:]:
+            self.__union(id(joining[0]), id(container))
+
+    def addPipe(self, pipe):
+        # pipe is any active element, a junction joins all of its containers
+        if not self.dirty:
+            self.__joinContainers(pipe)
+        self.__changed()
+
+    def removeObject(self, obj):
+        # obj is a container or a pipe, either can split its component
+        self.dirty = True
+        self.__changed()
+
+    def rebuild(self, containers, activeElements):
+        self.parents = dict((id(c), id(c)) for c in containers if c is not None and self.isJoining(c))
+        for element in activeElements:
+            if element is not None:
+                self.__joinContainers(element)
+        self.dirty = False
+        self.__changed()
+
+    def getComponents(self, containers, activeElements):
+        """
+        Returns the components as (containers, active elements) pairs, the containers include the
+        static containers joined to the component. The active elements keep
+        their order in activeElements, so stepping a component alone gives the same result as
+        stepping the whole model. The components without active elements are left out.
+        The elements between static containers move nothing, but their ramps have to move,
+        so they are collected into one more component of static containers.
+        """
+        if self.dirty:
+            self.rebuild(containers, activeElements)
+        if self.components is not None:
+            return self.components
+
+        groups = {}
+        order = []
+        def group(root):
+            if root not in groups:
+                groups[root] = ([], [])
+                order.append(root)
+            return groups[root]
+
+        for container in containers:
+            if container is not None and self.isJoining(container):
+                group(self.__find(id(container)))[0].append(container)
+        for element in activeElements:
+            if element is None:
+                continue
+            joining = [container for container in element.getContainers() if self.isJoining(container)]
+            if joining:
+                component = group(self.__find(id(joining[0])))
+            else:
+                component = group(None)
+            component[1].append(element)
+            # The static containers are shared by the components which use them, but only read
+            for container in element.getContainers():
+                if not self.isJoining(container) and container not in component[0]:
+                    component[0].append(container)
+        self.components = [groups[root] for root in order if groups[root][1]]
+        return self.components
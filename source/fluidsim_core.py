@@ -9,25 +9,36 @@
 
 # Uncovered physical phenomens
 #  * Thermal expansion
-#  * Delay of pipes
 
 # while ((1)); do sleep 1; a=`pep8 fluidsim.py | grep -v "blank line contains whitespace" | grep -v "line too long" | grep -v "trailing whitespace" | head -n 1`; clear; echo $a; done
 
 import math
 import cmath
+import bisect
 import SocketServer
 import threading
+import time
+import atexit
+import weakref
+from collections import OrderedDict
 from utilities import PhysConsts
 from os import linesep
 
 class TooManyContainersForOnePipe(Exception):
     pass
 
-class LogableInterface:
+# The simulation objects are slotted: big models have hundreds of thousands of them,
+# and a per-instance __dict__ would dominate their memory.
+
+class LogableInterface(object):
+    __slots__ = ()
+
     def log(self):
         return {}
 
-class FluidsimObject(object, LogableInterface):
+class FluidsimObject(LogableInterface):
+    __slots__ = ()
+
     def getDescription(self):
         return {}
     
@@ -35,6 +46,8 @@ class FluidsimObject(object, LogableInterface):
         raise NotImplementedError()
         
 class Fluid(FluidsimObject):
+    __slots__ = ('_volume', '_temperature', '_rho', '_eta')
+
     def __init__(self, volume, temperature):
         self._volume = volume
         self._temperature = temperature
@@ -66,13 +79,28 @@ class Fluid(FluidsimObject):
         return self._rho
 
     def add(self, fluid):
+        self.receive(fluid._volume, fluid._temperature)
+
+    def receive(self, volume, temperature):
         # Computing the common temperature with a weighted average
-        if self.volume() + fluid.volume() > 0:
-            commonTemp = (self.volume()*self.temperature() + fluid.volume()*fluid.temperature()) / (self.volume() + fluid.volume())
+        newVolume = self._volume + volume
+        if newVolume > 0:
+            self._temperature = (self._volume*self._temperature + volume*temperature) / newVolume
         else:
-            commonTemp = 0
-        self._temperature = commonTemp
-        self._volume = self._volume + fluid._volume
+            self._temperature = 0
+        self._volume = newVolume
+
+    def transferTo(self, dest, volume):
+        # Moves the volume (or everything, if there isn't enough) with its heat into dest.
+        # Same as dest.add(self.remove(volume)), but without the temporary Fluid object.
+        # Returns the moved volume.
+        if self._volume < volume:
+            volume = self._volume
+            self._volume = 0
+        else:
+            self._volume -= volume
+        dest.receive(volume, self._temperature)
+        return volume
 
     def remove(self, volume):
         if self.volume() < volume:
@@ -83,6 +111,25 @@ class Fluid(FluidsimObject):
             self._volume -= volume
         return ret
 
+    def take(self, volume):
+        # Removes the volume (or everything, if there isn't enough), returns the removed volume.
+        # The removed fluid has the own temperature.
+        if self._volume < volume:
+            volume = self._volume
+            self._volume = 0
+        else:
+            self._volume -= volume
+        return volume
+
+    def exchange(self, outVolume, inVolume, inHeat):
+        # Applies the sum of the simultaneous flows of one step.
+        # The outflow leaves with the own temperature, inHeat is the sum of volume*temperature of the inflows.
+        remaining = max(self._volume - outVolume, 0)
+        newVolume = remaining + inVolume
+        if newVolume > 0:
+            self._temperature = (remaining*self._temperature + inHeat) / newVolume
+        self._volume = newVolume
+
     def pressure(self, height):
         return self.rho() * height * PhysConsts.g
 
@@ -91,6 +138,7 @@ class StaticFluid(Fluid):
     The level or temperature never changes.
     It can simulate a source or a sink.
     """
+    __slots__ = ()
 
     def add(self, fluid):
         pass
@@ -98,20 +146,58 @@ class StaticFluid(Fluid):
     def remove(self, volume):
         return Fluid(volume, self.temperature())
 
+    def receive(self, volume, temperature):
+        pass
+
+    def transferTo(self, dest, volume):
+        dest.receive(volume, self._temperature)
+        return volume
+
+    def take(self, volume):
+        return volume
+
+    def exchange(self, outVolume, inVolume, inHeat):
+        pass
+
 class Pipe(FluidsimObject):
     """
      The active elements (Pipe, Valve, Pump) connect two containers and fluid can flow through via them
      The active elements can only be HORIZONTAL.
-     The active elements have no delay
-     If you want to model diagonal or delayed pipes, you have to model them with two pipes and an additional container between them
+     The fluid arrives with the delay of setDelay (default 0), meanwhile it's in the DelayLine of the pipe
+     If you want to model diagonal pipes, you have to model them with two pipes and an additional container between them
+     For a branching use a Junction, it has no storage, so it doesn't make the model stiff like a small container
+     The joints are stored positionally: containers[i] is joined at jointHeights[i] (measured from its bottom)
     """
+    __slots__ = ('containers', 'jointHeights', 'jointPressures', '_radius', '_conductance', 'length', 'height', 'delayLine')
+
     def __init__(self, radius, length, height):
         assert length>0, "Length is zero"
         self.containers = []
         self.jointHeights = []
+        self.jointPressures = []  # The hydrostatic pressure of the joints, it doesn't change
+        self._radius = None
+        self._conductance = None
         self.radius = radius
         self.length = length
         self.height = height
+        self.delayLine = None
+
+    def getRadius(self):
+        return self._radius
+
+    def setRadius(self, radius):
+        if radius != self._radius:
+            self._radius = radius
+            self._conductance = None
+
+    radius = property(getRadius, setRadius)
+
+    def getConductance(self):
+        # The geometric part of the flow: stream = conductance / eta * (p0 - p1)
+        # It changes only with the radius, so it's computed once for every radius.
+        if self._conductance is None:
+            self._conductance = math.pi * pow(self._radius, 4) / (8.0 * self.length)
+        return self._conductance
     
     def getContainer1(self):
         return self.containers[0]
@@ -119,22 +205,49 @@ class Pipe(FluidsimObject):
     def getContainer2(self):
         return self.containers[1]
 
+    def getContainers(self):
+        return self.containers
+
     def __getFluidStream(self):
         source, p0, dest, p1 = self._getSourceAndDestiny()
         q = self._getFluidQuantity(p0, p1, source, 1)
         return q
              
     def getDescription(self):
-        return {'type':'activeElement', 'subtype':'pipe', 'radius':self.radius,'length':self.length,'height':self.height,'stream':self.__getFluidStream()}
+        return {'type':'activeElement', 'subtype':'pipe', 'radius':self.radius,'length':self.length,'height':self.height,'stream':self.__getFluidStream(),
+                'delay':self.getDelay(), 'intransit':self.getVolumeInTransit()}
         
     def log(self):
         q = self.__getFluidStream()    
         return {'stream':self.__getFluidStream()}
         
-    def attach(self, container):
-        self.containers.append(container)
-        if len(self.containers) > 2:
+    def attach(self, container, jointHeight):
+        if len(self.containers) >= 2:
             raise TooManyContainersForOnePipe()
+        self.containers.append(container)
+        self.jointHeights.append(jointHeight)
+        self.jointPressures.append(container.fluid.pressure(jointHeight))
+
+    def setDelay(self, delay):
+        """ The fluid leaving the source reaches the destiny after delay seconds """
+        delay = float(delay)
+        if delay > 0:
+            if self.delayLine is None:
+                self.delayLine = DelayLine(delay)
+            else:
+                self.delayLine.delay = delay
+        elif self.delayLine is not None:
+            self.delayLine.flush(self.containers)
+            self.delayLine = None
+
+    def getDelay(self):
+        return 0.0 if self.delayLine is None else self.delayLine.delay
+
+    def getVolumeInTransit(self):
+        return 0.0 if self.delayLine is None else self.delayLine.getVolume()
+
+    def getJointHeight(self, container):
+        return self.jointHeights[self.containers.index(container)]
 
     def destroy(self):
         for container in self.containers:
@@ -155,14 +268,14 @@ class Pipe(FluidsimObject):
         return pow(self.radius, 2) * (p0 - p1) / (4 * source.eta() * self.length) / 2
 
     def _getFluidQuantity(self, p0, p1, source, dT):
-        v = self._getFlowSpeed(p0, p1, source)
-        return v*dT*pow(self.radius, 2) * math.pi
+        # v*dT*r^2*pi with the flowspeed of _getFlowSpeed, the constant factors are in the conductance
+        return self.getConductance() * (p0 - p1) / source.eta() * dT
 
     def _getPressure0(self):
-        return self.containers[0].getPressureOnPipe(self)
+        return self.containers[0].getPressureAtJoint(self.jointPressures[0])
     
     def _getPressure1(self):
-        return self.containers[1].getPressureOnPipe(self)
+        return self.containers[1].getPressureAtJoint(self.jointPressures[1])
         
     def _getSourceAndDestiny(self):
         p0 = self._getPressure0()
@@ -178,14 +291,103 @@ class Pipe(FluidsimObject):
             dest = self.containers[0].fluid
         return (source, p0, dest, p1)
     
+    def advanceActuator(self, dT):
+        # A simple pipe has no actuator. Valves and pumps move their ramps here.
+        pass
+
+    def computeFlux(self, dT):
+        """ Returns the source and destiny fluid and the volume flowing in dT, without moving anything """
+        source, p0, dest, p1 = self._getSourceAndDestiny()
+        return (source, dest, self._getFluidQuantity(p0, p1, source, float(dT)))
+
+    def computeFluxes(self, dT):
+        """ computeFlux for every source-destiny pair of the element """
+        return [self.computeFlux(dT)]
+
     def flow(self, dT):
         dT = float(dT)
         source, p0, dest, p1 = self._getSourceAndDestiny()
         q = self._getFluidQuantity(p0, p1, source, dT)
-        fluid = source.remove(q)
-        dest.add(fluid)
+        if self.delayLine is None:
+            return source.transferTo(dest, q)
+        end = 1 if dest is self.containers[1].fluid else 0
+        temperature = source.temperature()
+        q = source.take(q)
+        delivered = self.delayLine.shift(end, q, temperature, dT, self.containers)
+        return max(q, delivered)
+
+class DelayLine(FluidsimObject):
+    """
+    The fluid travelling in a pipe with a transport delay.
+    It's a ring buffer with one slot for every step of the delay, a slot holds the volume and
+    the temperature travelling to each end of the pipe. A step delivers the oldest slot and
+    reuses it for the new fluid, so the cost doesn't depend on the length of the delay.
+    If the step changes, the content is redistributed into the slots of the new step.
+    """
+    __slots__ = ('delay', 'volumes', 'temperatures', 'head')
+
+    def __init__(self, delay):
+        self.delay = float(delay)
+        self.volumes = ([0.0], [0.0])  # For the first and the second end of the pipe
+        self.temperatures = ([0.0], [0.0])
+        self.head = 0  # The oldest slot
+
+    def getVolume(self):
+        return sum(self.volumes[0]) + sum(self.volumes[1])
+
+    def __resize(self, steps):
+        count = len(self.volumes[0])
+        volumes = ([0.0] * steps, [0.0] * steps)
+        temperatures = ([0.0] * steps, [0.0] * steps)
+        for i in range(0, count):
+            slot = (self.head + i) % count
+            newSlot = min(steps - 1, i * steps // count)
+            for end in (0, 1):
+                volume = self.volumes[end][slot]
+                if volume > 0:
+                    total = volumes[end][newSlot] + volume
+                    temperatures[end][newSlot] = (volumes[end][newSlot] * temperatures[end][newSlot] + volume * self.temperatures[end][slot]) / total
+                    volumes[end][newSlot] = total
+        self.volumes = volumes
+        self.temperatures = temperatures
+        self.head = 0
+
+    def shift(self, end, volume, temperature, dT, containers):
+        """ Delivers the oldest slot to the containers and puts the volume going to containers[end] in its place """
+        steps = max(1, int(round(self.delay / dT)))
+        if steps != len(self.volumes[0]):
+            self.__resize(steps)
+        head = self.head
+        delivered = 0.0
+        for k in (0, 1):
+            if self.volumes[k][head] > 0:
+                containers[k].fluid.receive(self.volumes[k][head], self.temperatures[k][head])
+                delivered += self.volumes[k][head]
+            self.volumes[k][head] = 0.0
+        self.volumes[end][head] = volume
+        self.temperatures[end][head] = temperature
+        self.head = (head + 1) % steps
+        return delivered
+
+    def getState(self):
+        return (self.volumes[0][:], self.volumes[1][:], self.temperatures[0][:], self.temperatures[1][:], self.head)
+
+    def setState(self, state):
+        volumes0, volumes1, temperatures0, temperatures1, self.head = state
+        self.volumes = (volumes0[:], volumes1[:])
+        self.temperatures = (temperatures0[:], temperatures1[:])
+
+    def flush(self, containers):
+        """ Delivers everything at once """
+        for k in (0, 1):
+            for slot in range(0, len(self.volumes[k])):
+                if self.volumes[k][slot] > 0:
+                    containers[k].fluid.receive(self.volumes[k][slot], self.temperatures[k][slot])
+                self.volumes[k][slot] = 0.0
 
 class AbstractRamp(FluidsimObject):
+    __slots__ = ('setpoint', 'actValue')
+
     def __init__(self, initialValue):
         self.setpoint = initialValue
         self.actValue = initialValue
@@ -210,9 +412,25 @@ class AbstractRamp(FluidsimObject):
 
     def recalc(self, dT):
         raise NotImplementedError
+
+    def settle(self):
+        # Jumps to the end of the transient
+        self.actValue = self.setpoint
+
+    def isSettled(self, tolerance):
+        return abs(self.actValue - self.setpoint) <= tolerance
+
+    def getState(self):
+        # The values which are changed by recalc. A ramp can be rewound with setState.
+        return (self.actValue,)
+
+    def setState(self, state):
+        self.actValue = state[0]
     
 
 class LinearRamp(AbstractRamp):
+    __slots__ = ('delta',)
+
     def __init__(self, initialValue, delta):
         AbstractRamp.__init__(self, initialValue)
         self.delta = delta
@@ -239,32 +457,76 @@ class LinearRamp(AbstractRamp):
         else:
             self.actValue = max(self.actValue - difference, self.setpoint)
 
+# Transition matrices of SecondOrderDiffRamp, cached by (alpha, beta, dT).
+# The adaptive engine uses many different dT-s, so the cache is emptied when it becomes big.
+_secondOrderTransitions = {}
+_SECOND_ORDER_TRANSITION_CACHE_SIZE = 4096
+
+def getSecondOrderTransition(alpha, beta, dT):
+    """
+    Returns the discrete-time transition matrix (a flat 4-tuple, row major) which advances
+    the state (y-setpoint, y') of y + alpha*y' + beta*y'' = setpoint with dT.
+    It's the matrix exponential of the system matrix, computed from its eigenvalues.
+    """
+    key = (alpha, beta, dT)
+    transition = _secondOrderTransitions.get(key)
+    if transition is not None:
+        return transition
+
+    if beta == 0:
+        if alpha == 0:
+            # Without dynamics the output jumps to the setpoint
+            transition = (0.0, 0.0, 0.0, 0.0)
+        else:
+            k = math.exp(-dT / alpha)
+            transition = (k, 0.0, -k / alpha, 0.0)
+    else:
+        # x' = M x, where M = [[0, 1], [-1/beta, -alpha/beta]]
+        m = (0.0, 1.0, -1.0 / beta, -float(alpha) / beta)
+        D = alpha*alpha - 4*beta
+        if D == 0:
+            # exp(M t) = exp(l t) * (I + t (M - l I))
+            l = -alpha / (2. * beta)
+            k = math.exp(l * dT)
+            transition = (k * (1 + dT*(m[0]-l)), k * dT*m[1], k * dT*m[2], k * (1 + dT*(m[3]-l)))
+        else:
+            # Sylvester's formula: exp(M t) = (exp(l1 t) (M - l2 I) - exp(l2 t) (M - l1 I)) / (l1 - l2)
+            l1 = -(alpha + cmath.sqrt(D))/(2.*beta)
+            l2 = -(alpha - cmath.sqrt(D))/(2.*beta)
+            k1 = cmath.exp(l1 * dT) / (l1 - l2)
+            k2 = cmath.exp(l2 * dT) / (l1 - l2)
+            transition = ((k1*(m[0]-l2) - k2*(m[0]-l1)).real, ((k1-k2)*m[1]).real,
+                          ((k1-k2)*m[2]).real, (k1*(m[3]-l2) - k2*(m[3]-l1)).real)
+
+    if len(_secondOrderTransitions) >= _SECOND_ORDER_TRANSITION_CACHE_SIZE:
+        _secondOrderTransitions.clear()
+    _secondOrderTransitions[key] = transition
+    return transition
+
 class SecondOrderDiffRamp(AbstractRamp):
     """
-    The class solves symbolicly the following diff eqution:
+    The class solves the following diff eqution:
         y + alpha*y' + beta*y'' = setpoint
+    The state is the actual value and its derivative, a step multiplies the
+    deviation from the setpoint with the transition matrix of dT.
     """
+    __slots__ = ('alpha', 'beta', 'actDerivative')
     
     def __init__(self, initialValue, alpha, beta):
         AbstractRamp.__init__(self, initialValue)
         self.alpha = alpha
         self.beta = beta
-        
-        self.Y = lambda t: initialValue
-        self.dY = lambda t: 0
-        self.actTime = 0
+        self.actDerivative = 0.0
     
     def setParams(self, params):
         self.alpha = params[0]
         self.beta = params[1]
-        self.__refreshSolution()
     
     def getParams(self):
         return (self.alpha, self.beta)
 
     def setSetpoint(self, value):
         self.setpoint = value
-        self.__refreshSolution()
     
     def getSetpoint(self):
         return self.setpoint
@@ -273,63 +535,27 @@ class SecondOrderDiffRamp(AbstractRamp):
         return self.actValue
     
     def recalc(self, dT):
-        self.actTime += dT
-        self.actValue = self.Y(self.actTime)
-        
-    def __refreshSolution(self):
-        alpha = self.alpha
-        beta = self.beta    
-        D = math.pow(alpha, 2) - 4*beta
-
-        if beta == 0:
-            self.__generateFirstOrderDiffEq()
-        elif D == 0:
-            self.__generateSecOrderDiffEqWithIdenticalRoots()
-        else:
-            self.__generateSecOrderDiffEqWithDifferentRoots(D)
-        
-        self.actTime = 0           
-            
-    def __generateFirstOrderDiffEq(self):
-        alpha = self.alpha
-        Sp = self.setpoint
-        y_0 = self.Y(self.actTime)
-        
-        c = y_0-Sp
-        
-        self.Y = lambda t: c*math.exp(-1./alpha * t) + Sp
-        self.dY = lambda t: -1./alpha*c*math.exp(-1./alpha * t)
-    
-    def __generateSecOrderDiffEqWithIdenticalRoots(self):
-        y_0 = self.Y(self.actTime)
-        dY_0 = self.dY(self.actTime)
-        Sp = self.setpoint
-        alpha = self.alpha
-        beta = self.beta    
-        
-        l = -alpha / (2. * beta)
-        c1 = y_0 - Sp
-        c2 = dY_0 - c1*Sp
-        
-        self.Y = lambda t: c1*math.exp(l*t) + c2*t*math.exp(l*t) + Sp
-        self.dY = lambda t: l*c1*math.exp(l*t) + l*c2*t*math.exp(l*t)
-    
-    def __generateSecOrderDiffEqWithDifferentRoots(self, D):
-        y_0 = self.Y(self.actTime)
-        dY_0 = self.dY(self.actTime)
-        Sp = self.setpoint
-        alpha = self.alpha
-        beta = self.beta    
-        
-        l1 = -(alpha + cmath.sqrt(D))/(2.*beta)
-        l2 = -(alpha - cmath.sqrt(D))/(2.*beta)
-        
-        c2 = (dY_0 - l1*(y_0-Sp))/(l2-l1)
-        c1 = y_0 - Sp - c2
-        self.Y = lambda t: (c1*cmath.exp(l1*t) + c2*cmath.exp(l2*t) + Sp).real
-        self.dY = lambda t: (l1*c1*cmath.exp(l1*t) + l2*c2*cmath.exp(l2*t)).real
+        a, b, c, d = getSecondOrderTransition(self.alpha, self.beta, dT)
+        deviation = self.actValue - self.setpoint
+        self.actValue = self.setpoint + a*deviation + b*self.actDerivative
+        self.actDerivative = c*deviation + d*self.actDerivative
+
+    def settle(self):
+        self.actValue = self.setpoint
+        self.actDerivative = 0.0
+
+    def isSettled(self, tolerance):
+        return abs(self.actValue - self.setpoint) <= tolerance and abs(self.actDerivative) <= tolerance
+
+    def getState(self):
+        return (self.actValue, self.actDerivative)
+
+    def setState(self, state):
+        self.actValue, self.actDerivative = state
 
 class Valve(Pipe):
+    __slots__ = ('minRadius', 'maxRadius', 'ramp')
+
     def __init__(self, minRadius, maxRadius, length, height):   
         # Here, the self.radius is the current radius. (Like in the other two ActiveElements)
         super(Valve, self).__init__(maxRadius, length, height)
@@ -337,10 +563,13 @@ class Valve(Pipe):
         self.maxRadius = maxRadius
         self.ramp = SecondOrderDiffRamp(100, 10, 0)
     
-    def flow(self, dT):
+    def advanceActuator(self, dT):
         self.ramp.recalc(dT)
         self._recalcRadius()
-        Pipe.flow(self, dT)
+
+    def flow(self, dT):
+        self.advanceActuator(dT)
+        return Pipe.flow(self, dT)
     
     def log(self):
         l = Pipe.log(self)
@@ -362,8 +591,11 @@ class Valve(Pipe):
     def open(self, percentPoint):
         self.setPermeability(self.ramp.getActValue()+percentPoint)
     
+    def getRadiusFor(self, permeability):
+        return (self.maxRadius - self.minRadius)/100.0*permeability + self.minRadius
+
     def _recalcRadius(self):
-        self.radius = (self.maxRadius - self.minRadius)/100.0*self.ramp.getActValue() + self.minRadius
+        self.radius = self.getRadiusFor(self.ramp.getActValue())
         
     def setPermeability(self, percent):
         if percent < 0:
@@ -374,15 +606,20 @@ class Valve(Pipe):
 
 
 class Pump(Pipe):
+    __slots__ = ('maxPressure', 'performance', 'ramp')
+
     def __init__(self, radius, length, height, maxPressure):
         super(Pump, self).__init__(radius, length, height)
         self.maxPressure = maxPressure
         self.performance = 0
         self.ramp = SecondOrderDiffRamp(0, 10, 0)
 
-    def flow(self, dT):
+    def advanceActuator(self, dT):
         self.ramp.recalc(dT)
-        Pipe.flow(self, dT)
+
+    def flow(self, dT):
+        self.advanceActuator(dT)
+        return Pipe.flow(self, dT)
 
     def log(self):
         l = Pipe.log(self)
@@ -395,8 +632,11 @@ class Pump(Pipe):
         ret.update(self.ramp.getDescription())
         return ret
     
+    def getPressureFor(self, performance):
+        return self.maxPressure * performance / 100.0
+
     def actPressure(self):
-        return self.maxPressure * self.ramp.getActValue() / 100.0
+        return self.getPressureFor(self.ramp.getActValue())
     
     def setPerformance(self, percent):
         if percent > 100:
@@ -418,14 +658,136 @@ class Pump(Pipe):
         return super(Pump, self)._getPressure0()+self.actPressure()
 
 
+class Junction(FluidsimObject):
+    """
+    A branching point without storage, it joins any number of containers.
+    Every branch is a horizontal pipe from the junction to a container (attached in the order of the branches).
+    The pressure of the junction is solved in every step so that the streams of the branches sum to zero.
+    Like in a Pipe, the viscosity of a branch is the viscosity of its source, so the balance is solved
+    by iteration. The fluid leaving the junction has the mixed temperature of the inflows.
+    """
+    __slots__ = ('containers', 'jointHeights', 'jointPressures', 'radii', 'lengths', 'height', 'conductances')
+
+    MAX_ITERATIONS = 20
+
+    def __init__(self, radii, lengths, height):
+        assert len(radii) == len(lengths) and len(radii) >= 2, "A junction needs at least two branches"
+        assert min(lengths) > 0, "Length is zero"
+        self.containers = []
+        self.jointHeights = []
+        self.jointPressures = []
+        self.radii = [float(radius) for radius in radii]
+        self.lengths = [float(length) for length in lengths]
+        self.height = height
+        self.conductances = [math.pi * pow(radius, 4) / (8.0 * length) for radius, length in zip(self.radii, self.lengths)]
+
+    def attach(self, container, jointHeight):
+        if len(self.containers) >= len(self.radii):
+            raise TooManyContainersForOnePipe()
+        self.containers.append(container)
+        self.jointHeights.append(jointHeight)
+        self.jointPressures.append(container.fluid.pressure(jointHeight))
+
+    def getContainers(self):
+        return self.containers
+
+    def destroy(self):
+        for container in self.containers:
+            container.removePipe(self)
+
+    def advanceActuator(self, dT):
+        pass
+
+    def solve(self):
+        """ Returns the pressure of the junction and the stream of every branch (volume per second, positive into the junction) """
+        pressures = [container.getPressureAtJoint(jointPressure) for container, jointPressure in zip(self.containers, self.jointPressures)]
+        etas = [container.fluid.eta() for container in self.containers]
+        outEta = sum(etas) / len(etas)
+        pressure = None
+        for iteration in range(0, self.MAX_ITERATIONS):
+            weights = [conductance / (eta if pressure is None or p > pressure else outEta)
+                       for conductance, eta, p in zip(self.conductances, etas, pressures)]
+            total = sum(weights)
+            if total == 0:
+                return (pressures[0], [0.0] * len(pressures))
+            newPressure = sum(weight * p for weight, p in zip(weights, pressures)) / total
+            streams = [weight * (p - newPressure) for weight, p in zip(weights, pressures)]
+            inflow = sum(stream for stream in streams if stream > 0)
+            newOutEta = sum(stream * eta for stream, eta in zip(streams, etas) if stream > 0) / inflow if inflow > 0 else outEta
+            if newPressure == pressure and newOutEta == outEta:
+                break
+            pressure, outEta = newPressure, newOutEta
+        return (newPressure, streams)
+
+    def __getVolumes(self, dT):
+        """ The volumes flowing in dT, clamped by the sources, the outflows are scaled to the inflows """
+        pressure, streams = self.solve()
+        volumes = []
+        for container, stream in zip(self.containers, streams):
+            q = stream * dT
+            if q > 0 and not isinstance(container.fluid, StaticFluid):
+                q = min(q, container.fluid.volume())
+            volumes.append(q)
+        inflow = sum(q for q in volumes if q > 0)
+        outflow = -sum(q for q in volumes if q < 0)
+        scale = inflow / outflow if outflow > 0 else 0.0
+        return [q if q > 0 else q * scale for q in volumes], inflow
+
+    def computeFluxes(self, dT):
+        """ The flows as source-destiny pairs: every inflow is split between the outflows """
+        volumes, inflow = self.__getVolumes(float(dT))
+        fluxes = []
+        for source, qIn in zip(self.containers, volumes):
+            if qIn > 0:
+                for dest, qOut in zip(self.containers, volumes):
+                    if qOut < 0:
+                        fluxes.append((source.fluid, dest.fluid, qIn * -qOut / inflow))
+        return fluxes
+
+    def flow(self, dT):
+        volumes, inflow = self.__getVolumes(float(dT))
+        if inflow <= 0:
+            return 0.0
+        heat = 0.0
+        for container, q in zip(self.containers, volumes):
+            if q > 0:
+                heat += q * container.fluid.temperature()
+                container.fluid.exchange(q, 0, 0)
+        temperature = heat / inflow
+        for container, q in zip(self.containers, volumes):
+            if q < 0:
+                container.fluid.receive(-q, temperature)
+        return inflow
+
+    def getStream(self):
+        """ The volume per second flowing through the junction """
+        pressure, streams = self.solve()
+        return sum(stream for stream in streams if stream > 0)
+
+    def log(self):
+        return {'stream':self.getStream()}
+
+    def getDescription(self):
+        pressure, streams = self.solve()
+        return {'type':'activeElement', 'subtype':'junction', 'radii':self.radii, 'lengths':self.lengths, 'height':self.height,
+                'pressure':pressure, 'streams':streams, 'stream':sum(stream for stream in streams if stream > 0)}
+
 class StandardPressureCalculator(FluidsimObject):
+    __slots__ = ('area', 'fluid', 'maxVolume', '_cachedVolume', '_cachedPressure', '_pressurePerVolume')
+
     def __init__(self, area, maxWaterLevel):
         self.area = float(area)
         self.fluid = 0
         self.maxVolume = float(maxWaterLevel) * self.area
+        self._cachedVolume = None
+        self._cachedPressure = 0
+        self._pressurePerVolume = 0
     
     def setFluid(self, fluid):
         self.fluid = fluid
+        self._cachedVolume = None
+        # The pressure of a prismatic container grows linearly with the volume
+        self._pressurePerVolume = fluid.pressure(self.getWaterLevelFor(1.0))
     
     def getWaterLevelFor(self, volume):
         return float(volume)/float(self.area)
@@ -439,10 +801,17 @@ class StandardPressureCalculator(FluidsimObject):
     def setLevel(self, level):
         self.fluid.setVolume(self.getVolumeFor(level))
     
+    def getColumnPressure(self):
+        # The pressure at the bottom is recomputed only if the volume has changed since the last call,
+        # so every pipe of the container uses the same value within a step
+        volume = self.fluid.volume()
+        if volume != self._cachedVolume:
+            self._cachedVolume = volume
+            self._cachedPressure = volume * self._pressurePerVolume
+        return self._cachedPressure
+
     def getPressureAt(self, height):
-        fluidHeight = self.fluid.volume()/self.area
-        fluidHeight = self.getWaterLevelFor(self.fluid.volume())
-        return self.fluid.pressure(fluidHeight-height)
+        return self.getColumnPressure() - self.fluid.pressure(height)
 
     def log(self):
         return {"waterlevel":self.getWaterLevel()}
@@ -450,13 +819,84 @@ class StandardPressureCalculator(FluidsimObject):
     def getDescription(self):
         return {'maxvolume':self.maxVolume, 'waterlevel':self.getWaterLevel(), 'maxwaterlevel':self.getWaterLevelFor(self.maxVolume), 'area':self.area}
 
+class TabulatedPressureCalculator(StandardPressureCalculator):
+    """
+    A container with a nonlinear level-volume curve (cone, horizontal cylinder, ...).
+    The curve is a table of levels and the volumes below them, both increasing from (0, 0), linear between the points.
+    It's resampled to resolution equal volume steps, so getWaterLevelFor is one index computation.
+    getVolumeFor bisects the resampled levels. Beyond the table the last (or first) segment continues.
+    The area is the mean cross-section. CompiledNetwork evaluates the same curve for all containers at once.
+    """
+    __slots__ = ('volumeStep', 'levelTable')
+
+    def __init__(self, levels, volumes, resolution=1024):
+        levels = [float(level) for level in levels]
+        volumes = [float(volume) for volume in volumes]
+        if len(levels) != len(volumes) or len(levels) < 2:
+            raise ValueError("The table needs at least two levels with a volume for each")
+        if levels[0] != 0 or volumes[0] != 0:
+            raise ValueError("The table has to start from level 0 and volume 0")
+        for i in range(1, len(levels)):
+            if levels[i] <= levels[i-1] or volumes[i] <= volumes[i-1]:
+                raise ValueError("The levels and the volumes of the table have to increase")
+        resolution = int(resolution)
+        super(TabulatedPressureCalculator, self).__init__(volumes[-1] / levels[-1], levels[-1])
+        self.maxVolume = volumes[-1]
+        self.volumeStep = volumes[-1] / resolution
+        self.levelTable = []
+        segment = 0
+        for j in range(0, resolution + 1):
+            volume = min(j * self.volumeStep, volumes[-1])
+            while segment < len(volumes) - 2 and volumes[segment + 1] < volume:
+                segment += 1
+            fraction = (volume - volumes[segment]) / (volumes[segment + 1] - volumes[segment])
+            self.levelTable.append(levels[segment] + fraction * (levels[segment + 1] - levels[segment]))
+
+    @staticmethod
+    def getConeTable(bottomRadius, topRadius, height, count=64):
+        """ The table of a truncated cone standing on its bottom """
+        levels = [height * i / float(count) for i in range(0, count + 1)]
+        def volume(h):
+            r = bottomRadius + (topRadius - bottomRadius) * h / height
+            return math.pi * h * (bottomRadius ** 2 + bottomRadius * r + r ** 2) / 3.0
+        return levels, [volume(h) for h in levels]
+
+    @staticmethod
+    def getHorizontalCylinderTable(radius, length, count=64):
+        """ The table of a cylinder lying on its side """
+        levels = [2.0 * radius * i / float(count) for i in range(0, count + 1)]
+        def volume(h):
+            segment = radius ** 2 * math.acos(min(1.0, max(-1.0, (radius - h) / radius))) - (radius - h) * math.sqrt(max(0.0, 2 * radius * h - h * h))
+            return segment * length
+        return levels, [volume(h) for h in levels]
+
+    def getWaterLevelFor(self, volume):
+        x = float(volume) / self.volumeStep
+        segment = min(max(int(math.floor(x)), 0), len(self.levelTable) - 2)
+        table = self.levelTable
+        return table[segment] + (x - segment) * (table[segment + 1] - table[segment])
+
+    def getVolumeFor(self, level):
+        table = self.levelTable
+        segment = min(max(bisect.bisect_right(table, level) - 1, 0), len(table) - 2)
+        return (segment + (level - table[segment]) / (table[segment + 1] - table[segment])) * self.volumeStep
+
+    def getColumnPressure(self):
+        volume = self.fluid.volume()
+        if volume != self._cachedVolume:
+            self._cachedVolume = volume
+            self._cachedPressure = self.fluid.pressure(self.getWaterLevelFor(volume))
+        return self._cachedPressure
+
 class Container(FluidsimObject):
+    __slots__ = ('fluid', 'pressureCalculator', 'pipes', 'baseLine')
+
     def __init__(self, pressureCalculator, fluid=None):
         # pressureFunc : descendant of StandardPressureCalculator
         self.fluid = fluid if fluid is not None else Fluid(0,0)
         self.pressureCalculator = pressureCalculator
         self.pressureCalculator.setFluid(self.fluid)
-        self.joins = {}
+        self.pipes = []  # The joint heights are stored in the pipes
         self.baseLine = 0  # The distance between the container's bottom and the ground
 
     def log(self):
@@ -477,25 +917,68 @@ class Container(FluidsimObject):
         self.pressureCalculator.setLevel(level)
     
     def attachPipe(self, pipe):
-        self.joins[pipe] = pipe.height-self.baseLine
-        pipe.attach(self)
+        self.pipes.append(pipe)
+        pipe.attach(self, pipe.height-self.baseLine)
     
     def removePipe(self, pipe):
-        return self.joins.pop(pipe, False)
+        if pipe in self.pipes:
+            self.pipes.remove(pipe)
+            return True
+        return False
     
     def destroy(self):
-        attachedPipes = self.joins.keys() # the pipe.destroy will modify the self.joins dictionary, need copy from the keys
+        attachedPipes = list(self.pipes) # the pipe.destroy will modify the self.pipes list, need a copy
         for pipe in attachedPipes:
             pipe.destroy()
         return attachedPipes
+
+    def getPressureAtJoint(self, jointPressure):
+        return self.pressureCalculator.getColumnPressure() - jointPressure
     
     def getPressureOnPipe(self, pipe):
-        return self.pressureCalculator.getPressureAt(self.joins[pipe])
+        return self.getPressureAtJoint(pipe.jointPressures[pipe.containers.index(self)])
+
+class LogFilePool:
+    """
+    The open log files. At most maxOpenFiles are kept open, the least recently used one is closed first,
+    so a model with thousands of objects doesn't run out of file descriptors.
+    """
+    def __init__(self, maxOpenFiles=256):
+        self.maxOpenFiles = int(maxOpenFiles)
+        self.files = OrderedDict()  # filename -> file, the least recently used first
+
+    def write(self, filename, data):
+        f = self.files.pop(filename, None)
+        if f is None:
+            if len(self.files) >= self.maxOpenFiles:
+                oldestName, oldest = self.files.popitem(last=False)
+                oldest.close()
+            f = open(filename, 'a')
+        self.files[filename] = f
+        f.write(data)
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
 
 class FileLogHandler:
-    def __init__(self, prefix, logID, fluidSimObject):
+    """
+    Writes the logs of an object into a CSV file.
+    The lines are collected in memory and written in one piece when bufferSize bytes are collected
+    or when the LogManager flushes, through the LogFilePool of the LogManager.
+    """
+    def __init__(self, prefix, logID, fluidSimObject, filePool, bufferSize=65536):
         self.filename = str(prefix)+str(logID)+".log"
         self.fluidSimObject = fluidSimObject
+        self.filePool = filePool
+        self.bufferSize = bufferSize
+        self.pending = []
+        self.pendingSize = 0
         with open(self.filename, 'w') as f:
             firstLog = fluidSimObject.log()
             self.keys = firstLog.keys()
@@ -503,29 +986,115 @@ class FileLogHandler:
             for key in self.keys:
                 f.write(","+str(key))
             f.write(linesep)
-    
-    def createLog(self, timestamp):
+
+    def sample(self):
+        """ The actual values of the object, in the order of the keys """
         actLog = self.fluidSimObject.log()
-        with open(self.filename, 'a') as f:
-            f.write(str(timestamp))
-            for key in self.keys:
-                f.write(","+str(actLog[key]))
-            f.write(linesep)
-        
+        return [actLog[key] for key in self.keys]
+
+    def write(self, timestamp, values):
+        line = str(timestamp) + "".join([","+str(value) for value in values]) + linesep
+        self.pending.append(line)
+        self.pendingSize += len(line)
+        if self.pendingSize >= self.bufferSize:
+            self.flush()
+
+    def createLog(self, timestamp):
+        self.write(timestamp, self.sample())
+
+    def flush(self):
+        if self.pending:
+            self.filePool.write(self.filename, "".join(self.pending))
+            self.pending = []
+            self.pendingSize = 0
+
+# The weak references of the LogManagers, they are closed at exit
+logManagers = {}  # id(weak reference) -> weak reference
+
+def closeLogManagers():
+    for ref in logManagers.values():
+        logManager = ref()
+        if logManager is not None:
+            logManager.close()
+
+atexit.register(closeLogManagers)
+
 class LogManager:
-    def __init__(self, logHandlerTypeList):
+    """
+    Creates the logs of the monitored objects in every logPeriod of the simulation time.
+    The handlers buffer their logs, everything is written out after flushPeriod seconds of wall time,
+    by flush(), and at exit. A LogManager is referred weakly until the exit, if it's collected
+    before, its handlers are flushed then.
+    """
+    def __init__(self, logHandlerTypeList, maxOpenFiles=256, flushPeriod=5.0):
         self.logHandlerTypes = logHandlerTypeList
         self.logHandlers = []
         self.prefix = "logs/" 
         self.logPeriod = 1.0
         self.prevLogTimestamp = 0
+        self.filePool = LogFilePool(maxOpenFiles)
+        self.flushPeriod = flushPeriod
+        self.lastFlush = time.time()
+        self.tracker = None
+        self._track()
+
+    def _getFinalizer(self):
+        """ Closes the logs when the manager is collected, so it can't refer to the manager """
+        logHandlers, filePool = self.logHandlers, self.filePool
+        def finalize():
+            for logHandler in logHandlers:
+                logHandler.flush()
+            filePool.close()
+        return finalize
+
+    def _track(self):
+        """ Registers the manager for the exit, again when its handlers or file pool are replaced """
+        self._untrack()
+        finalize = self._getFinalizer()
+        def collected(ref):
+            if logManagers.pop(id(ref), None) is not None:
+                finalize()
+        self.tracker = weakref.ref(self, collected)
+        logManagers[id(self.tracker)] = self.tracker
+
+    def _untrack(self):
+        if self.tracker is not None:
+            logManagers.pop(id(self.tracker), None)
+            self.tracker = None
     
+    def takeOver(self, other):
+        """ Continues the logs of another LogManager, which isn't used any more """
+        other.close()
+        other._untrack()
+        self.logHandlerTypes = other.logHandlerTypes
+        self.logHandlers = other.logHandlers
+        self.prefix = other.prefix
+        self.logPeriod = other.logPeriod
+        self.prevLogTimestamp = other.prevLogTimestamp
+        self.filePool = other.filePool
+        self._track()
+
     def monitor(self, ID, fluidSimObject):
         for LogHandler in self.logHandlerTypes:
-            self.logHandlers.append(LogHandler(self.prefix, ID, fluidSimObject))
+            self.logHandlers.append(LogHandler(self.prefix, ID, fluidSimObject, self.filePool))
         
+    def isLogDue(self, timestamp):
+        return timestamp >= self.prevLogTimestamp + self.logPeriod
+
     def createLog(self, timestamp):
-        if timestamp >= self.prevLogTimestamp + self.logPeriod:
+        if self.isLogDue(timestamp):
             self.prevLogTimestamp = timestamp
             for logHandler in self.logHandlers:
-                logHandler.createLog(timestamp)       
+                logHandler.createLog(timestamp)
+            if time.time() - self.lastFlush >= self.flushPeriod:
+                self.flush()
+
+    def flush(self):
+        for logHandler in self.logHandlers:
+            logHandler.flush()
+        self.filePool.flush()
+        self.lastFlush = time.time()
+
+    def close(self):
+        self.flush()
+        self.filePool.close()
@@ -0,0 +1,1007 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Step engines advance the objects of a DirectSyncronizedSimulatorFacade.
+# Every simulator instance owns one engine and run() delegates to it, so the
+# facade API is the same whichever engine is selected.
+
+import math
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from fluidsim_core import StaticFluid, Pipe, Junction, Container
+from fluidsim_network import numpy, scatterAdd, CompiledNetwork, labelComponents, ActuatorBank
+from fluidsim_jit import JIT_AVAILABLE, FlatModel, UnsupportedModel
+
+class UnknownStepEngine(Exception):
+    pass
+
+class InvalidCondition(Exception):
+    pass
+
+# The quantities which can be watched by runUntil
+CONTAINER_QUANTITIES = ('waterlevel', 'volume', 'temperature')
+PIPE_QUANTITIES = ('stream',)
+
+def checkQuantity(obj, quantity):
+    if isinstance(obj, Container):
+        allowed = CONTAINER_QUANTITIES
+    elif isinstance(obj, (Pipe, Junction)):
+        allowed = PIPE_QUANTITIES
+    else:
+        raise InvalidCondition("Not a container or an active element")
+    if quantity not in allowed:
+        raise InvalidCondition("Unknown quantity '"+str(quantity)+"'. Possible quantities are: "+str(allowed))
+
+class StepEngine(object):
+    """
+    The common part of the engines.
+    The engine gets the object lists of the simulator at the beginning of every run(),
+    and it has to keep the objects up-to-date whenever somebody could read them (logging, end of run).
+    run() checks the logs after every logPeriod steps.
+    """
+    logPeriod = 1
+
+    def __init__(self):
+        self.containers = []
+        self.activeElements = []
+
+    def invalidate(self):
+        """ Called by the simulator when an object is added or deleted """
+        pass
+
+    def touch(self, obj):
+        """ Called by the simulator when a command changes obj (None: anything could have changed) """
+        pass
+
+    def checkModel(self, containers, activeElements):
+        """ Raises TypeError if the engine can't step the model """
+        pass
+
+    def prepare(self, containers, activeElements):
+        self.containers = containers
+        self.activeElements = activeElements
+
+    def step(self, dT):
+        raise NotImplementedError()
+
+    def syncObjects(self):
+        pass
+
+    def close(self):
+        """ Called by the simulator when the engine is replaced, frees its worker threads """
+        pass
+
+    @staticmethod
+    def _closePool(pool):
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def isQuiescent(self, tolerance):
+        """
+        True if every ramp is at its setpoint and no pipe moves more than tolerance volume per second.
+        A pipe can't move more than the volume of its source, so the empty containers don't count.
+        The fluid travelling in a delayed pipe arrives within the delay, so it's counted per delay.
+        """
+        for element in self.activeElements:
+            if element is None:
+                continue
+            ramp = getattr(element, 'ramp', None)
+            if ramp is not None and not ramp.isSettled(tolerance):
+                return False
+            if isinstance(element, Pipe) and element.getVolumeInTransit() > tolerance * element.getDelay():
+                return False
+            for source, dest, q in element.computeFluxes(1.0):
+                if not isinstance(source, StaticFluid):
+                    q = min(q, source.volume())
+                if abs(q) > tolerance:
+                    return False
+        return True
+
+    def settleObjects(self):
+        """ Puts the ramps of the objects to their setpoints before a fast-forward """
+        for element in self.activeElements:
+            ramp = getattr(element, 'ramp', None)
+            if ramp is not None:
+                ramp.settle()
+                element.advanceActuator(0.0)
+
+    def fastForward(self, simulator, deltaT, repeat, stepsDone=0):
+        """
+        Advances the time of a quiescent simulator with repeat steps without computing them.
+        The time is summed step by step like in run(), so the logs are created at the same
+        timestamps where the stepping would create them. stepsDone is the number of steps
+        of the run before the fast-forward, the logs are checked after every logPeriod steps of the run.
+        """
+        logManager = simulator.logManager
+        timestamp = simulator.simulationTime
+        due = logManager.prevLogTimestamp + logManager.logPeriod
+        step = stepsDone
+        end = stepsDone + repeat
+        while step < end:
+            timestamp += deltaT
+            step += 1
+            if timestamp >= due and step % self.logPeriod == 0:
+                simulator.simulationTime = timestamp
+                logManager.createLog(timestamp)
+                due = logManager.prevLogTimestamp + logManager.logPeriod
+        simulator.simulationTime = timestamp
+
+    def _checkQuiescence(self, simulator, stepCount):
+        """ Called after every step, returns True if the rest of the run can be fast-forwarded """
+        tolerance = simulator.quiescenceTolerance
+        if tolerance is None or stepCount % simulator.quiescenceCheckPeriod != 0:
+            return False
+        if not self.isQuiescent(tolerance):
+            return False
+        self.syncObjects()
+        self.settleObjects()
+        simulator.quiescent = True
+        return True
+
+    def prepareRun(self, simulator):
+        self.prepare(simulator.containers, simulator.activeElements)
+
+    def saveState(self):
+        """ Returns a snapshot of everything a step can change """
+        fluids = [(c.fluid, c.fluid.volume(), c.fluid.temperature()) for c in self.containers if c is not None]
+        actuators = [(e, e.ramp.getState(), e.radius) for e in self.activeElements if e is not None and hasattr(e, 'ramp')]
+        delayLines = [(e.delayLine, e.delayLine.getState()) for e in self.activeElements if isinstance(e, Pipe) and e.delayLine is not None]
+        return fluids, actuators, delayLines
+
+    def restoreState(self, snapshot):
+        fluids, actuators, delayLines = snapshot
+        for delayLine, state in delayLines:
+            delayLine.setState(state)
+        for fluid, volume, temperature in fluids:
+            fluid.setVolume(volume)
+            fluid.setTemperature(temperature)
+        for element, rampState, radius in actuators:
+            element.ramp.setState(rampState)
+            element.radius = radius
+
+    def getQuantity(self, obj, quantity):
+        """
+        The actual value of a quantity of checkQuantity. The stream is positive from the first container to the second,
+        the stream of a junction is the volume per second flowing through it.
+        """
+        if quantity == 'stream':
+            if isinstance(obj, Junction):
+                return obj.getStream()
+            source, dest, q = obj.computeFlux(1.0)
+            return q if source is obj.getContainer1().fluid else -q
+        volume = obj.fluid.volume()
+        if quantity == 'volume':
+            return volume
+        if quantity == 'waterlevel':
+            return obj.pressureCalculator.getWaterLevelFor(volume)
+        return obj.fluid.temperature()
+
+    def __firedConditions(self, conditions):
+        fired = []
+        for index, (obj, quantity, above, value) in enumerate(conditions):
+            actual = self.getQuantity(obj, quantity)
+            if (above and actual > value) or (not above and actual < value):
+                fired.append(index)
+        return fired
+
+    def __locate(self, snapshot, conditions, h, tolerance):
+        """ Bisection for the shortest step from the snapshot which fires a condition, it's taken at the end """
+        low, high = 0.0, h
+        while high - low > tolerance:
+            middle = 0.5 * (low + high)
+            self.restoreState(snapshot)
+            self.step(middle)
+            if self.__firedConditions(conditions):
+                high = middle
+            else:
+                low = middle
+        self.restoreState(snapshot)
+        self.step(high)
+        return high
+
+    def runUntil(self, simulator, deltaT, conditions, maxTime, timeTolerance=None):
+        """
+        Steps with deltaT until a condition becomes true or maxTime passes.
+        A condition is (object, quantity, above, value), it fires when the quantity is above
+        (or below) the value. The step where a condition fires is shortened by bisection
+        to timeTolerance (default: deltaT/1e6), so the run stops right after the crossing.
+        Returns the indices of the fired conditions, an empty list if the time limit was reached.
+        """
+        deltaT = float(deltaT)
+        maxTime = float(maxTime)
+        timeTolerance = deltaT * 1e-6 if timeTolerance is None else float(timeTolerance)
+        logManager = simulator.logManager
+        self.prepareRun(simulator)
+        fired = self.__firedConditions(conditions)
+        if fired or maxTime <= 0:
+            return fired
+        if simulator.quiescent:
+            # Nothing changes, so no condition can fire
+            repeat = int(math.ceil(maxTime / deltaT))
+            self.fastForward(simulator, maxTime / repeat, repeat)
+            return fired
+        end = simulator.simulationTime + maxTime
+        while not fired and end - simulator.simulationTime > timeTolerance:
+            h = min(deltaT, end - simulator.simulationTime)
+            snapshot = self.saveState()
+            self.step(h)
+            fired = self.__firedConditions(conditions)
+            if fired:
+                h = self.__locate(snapshot, conditions, h, timeTolerance)
+                fired = self.__firedConditions(conditions)
+            simulator.simulationTime += h
+            if logManager.isLogDue(simulator.simulationTime):
+                self.syncObjects()
+                logManager.createLog(simulator.simulationTime)
+        self.syncObjects()
+        return fired
+
+    def _runInChunks(self, simulator, deltaT, repeat, advance):
+        """
+        run() for the engines which take many steps at once: advance(dT, count) takes count steps
+        and updates the objects. The chunks end where a log is due or the quiescence is checked.
+        The time is summed step by step, so the logs fall on the same steps as in the serial run.
+        """
+        logManager = simulator.logManager
+        done = 0
+        while done < repeat:
+            count = 0
+            timestamp = simulator.simulationTime
+            logDue = False
+            while done + count < repeat:
+                count += 1
+                timestamp += deltaT
+                if logManager.isLogDue(timestamp):
+                    logDue = True
+                    break
+                if simulator.quiescenceTolerance is not None and (done + count) % simulator.quiescenceCheckPeriod == 0:
+                    break
+            advance(deltaT, count)
+            simulator.simulationTime = timestamp
+            done += count
+            if logDue:
+                logManager.createLog(timestamp)
+            if self._checkQuiescence(simulator, done):
+                self.fastForward(simulator, deltaT, repeat - done, done)
+                break
+
+    def run(self, simulator, deltaT, repeat):
+        deltaT = float(deltaT)
+        logManager = simulator.logManager
+        if simulator.quiescent:
+            self.fastForward(simulator, deltaT, repeat)
+            return
+        self.prepare(simulator.containers, simulator.activeElements)
+        for i in range(0, repeat):
+            self.step(deltaT)
+            simulator.simulationTime += deltaT
+            if (i + 1) % self.logPeriod == 0 and logManager.isLogDue(simulator.simulationTime):
+                self.syncObjects()
+                logManager.createLog(simulator.simulationTime)
+            if self._checkQuiescence(simulator, i + 1):
+                self.fastForward(simulator, deltaT, repeat - i - 1, i + 1)
+                return
+        self.syncObjects()
+
+class SequentialStepEngine(StepEngine):
+    """
+    The reference engine: every Pipe.flow moves the fluid immediately,
+    so the later pipes see the changes made by the earlier ones.
+    In a plant with many valves and pumps their ramps are advanced together (ActuatorBank)
+    before the pipes flow. A ramp doesn't depend on the flows, so the result is the same.
+    """
+    def __init__(self):
+        StepEngine.__init__(self)
+        self.flows = None
+        self.actuators = None
+
+    def prepare(self, containers, activeElements):
+        StepEngine.prepare(self, containers, activeElements)
+        self.activeElements = [element for element in activeElements if element is not None]
+        self.flows = None  # Built by the first step
+        self.actuators = None
+
+    def restoreState(self, snapshot):
+        StepEngine.restoreState(self, snapshot)
+        self.flows = None
+
+    def __batchActuators(self):
+        self.actuators = ActuatorBank.create(self.activeElements)
+        if self.actuators is None:
+            self.flows = [element.flow for element in self.activeElements]
+            return
+        self.actuators.gather()
+        batched = set(id(element) for element in self.actuators.elements)
+        self.flows = [partial(Pipe.flow, element) if id(element) in batched else element.flow for element in self.activeElements]
+
+    def step(self, dT):
+        if self.flows is None:
+            self.__batchActuators()
+        if self.actuators is not None:
+            self.actuators.advance(dT)
+        for flow in self.flows:
+            flow(dT)
+
+class SleepRegion(object):
+    __slots__ = ('containers', 'elements', 'quietSteps', 'asleep')
+
+    def __init__(self):
+        self.containers = []
+        self.elements = []
+        self.quietSteps = 0
+        self.asleep = False
+
+class SleepingStepEngine(SequentialStepEngine):
+    """
+    Sequential engine which steps only the awake regions of the plant.
+    A region is a connected part of the dynamic containers, joined by the pipes which can conduct.
+    The static containers and the closed valves separate the regions, nothing flows across them.
+    A region falls asleep when its ramps are at their setpoints and none of its pipes has moved
+    more than threshold volume per second for sleepSteps steps. The commands of the simulator
+    wake the regions they touch, a static container wakes every region attached to it.
+    The valves and pumps between static containers are in no region, only their ramps are moved until they settle.
+    """
+    def __init__(self, threshold=1e-9, sleepSteps=100):
+        SequentialStepEngine.__init__(self)
+        self.threshold = float(threshold)
+        self.sleepSteps = int(sleepSteps)
+        self.regions = None
+        self.regionOfContainer = {}  # id(container) -> SleepRegion
+        self.sleeping = set()  # id() of the containers of the sleeping regions, kept between two rebuilds
+        self.awakeRegions = []
+        self.boundaryElements = []  # The elements between static containers with moving ramps
+
+    def invalidate(self):
+        self.regions = None
+        self.sleeping.clear()
+
+    def touch(self, obj):
+        if obj is None:
+            self.invalidate()
+        elif isinstance(obj, (Pipe, Junction)):
+            # An actuator can join or split regions
+            for container in obj.getContainers():
+                self.__wake(container)
+            self.regions = None
+        else:
+            self.__wake(obj)
+
+    def __wake(self, container):
+        region = self.regionOfContainer.get(id(container))
+        if region is not None:
+            self.__wakeRegion(region)
+            return
+        self.sleeping.discard(id(container))
+        # A static container: its level drives the regions on the other side of its pipes
+        for element in getattr(container, 'pipes', ()):
+            for other in element.getContainers():
+                region = self.regionOfContainer.get(id(other))
+                if region is not None:
+                    self.__wakeRegion(region)
+
+    def __wakeRegion(self, region):
+        for member in region.containers:
+            self.sleeping.discard(id(member))
+        region.quietSteps = 0
+        if region.asleep:
+            region.asleep = False
+            self.awakeRegions.append(region)
+
+    @staticmethod
+    def __canConduct(element):
+        if isinstance(element, Junction):
+            return max(element.radii) > 0
+        ramp = getattr(element, 'ramp', None)
+        return element.radius > 0 or (ramp is not None and not ramp.isSettled(0))
+
+    def __buildRegions(self, containers, elements):
+        index = dict((id(container), i) for i, container in enumerate(containers))
+        dynamic = [not isinstance(container.fluid, StaticFluid) for container in containers]
+        conducting = [self.__canConduct(element) for element in elements]
+        # An element joins its first container with each of the others (a junction has more than two)
+        fromIndex, toIndex, edgeMask = [], [], []
+        for element, canConduct in zip(elements, conducting):
+            first = index[id(element.getContainers()[0])]
+            for container in element.getContainers()[1:]:
+                fromIndex.append(first)
+                toIndex.append(index[id(container)])
+                edgeMask.append(canConduct)
+        labels = labelComponents(len(containers), fromIndex, toIndex, edgeMask, dynamic)
+
+        regions = {}
+        for i, container in enumerate(containers):
+            if dynamic[i]:
+                regions.setdefault(labels[i], SleepRegion()).containers.append(container)
+        self.boundaryElements = []
+        for k, element in enumerate(elements):
+            # A closed valve is woken by its commands. A pipe between static containers moves nothing,
+            # but the ramp of a valve or pump between them has to reach its setpoint.
+            if not conducting[k]:
+                continue
+            for container in element.getContainers():
+                if dynamic[index[id(container)]]:
+                    regions[labels[index[id(container)]]].elements.append(element)
+                    break
+            else:
+                ramp = getattr(element, 'ramp', None)
+                if ramp is not None and not ramp.isSettled(0):
+                    self.boundaryElements.append(element)
+
+        self.regions = regions.values()
+        self.regionOfContainer = {}
+        for region in self.regions:
+            for container in region.containers:
+                self.regionOfContainer[id(container)] = region
+            region.asleep = all(id(container) in self.sleeping for container in region.containers)
+        self.awakeRegions = [region for region in self.regions if not region.asleep]
+
+    def prepare(self, containers, activeElements):
+        SequentialStepEngine.prepare(self, containers, activeElements)
+        if self.regions is None:
+            self.__buildRegions([container for container in containers if container is not None], self.activeElements)
+
+    def __fallAsleep(self, region):
+        for element in region.elements:
+            ramp = getattr(element, 'ramp', None)
+            if ramp is not None:
+                ramp.settle()
+                element.advanceActuator(0.0)
+        region.asleep = True
+        self.sleeping.update(id(container) for container in region.containers)
+
+    def step(self, dT):
+        threshold = self.threshold * dT
+        fellAsleep = False
+        for region in self.awakeRegions:
+            moved = 0.0
+            for element in region.elements:
+                moved = max(moved, abs(element.flow(dT)))
+            if moved > threshold:
+                region.quietSteps = 0
+                continue
+            region.quietSteps += 1
+            if region.quietSteps >= self.sleepSteps and \
+               all(element.ramp.isSettled(self.threshold) for element in region.elements if hasattr(element, 'ramp')):
+                self.__fallAsleep(region)
+                fellAsleep = True
+        if fellAsleep:
+            self.awakeRegions = [region for region in self.awakeRegions if not region.asleep]
+        if self.boundaryElements:
+            self.__moveBoundaryRamps(dT)
+
+    def __moveBoundaryRamps(self, dT):
+        moving = []
+        for element in self.boundaryElements:
+            element.advanceActuator(dT)
+            if element.ramp.isSettled(self.threshold):
+                element.ramp.settle()
+                element.advanceActuator(0.0)
+            else:
+                moving.append(element)
+        self.boundaryElements = moving
+
+    def getActiveSize(self):
+        """ Returns the number of the awake and all regions """
+        return len(self.awakeRegions), len(self.regions or [])
+
+class JitStepEngine(SequentialStepEngine):
+    """
+    The sequential engine with the steps between two logs in one call of the kernel of fluidsim_jit.
+    The kernel is compiled if numba is installed. Without numba, or with objects the kernel doesn't
+    know (other pipe or ramp classes), the engine steps the objects like the sequential engine.
+    useKernel forces the kernel on or off, the interpreted kernel is only good for checking it.
+    step() always steps the objects, only run() uses the kernel.
+    """
+    def __init__(self, useKernel=None):
+        SequentialStepEngine.__init__(self)
+        self.useKernel = JIT_AVAILABLE if useKernel is None else bool(useKernel)
+        self.model = None
+
+    def invalidate(self):
+        self.model = None
+
+    def __advance(self, dT, count):
+        self.model.run(dT, count)
+        self.model.scatter()
+
+    def run(self, simulator, deltaT, repeat):
+        if not self.useKernel or simulator.quiescent:
+            SequentialStepEngine.run(self, simulator, deltaT, repeat)
+            return
+        self.prepare(simulator.containers, simulator.activeElements)
+        if self.model is None:
+            try:
+                self.model = FlatModel(self.containers, self.activeElements)
+            except UnsupportedModel:
+                self.model = False
+        if self.model is False:
+            SequentialStepEngine.run(self, simulator, deltaT, repeat)
+            return
+        self.model.gather()
+        self._runInChunks(simulator, float(deltaT), repeat, self.__advance)
+
+class JacobiStepEngine(StepEngine):
+    """
+    Simultaneous-update engine on the objects.
+    First every pipe computes its flux from the same snapshot of the containers (Pipe.computeFlux),
+    then the sums are applied with Fluid.exchange. The result doesn't depend on the order of the pipes,
+    so the flux phase can be split between worker threads.
+    The pipes with a delay flow one after the other after the simultaneous update.
+    The ramps of many valves and pumps are advanced together, like in the sequential engine.
+    """
+    def __init__(self, workers=1):
+        StepEngine.__init__(self)
+        self.workers = int(workers)
+        self.pool = ThreadPool(self.workers) if self.workers > 1 else None
+        self.chunks = []
+        self.delayedElements = []
+
+    def close(self):
+        self._closePool(self.pool)
+        self.pool = None
+
+    def prepare(self, containers, activeElements):
+        StepEngine.prepare(self, containers, activeElements)
+        self.activeElements = [element for element in activeElements if element is not None]
+        self.delayedElements = [element for element in self.activeElements if isinstance(element, Pipe) and element.delayLine is not None]
+        self.__batchActuators()
+        simultaneous = [element for element in self.activeElements if not (isinstance(element, Pipe) and element.delayLine is not None)]
+        chunkSize = max(1, -(-len(simultaneous) // self.workers))
+        self.chunks = [simultaneous[i:i+chunkSize] for i in range(0, len(simultaneous), chunkSize)]
+
+    @staticmethod
+    def _computeFluxes(args):
+        elements, dT = args
+        fluxes = []
+        for element in elements:
+            fluxes.extend(element.computeFluxes(dT))
+        return fluxes
+
+    def __computeFluxes(self, dT):
+        if self.pool is None or len(self.chunks) < 2:
+            return JacobiStepEngine._computeFluxes((sum(self.chunks, []), dT))
+        fluxes = []
+        for chunk in self.pool.map(JacobiStepEngine._computeFluxes, [(chunk, dT) for chunk in self.chunks]):
+            fluxes.extend(chunk)
+        return fluxes
+
+    def __batchActuators(self):
+        self.actuators = ActuatorBank.create(self.activeElements)
+        if self.actuators is None:
+            self.ownActuators = self.activeElements
+            return
+        self.actuators.gather()
+        batched = set(id(element) for element in self.actuators.elements)
+        self.ownActuators = [element for element in self.activeElements if id(element) not in batched]
+
+    def restoreState(self, snapshot):
+        StepEngine.restoreState(self, snapshot)
+        if self.actuators is not None:
+            self.actuators.gather()
+
+    def step(self, dT):
+        if self.actuators is not None:
+            self.actuators.advance(dT)
+        for element in self.ownActuators:
+            element.advanceActuator(dT)
+        fluxes = self.__computeFluxes(dT)
+
+        # If a container can't give enough fluid for all of its outgoing pipes, all of them get less
+        outVolumes = {}
+        for source, dest, q in fluxes:
+            outVolumes[id(source)] = outVolumes.get(id(source), 0) + q
+        scales = {}
+        for source, dest, q in fluxes:
+            out = outVolumes[id(source)]
+            if not isinstance(source, StaticFluid) and out > source.volume():
+                scales[id(source)] = source.volume() / out
+
+        exchanges = {}  # id(fluid) -> [fluid, outVolume, inVolume, inHeat]
+        for source, dest, q in fluxes:
+            q *= scales.get(id(source), 1)
+            exchanges.setdefault(id(source), [source, 0, 0, 0])[1] += q
+            destExchange = exchanges.setdefault(id(dest), [dest, 0, 0, 0])
+            destExchange[2] += q
+            destExchange[3] += q * source.temperature()
+        for fluid, outVolume, inVolume, inHeat in exchanges.values():
+            fluid.exchange(outVolume, inVolume, inHeat)
+        # The actuators are already advanced
+        for element in self.delayedElements:
+            Pipe.flow(element, dT)
+
+class EngineComponent(object):
+    __slots__ = ('containers', 'elements', 'engine', 'stepTime')
+
+    def __init__(self, containers, elements, engine):
+        self.containers = containers
+        self.elements = elements
+        self.engine = engine
+        self.stepTime = 0.0
+
+class ComponentStepEngine(StepEngine):
+    """
+    Steps the connected components of the model (simulator.componentTracker) on a thread pool,
+    every component with its own inner engine. The components don't exchange fluid, so the
+    result is the same as the inner engine would give for the whole model (with the sequential
+    inner engine it's identical to the serial stepping). The components are joined only where
+    a log is due. getStatistics() tells the time spent in every component during the last run.
+    """
+    def __init__(self, workers=4, inner="sequential", innerOptions=None):
+        StepEngine.__init__(self)
+        self.workers = int(workers)
+        self.innerName = inner
+        self.innerOptions = innerOptions
+        self.pool = ThreadPool(self.workers) if self.workers > 1 else None
+        self.components = []
+        self.version = None
+        self.lastWallTime = 0.0
+
+    def invalidate(self):
+        self.version = None
+
+    def touch(self, obj):
+        for component in self.components:
+            component.engine.touch(obj)
+
+    def __closeComponents(self):
+        for component in self.components:
+            component.engine.close()
+        self.components = []
+
+    def close(self):
+        self.__closeComponents()
+        self._closePool(self.pool)
+        self.pool = None
+
+    def __prepareComponents(self, simulator):
+        StepEngine.prepare(self, simulator.containers, simulator.activeElements)
+        tracker = simulator.componentTracker
+        if self.version is None or self.version != tracker.version or tracker.dirty:
+            parts = tracker.getComponents(simulator.containers, simulator.activeElements)
+            self.__closeComponents()
+            self.components = [EngineComponent(containers, elements, createStepEngine(self.innerName, self.innerOptions))
+                               for containers, elements in parts]
+            self.version = tracker.version
+        for component in self.components:
+            component.engine.prepare(component.containers, component.elements)
+            component.stepTime = 0.0
+
+    def prepareRun(self, simulator):
+        self.__prepareComponents(simulator)
+
+    def step(self, dT):
+        self.__advance(dT, 1)
+
+    def restoreState(self, snapshot):
+        StepEngine.restoreState(self, snapshot)
+        # The inner engines may keep their own copy of the state
+        for component in self.components:
+            component.engine.prepare(component.containers, component.elements)
+
+    @staticmethod
+    def _advanceComponent(args):
+        component, dT, count = args
+        start = time.time()
+        engine = component.engine
+        for i in range(0, count):
+            engine.step(dT)
+        engine.syncObjects()
+        component.stepTime += time.time() - start
+
+    def __advance(self, dT, count):
+        args = [(component, dT, count) for component in self.components]
+        if self.pool is None or len(args) < 2:
+            for arg in args:
+                ComponentStepEngine._advanceComponent(arg)
+        else:
+            self.pool.map(ComponentStepEngine._advanceComponent, args)
+
+    def run(self, simulator, deltaT, repeat):
+        deltaT = float(deltaT)
+        if simulator.quiescent:
+            self.fastForward(simulator, deltaT, repeat)
+            return
+        wallStart = time.time()
+        self.__prepareComponents(simulator)
+        self._runInChunks(simulator, deltaT, repeat, self.__advance)
+        self.lastWallTime = time.time() - wallStart
+
+    def getStatistics(self):
+        """ Returns the wall time of the last run and the (containers, elements, step time) of every component """
+        return self.lastWallTime, [(c.containers, c.elements, c.stepTime) for c in self.components]
+
+class VectorizedStepEngine(StepEngine):
+    """
+    Compiles the object graph into a CompiledNetwork and steps the arrays.
+    Every flow of a step is computed from the same snapshot, so the result differs
+    slightly from the sequential engine, but it doesn't depend on the order of the pipes.
+    The objects are written back only when the logger or the caller needs them.
+    """
+    def __init__(self):
+        StepEngine.__init__(self)
+        self.network = None
+        self.state = None
+
+    def invalidate(self):
+        self.network = None
+        self.state = None
+
+    def checkModel(self, containers, activeElements):
+        # Compiling raises the TypeError of the junctions and the delayed pipes, the network is kept for the run
+        if self.network is None:
+            self.network = CompiledNetwork(containers, activeElements)
+
+    def prepare(self, containers, activeElements):
+        StepEngine.prepare(self, containers, activeElements)
+        self.checkModel(containers, activeElements)
+        # The commands between two runs modify the objects, so the state is always reread
+        self.state = self.network.gatherState()
+
+    def step(self, dT):
+        self.network.step(self.state, dT)
+
+    def syncObjects(self):
+        self.network.scatterState(self.state)
+
+    def isQuiescent(self, tolerance):
+        return self.network.isQuiescent(self.state, tolerance)
+
+    def saveState(self):
+        return self.state.copy()
+
+    def restoreState(self, snapshot):
+        self.state = snapshot.copy()
+
+    def getQuantity(self, obj, quantity):
+        network = self.network
+        if quantity == 'stream':
+            return float(network.getStreams(self.state)[network.activeElementIndex[id(obj)]])
+        index = network.containerIndex[id(obj)]
+        volume = float(self.state.volumes[index])
+        if quantity == 'volume':
+            return volume
+        if quantity == 'waterlevel':
+            return obj.pressureCalculator.getWaterLevelFor(volume)
+        return float(self.state.temperatures[index])
+
+class MultiRateStepEngine(VectorizedStepEngine):
+    """
+    The vectorized engine with slower rates for the subsystems, the periods are counted in base steps.
+    The ramps are advanced every rampPeriod steps with the whole period and held until the next
+    update, or with interpolateRamps they move linearly to the end of the period.
+    The temperatures are mixed every thermalPeriod steps from the volumes moved since the last mixing,
+    the temperatures of the sources are held meanwhile, so the heat is still conserved.
+    The logs are checked every logPeriod steps. With all periods 1 it's the vectorized engine.
+    The periods start again with every run.
+    """
+    def __init__(self, rampPeriod=1, thermalPeriod=1, logPeriod=1, interpolateRamps=False):
+        VectorizedStepEngine.__init__(self)
+        self.rampPeriod = MultiRateStepEngine.__getPeriod(rampPeriod)
+        self.thermalPeriod = MultiRateStepEngine.__getPeriod(thermalPeriod)
+        self.logPeriod = MultiRateStepEngine.__getPeriod(logPeriod)
+        self.interpolateRamps = bool(interpolateRamps)
+        self.phase = 0
+        self.rampStart = None  # The ramp values at the beginning of the interpolated period
+        self.rampEnd = None    # The ramps at the end of the interpolated period
+        self.mixVolumes = None  # The volumes at the last mixing
+        self.forwardSums = None  # The volumes moved by the pipes since the last mixing
+        self.backwardSums = None
+
+    @staticmethod
+    def __getPeriod(value):
+        period = int(value)
+        if period < 1 or period != value:
+            raise ValueError("The periods have to be positive integers, not "+str(value))
+        return period
+
+    def prepare(self, containers, activeElements):
+        VectorizedStepEngine.prepare(self, containers, activeElements)
+        self.phase = 0
+        self.__startMixing()
+
+    def __startMixing(self):
+        self.mixVolumes = self.state.volumes.copy()
+        self.forwardSums = numpy.zeros(self.network.pipeCount)
+        self.backwardSums = numpy.zeros(self.network.pipeCount)
+
+    def __mixTemperatures(self):
+        """ Fluid.add for all the volumes moved since the last mixing """
+        network = self.network
+        state = self.state
+        count = network.containerCount
+        forward, backward = self.forwardSums, self.backwardSums
+        temperatures = state.temperatures
+        inHeats = scatterAdd(network.toIndex, forward * temperatures[network.fromIndex], count) + \
+                  scatterAdd(network.fromIndex, backward * temperatures[network.toIndex], count)
+        outVolumes = scatterAdd(network.fromIndex, forward, count) + scatterAdd(network.toIndex, backward, count)
+        heats = numpy.maximum(self.mixVolumes - outVolumes, 0) * temperatures + inHeats
+        mixable = network.isDynamic & (state.volumes > 0)
+        temperatures[mixable] = heats[mixable] / state.volumes[mixable]
+        self.__startMixing()
+
+    def __advanceRamps(self, dT):
+        network = self.network
+        state = self.state
+        period = self.rampPeriod
+        position = self.phase % period
+        if not self.interpolateRamps:
+            if position == 0:
+                network.advanceActuators(state, period * dT)
+            return
+        if position == 0:
+            self.rampStart = state.ramps.values.copy()
+            self.rampEnd = state.ramps.copy()
+            self.rampEnd.advance(period * dT)
+        if position == period - 1:
+            state.ramps.values[:] = self.rampEnd.values
+            state.ramps.derivatives[:] = self.rampEnd.derivatives
+        else:
+            state.ramps.values[:] = self.rampStart + (self.rampEnd.values - self.rampStart) * (position + 1.0) / period
+        network.updateActuators(state)
+
+    def step(self, dT):
+        network = self.network
+        state = self.state
+        self.__advanceRamps(dT)
+        flows = network.computeFlows(state, dT)
+        if self.thermalPeriod == 1:
+            network.applyFlows(state, flows)
+        else:
+            count = network.containerCount
+            self.forwardSums += numpy.maximum(flows, 0)
+            self.backwardSums += numpy.maximum(-flows, 0)
+            volumes = state.volumes + scatterAdd(network.toIndex, flows, count) - scatterAdd(network.fromIndex, flows, count)
+            state.volumes[network.isDynamic] = numpy.maximum(volumes, 0)[network.isDynamic]
+            if (self.phase + 1) % self.thermalPeriod == 0:
+                self.__mixTemperatures()
+        self.phase += 1
+
+    def syncObjects(self):
+        if self.forwardSums.any() or self.backwardSums.any():
+            self.__mixTemperatures()
+        VectorizedStepEngine.syncObjects(self)
+
+    def saveState(self):
+        rampEnd = None if self.rampEnd is None else self.rampEnd.copy()
+        return (self.state.copy(), self.phase, self.rampStart, rampEnd,
+                self.mixVolumes.copy(), self.forwardSums.copy(), self.backwardSums.copy())
+
+    def restoreState(self, snapshot):
+        state, self.phase, self.rampStart, rampEnd, mixVolumes, forwardSums, backwardSums = snapshot
+        self.state = state.copy()
+        self.rampEnd = None if rampEnd is None else rampEnd.copy()
+        self.mixVolumes, self.forwardSums, self.backwardSums = mixVolumes.copy(), forwardSums.copy(), backwardSums.copy()
+
+class ImplicitStepEngine(VectorizedStepEngine):
+    """
+    Backward Euler engine for stiff networks (small containers joined by wide pipes).
+    It stays stable with steps much larger than the time constants of the containers.
+    """
+    def step(self, dT):
+        network = self.network
+        network.advanceActuators(self.state, dT)
+        network.applyFlows(self.state, network.computeImplicitFlows(self.state, dT))
+
+class AdaptiveStepEngine(VectorizedStepEngine):
+    """
+    Takes steps with an embedded Euler-Heun pair on the compiled network.
+    The difference of the two solutions estimates the local error of the water levels.
+    The step grows while the system is quiet and shrinks after a valve or pump change.
+    run(deltaT, repeat) advances deltaT*repeat simulated time, advance() also tells the number of steps.
+    """
+    SAFETY = 0.9
+    MIN_FACTOR = 0.2
+    MAX_FACTOR = 5.0
+
+    def __init__(self, tolerance=1e-4, minStep=1e-6, maxStep=10.0):
+        VectorizedStepEngine.__init__(self)
+        self.tolerance = float(tolerance)
+        self.minStep = float(minStep)
+        self.maxStep = float(maxStep)
+        self.nextStep = None
+        self.lastStepCount = 0
+
+    def invalidate(self):
+        VectorizedStepEngine.invalidate(self)
+        self.nextStep = None
+
+    def __tryStep(self, h):
+        """ Returns the Heun solution at t+h (actuators included) and the estimated error """
+        network = self.network
+        start = self.state
+        flows1 = network.computeFlows(start, h)
+        euler = start.copy()
+        network.applyFlows(euler, flows1)
+        network.advanceActuators(euler, h)
+        flows2 = network.computeFlows(euler, h)
+        heun = start.copy()
+        heun.radii = euler.radii
+        heun.pumpPressures = euler.pumpPressures
+        heun.ramps = euler.ramps
+        network.applyFlows(heun, network.clampFlows(start, 0.5 * (flows1 + flows2)))
+        # The error comes from the unclamped streams: the clamping hides the flow out of
+        # a container that is empty at the start of the step and filled during it
+        streamChanges = 0.5 * h * (network.getStreams(euler) - network.getStreams(start))
+        count = network.containerCount
+        volumeErrors = scatterAdd(network.toIndex, streamChanges, count) - scatterAdd(network.fromIndex, streamChanges, count)
+        levelErrors = volumeErrors / network.getAreas(start)
+        error = abs(levelErrors[network.isDynamic]).max() if network.isDynamic.any() else 0.0
+        return heun, error
+
+    def __initialStep(self):
+        """ Half of the fastest level time constant, the explicit steps are stable below it """
+        timeConstants = self.network.getTimeConstants(self.state)[self.network.isDynamic]
+        if not len(timeConstants):
+            return self.maxStep
+        return min(self.maxStep, max(self.minStep, 0.5 * timeConstants.min()))
+
+    def __factor(self, error, tolerance):
+        if error == 0:
+            return self.MAX_FACTOR
+        return min(self.MAX_FACTOR, max(self.MIN_FACTOR, self.SAFETY * (tolerance / error) ** 0.5))
+
+    def advance(self, simulator, duration, tolerance=None):
+        """ Advances the simulator with duration, returns the number of accepted steps """
+        tolerance = self.tolerance if tolerance is None else float(tolerance)
+        logManager = simulator.logManager
+        remaining = float(duration)
+        if simulator.quiescent:
+            self.__fastForward(simulator, remaining)
+            self.lastStepCount = 0
+            return 0
+        self.prepare(simulator.containers, simulator.activeElements)
+        h = min(self.nextStep or self.maxStep, self.__initialStep())
+        steps = 0
+        while remaining > self.minStep * 1e-3:
+            h = max(min(h, remaining), min(self.minStep, remaining))
+            candidate, error = self.__tryStep(h)
+            if error > tolerance and h > self.minStep:
+                h = max(h * self.__factor(error, tolerance), self.minStep)
+                continue
+            self.state = candidate
+            remaining -= h
+            steps += 1
+            simulator.simulationTime += h
+            if logManager.isLogDue(simulator.simulationTime):
+                self.syncObjects()
+                logManager.createLog(simulator.simulationTime)
+            h = min(h * self.__factor(error, tolerance), self.maxStep)
+            self.nextStep = h
+            if self._checkQuiescence(simulator, steps):
+                self.__fastForward(simulator, remaining)
+                break
+        else:
+            self.syncObjects()
+        self.lastStepCount = steps
+        return steps
+
+    def __fastForward(self, simulator, duration):
+        # A quiescent system would be stepped with maxStep
+        if duration > 0:
+            repeat = int(math.ceil(duration / self.maxStep))
+            self.fastForward(simulator, duration / repeat, repeat)
+
+    def run(self, simulator, deltaT, repeat):
+        self.advance(simulator, float(deltaT) * repeat)
+
+STEP_ENGINES = {
+    "sequential": SequentialStepEngine,
+    "sleeping": SleepingStepEngine,
+    "jit": JitStepEngine,
+    "components": ComponentStepEngine,
+    "jacobi": JacobiStepEngine,
+    "vectorized": VectorizedStepEngine,
+    "multirate": MultiRateStepEngine,
+    "adaptive": AdaptiveStepEngine,
+    "implicit": ImplicitStepEngine,
+}
+
+def createStepEngine(name, options=None):
+    name = str(name).lower()
+    if name not in STEP_ENGINES:
+        raise UnknownStepEngine("Unknown step engine '"+name+"'. Possible engines are: "+str(sorted(STEP_ENGINES.keys())))
+    options = dict((str(key), value) for key, value in (options or {}).items())
+    return STEP_ENGINES[name](**options)
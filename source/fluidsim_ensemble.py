@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Ensemble simulation: N variants of one model stepped together.
+# The topology of the CompiledNetwork is shared, every mutable array of the
+# NetworkState gets a leading member dimension, so one step of the ensemble is
+# the same handful of vectorized operations as one step of a single model.
+
+import copy
+
+from fluidsim_core import Valve
+from fluidsim_network import numpy, requireNumpy, NetworkState, RampBank
+
+class InvalidParameter(Exception):
+    pass
+
+CONTAINER_PARAMETERS = ('area', 'level', 'volume', 'temperature')
+ELEMENT_PARAMETERS = ('radius', 'setpoint')
+CONTAINER_RESULTS = ('waterlevel', 'volume', 'temperature')
+ELEMENT_RESULTS = ('stream', 'setpoint')
+
+class Ensemble(object):
+    """
+    size members, all started from the state of the model when the ensemble was created.
+    The parameters are set and the results are read per object ID, as arrays with one value per member.
+    The members share everything but their parameters and state, so the memory grows linearly with size.
+    """
+    def __init__(self, network, size, containerIDs, elementIDs):
+        requireNumpy()
+        self.size = int(size)
+        # The areas are the only per-container parameter, they get the member dimension
+        self.network = copy.copy(network)
+        self.network.areas = numpy.tile(network.areas, (self.size, 1))
+        self.containerIndices = dict((ID, network.containerIndex[id(c)]) for ID, c in containerIDs.items())
+        self.elementIndices = dict((ID, network.activeElementIndex[id(e)]) for ID, e in elementIDs.items())
+        self.rampIndices = dict((id(element), index) for index, element in
+                                enumerate([element for index, element in network.valves + network.pumps]))
+        self.elements = elementIDs
+
+        single = network.gatherState()
+        ramps = single.ramps
+        def tile(array):
+            return numpy.tile(array, (self.size, 1))
+        self.state = NetworkState(tile(single.volumes), tile(single.temperatures), tile(single.radii), tile(single.pumpPressures),
+                                  RampBank(tile(ramps.values), tile(ramps.derivatives), tile(ramps.setpoints),
+                                           ramps.isLinear, ramps.deltas, ramps.alphas, ramps.betas))
+        self.time = 0.0
+
+    def __members(self, values):
+        values = numpy.asarray(values, dtype=float)
+        if values.ndim == 0:
+            return numpy.repeat(values, self.size)
+        if values.shape != (self.size,):
+            raise InvalidParameter("One value or "+str(self.size)+" values are needed")
+        return values
+
+    def setParameter(self, objectID, name, values):
+        """
+        Sets a parameter of an object for every member: one value for all, or one value per member.
+        Containers: area (not for tabulated containers), level (with the actual areas), volume, temperature.
+        Active elements: radius (pipes and pumps), setpoint (the percent of valves and pumps).
+        """
+        values = self.__members(values)
+        state = self.state
+        if objectID in self.containerIndices:
+            index = self.containerIndices[objectID]
+            tabulated = index in self.network.tabulatedIndices
+            if name == 'area' and not tabulated:
+                self.network.areas[:, index] = values
+            elif name == 'level' and not tabulated:
+                state.volumes[:, index] = values * self.network.areas[:, index]
+            elif name == 'level':
+                calculator = self.network.containers[index].pressureCalculator
+                state.volumes[:, index] = [calculator.getVolumeFor(level) for level in values]
+            elif name == 'volume':
+                state.volumes[:, index] = values
+            elif name == 'temperature':
+                state.temperatures[:, index] = values
+            else:
+                raise InvalidParameter("Unknown container parameter '"+str(name)+"'. Possible parameters are: "+str(CONTAINER_PARAMETERS))
+        elif objectID in self.elementIndices:
+            element = self.elements[objectID]
+            if name == 'radius' and not isinstance(element, Valve):
+                state.radii[:, self.elementIndices[objectID]] = values
+            elif name == 'setpoint' and id(element) in self.rampIndices:
+                rampIndex = self.rampIndices[id(element)]
+                state.ramps.setpoints[:, rampIndex] = numpy.clip(values, self.network.minSetpoints[rampIndex], 100)
+            else:
+                raise InvalidParameter("The parameter '"+str(name)+"' can't be set for this element. Possible parameters are: "+str(ELEMENT_PARAMETERS))
+        else:
+            raise InvalidParameter("No object with ID "+str(objectID))
+
+    def getSetpointRange(self, objectID):
+        """ The lowest and highest setpoint of a valve or pump """
+        element = self.elements.get(objectID)
+        if element is None or id(element) not in self.rampIndices:
+            raise InvalidParameter("No valve or pump with ID "+str(objectID))
+        return self.network.minSetpoints[self.rampIndices[id(element)]], 100.0
+
+    def getResult(self, objectID, quantity):
+        """ Returns the actual value of a quantity of an object for every member """
+        network = self.network
+        state = self.state
+        if objectID in self.containerIndices:
+            index = self.containerIndices[objectID]
+            if quantity == 'waterlevel':
+                return network.getLevels(state)[:, index]
+            elif quantity == 'volume':
+                return state.volumes[:, index].copy()
+            elif quantity == 'temperature':
+                return state.temperatures[:, index].copy()
+            raise InvalidParameter("Unknown container quantity '"+str(quantity)+"'. Possible quantities are: "+str(CONTAINER_RESULTS))
+        elif objectID in self.elementIndices:
+            element = self.elements[objectID]
+            if quantity == 'stream':
+                return network.getStreams(state)[:, self.elementIndices[objectID]]
+            elif quantity == 'setpoint' and id(element) in self.rampIndices:
+                return state.ramps.setpoints[:, self.rampIndices[id(element)]].copy()
+            raise InvalidParameter("Unknown element quantity '"+str(quantity)+"'. Possible quantities are: "+str(ELEMENT_RESULTS))
+        raise InvalidParameter("No object with ID "+str(objectID))
+
+    def run(self, deltaT, repeat=1):
+        deltaT = float(deltaT)
+        for i in range(0, repeat):
+            self.network.step(self.state, deltaT)
+            self.time += deltaT
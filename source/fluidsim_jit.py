@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Compiled stepping kernel for the sequential semantics of fluidsim_core.
+# The objects are packed into flat arrays (FlatModel), and many steps run inside
+# one call of runSequentialSteps. If numba is importable the kernel is compiled
+# with a cache on disk (next to this file, or in NUMBA_CACHE_DIR), so only the
+# first start compiles it. Without numba the kernel is plain Python, and the
+# engines use the objects instead, which remain the reference.
+
+import math
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from fluidsim_core import StaticFluid, Pipe, Valve, Pump, StandardPressureCalculator, LinearRamp, SecondOrderDiffRamp, getSecondOrderTransition
+from fluidsim_network import numpy, requireNumpy
+
+JIT_AVAILABLE = numba is not None
+
+def jit(func):
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+PIPE, VALVE, PUMP = 0, 1, 2
+
+class UnsupportedModel(Exception):
+    pass
+
+@jit
+def runSequentialSteps(count, dT, volumes, temperatures, isStatic, pressurePerVolume, etas,
+                       fromIndex, toIndex, fromJointPressures, toJointPressures, lengths, radii,
+                       kinds, minRadii, maxRadii, maxPressures,
+                       rampIsLinear, rampDeltas, rampA, rampB, rampC, rampD,
+                       rampValues, rampDerivatives, rampSetpoints):
+    """ count steps of the sequential engine: the pipes flow one after the other, in their order """
+    for step in range(count):
+        for k in range(len(fromIndex)):
+            kind = kinds[k]
+            if kind != PIPE:
+                # Ramp.recalc
+                setpoint = rampSetpoints[k]
+                if rampIsLinear[k]:
+                    difference = rampDeltas[k] * dT
+                    if rampValues[k] < setpoint:
+                        rampValues[k] = min(rampValues[k] + difference, setpoint)
+                    else:
+                        rampValues[k] = max(rampValues[k] - difference, setpoint)
+                else:
+                    deviation = rampValues[k] - setpoint
+                    derivative = rampDerivatives[k]
+                    rampValues[k] = setpoint + rampA[k]*deviation + rampB[k]*derivative
+                    rampDerivatives[k] = rampC[k]*deviation + rampD[k]*derivative
+                if kind == VALVE:
+                    radii[k] = (maxRadii[k] - minRadii[k])/100.0*rampValues[k] + minRadii[k]
+
+            # Pipe._getSourceAndDestiny
+            a = fromIndex[k]
+            b = toIndex[k]
+            p0 = volumes[a] * pressurePerVolume[a] - fromJointPressures[k]
+            if kind == PUMP:
+                p0 += maxPressures[k] * rampValues[k] / 100.0
+            p1 = volumes[b] * pressurePerVolume[b] - toJointPressures[k]
+            if p1 < p0:
+                source = a
+                dest = b
+            else:
+                source = b
+                dest = a
+                p0, p1 = p1, p0
+
+            # Pipe._getFluidQuantity and Fluid.transferTo
+            conductance = math.pi * radii[k]**4 / (8.0 * lengths[k])
+            q = conductance * (p0 - p1) / etas[source] * dT
+            if not isStatic[source]:
+                if volumes[source] < q:
+                    q = volumes[source]
+                    volumes[source] = 0.0
+                else:
+                    volumes[source] -= q
+            if not isStatic[dest]:
+                newVolume = volumes[dest] + q
+                if newVolume > 0:
+                    temperatures[dest] = (volumes[dest]*temperatures[dest] + q*temperatures[source]) / newVolume
+                else:
+                    temperatures[dest] = 0.0
+                volumes[dest] = newVolume
+
+class FlatModel(object):
+    """
+    The containers and active elements of a simulator in the flat arrays of runSequentialSteps.
+    The topology is packed once, gather() and scatter() copy the state between the arrays and the objects.
+    """
+    def __init__(self, containers, activeElements):
+        requireNumpy()
+        self.containers = [c for c in containers if c is not None]
+        self.elements = [e for e in activeElements if e is not None]
+        for element in self.elements:
+            if type(element) not in (Pipe, Valve, Pump):
+                raise UnsupportedModel("The kernel can't step "+type(element).__name__)
+            if element.delayLine is not None:
+                raise UnsupportedModel("The kernel can't step delayed pipes")
+            ramp = getattr(element, 'ramp', None)
+            if ramp is not None and type(ramp) not in (LinearRamp, SecondOrderDiffRamp):
+                raise UnsupportedModel("The kernel can't step "+type(ramp).__name__)
+        for container in self.containers:
+            if type(container.pressureCalculator) is not StandardPressureCalculator:
+                raise UnsupportedModel("The kernel can step only prismatic containers")
+        index = dict((id(c), i) for i, c in enumerate(self.containers))
+        elements = self.elements
+
+        self.isStatic = numpy.array([isinstance(c.fluid, StaticFluid) for c in self.containers], dtype=numpy.bool_)
+        self.etas = numpy.array([c.fluid.eta() for c in self.containers], dtype=float)
+        self.fromIndex = numpy.array([index[id(e.getContainer1())] for e in elements], dtype=numpy.int64)
+        self.toIndex = numpy.array([index[id(e.getContainer2())] for e in elements], dtype=numpy.int64)
+        self.fromJointPressures = numpy.array([e.jointPressures[0] for e in elements], dtype=float)
+        self.toJointPressures = numpy.array([e.jointPressures[1] for e in elements], dtype=float)
+        self.lengths = numpy.array([e.length for e in elements], dtype=float)
+        self.kinds = numpy.array([VALVE if isinstance(e, Valve) else PUMP if isinstance(e, Pump) else PIPE for e in elements], dtype=numpy.int64)
+        self.minRadii = numpy.array([getattr(e, 'minRadius', 0.0) for e in elements], dtype=float)
+        self.maxRadii = numpy.array([getattr(e, 'maxRadius', 0.0) for e in elements], dtype=float)
+        self.maxPressures = numpy.array([getattr(e, 'maxPressure', 0.0) for e in elements], dtype=float)
+        self.transitionDT = None
+
+        count = len(elements)
+        self.volumes = numpy.zeros(len(self.containers))
+        self.temperatures = numpy.zeros(len(self.containers))
+        self.pressurePerVolume = numpy.zeros(len(self.containers))
+        self.radii = numpy.zeros(count)
+        self.rampIsLinear = numpy.zeros(count, dtype=numpy.bool_)
+        self.rampDeltas = numpy.zeros(count)
+        self.rampValues = numpy.zeros(count)
+        self.rampDerivatives = numpy.zeros(count)
+        self.rampSetpoints = numpy.zeros(count)
+        self.rampA, self.rampB, self.rampC, self.rampD = [numpy.zeros(count) for i in range(0, 4)]
+
+    def gather(self):
+        """ Reads the state and the ramp parameters, which can be changed by the commands """
+        for i, container in enumerate(self.containers):
+            self.volumes[i] = container.fluid.volume()
+            self.temperatures[i] = container.fluid.temperature()
+            self.pressurePerVolume[i] = container.pressureCalculator._pressurePerVolume
+        for k, element in enumerate(self.elements):
+            self.radii[k] = element.radius
+            ramp = getattr(element, 'ramp', None)
+            if ramp is None:
+                continue
+            self.rampIsLinear[k] = isinstance(ramp, LinearRamp)
+            self.rampDeltas[k] = getattr(ramp, 'delta', 0.0)
+            self.rampValues[k] = ramp.getActValue()
+            self.rampDerivatives[k] = getattr(ramp, 'actDerivative', 0.0)
+            self.rampSetpoints[k] = ramp.getSetpoint()
+        self.transitionDT = None
+
+    def scatter(self):
+        for i, container in enumerate(self.containers):
+            if not self.isStatic[i]:
+                container.fluid.setVolume(self.volumes[i])
+                container.fluid.setTemperature(self.temperatures[i])
+        for k, element in enumerate(self.elements):
+            ramp = getattr(element, 'ramp', None)
+            if ramp is None:
+                continue
+            if self.rampIsLinear[k]:
+                ramp.setState((float(self.rampValues[k]),))
+            else:
+                ramp.setState((float(self.rampValues[k]), float(self.rampDerivatives[k])))
+            if self.kinds[k] == VALVE:
+                element.radius = float(self.radii[k])
+
+    def __updateTransitions(self, dT):
+        if self.transitionDT == dT:
+            return
+        for k, element in enumerate(self.elements):
+            ramp = getattr(element, 'ramp', None)
+            if isinstance(ramp, SecondOrderDiffRamp):
+                self.rampA[k], self.rampB[k], self.rampC[k], self.rampD[k] = getSecondOrderTransition(ramp.alpha, ramp.beta, dT)
+        self.transitionDT = dT
+
+    def run(self, dT, count):
+        self.__updateTransitions(dT)
+        runSequentialSteps(count, dT, self.volumes, self.temperatures, self.isStatic, self.pressurePerVolume, self.etas,
+                           self.fromIndex, self.toIndex, self.fromJointPressures, self.toJointPressures, self.lengths, self.radii,
+                           self.kinds, self.minRadii, self.maxRadii, self.maxPressures,
+                           self.rampIsLinear, self.rampDeltas, self.rampA, self.rampB, self.rampC, self.rampD,
+                           self.rampValues, self.rampDerivatives, self.rampSetpoints)
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Log managers which keep the disk out of the simulation loop.
+# AsyncLogManager only takes the samples in run(), a writer thread formats and writes them,
+# so a disk stall doesn't stall the steps and the lock of the simulator.
+# ColumnarLogStore writes every monitored signal into one binary file instead of one CSV per object,
+# ColumnarLogReader reads any signals of any time range from it through a memory map.
+
+import threading
+import time
+import Queue
+import json
+import mmap
+import struct
+
+from fluidsim_core import LogManager
+from fluidsim_network import numpy, requireNumpy
+
+OVERFLOW_POLICIES = ('block', 'dropoldest', 'drop')
+
+class LogWriter(threading.Thread):
+    """
+    The thread of an AsyncLogManager. It refers only to the queue, the handlers and the file pool,
+    not to the manager, so a manager which isn't used any more can be collected; then its writer
+    gets a None, writes out everything and stops.
+    """
+    def __init__(self, queue, logHandlers, filePool, flushPeriod):
+        threading.Thread.__init__(self, name="log writer")
+        self.daemon = True
+        self.queue = queue
+        self.logHandlers = logHandlers
+        self.filePool = filePool
+        self.flushPeriod = flushPeriod
+        self.lastFlush = time.time()
+        self.written = 0
+        self.writeTime = 0.0  # The time spent with writing
+
+    def flush(self):
+        for logHandler in self.logHandlers:
+            logHandler.flush()
+        self.filePool.flush()
+        self.lastFlush = time.time()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if isinstance(record, threading._Event):
+                # A flush: everything before it is written
+                self.flush()
+                record.set()
+                continue
+            start = time.time()
+            timestamp, samples = record
+            for logHandler, values in samples:
+                logHandler.write(timestamp, values)
+            self.written += 1
+            if time.time() - self.lastFlush >= self.flushPeriod:
+                self.flush()
+            self.writeTime += time.time() - start
+        self.flush()
+        self.filePool.close()
+
+class AsyncLogManager(LogManager):
+    """
+    createLog puts one record (the timestamp and the values of every handler) into a queue of queueSize records,
+    the writer thread passes them to the handlers. If the queue is full, the overflow policy decides:
+        block: createLog waits for the writer (nothing is lost)
+        dropoldest: the oldest record in the queue is dropped
+        drop: the new record is dropped
+    The dropped records are counted, getMetrics() tells them with the depth of the queue.
+    flush() and close() wait until the records before them are written.
+    """
+    def __init__(self, logHandlerTypeList, queueSize=1024, overflow='block', maxOpenFiles=256, flushPeriod=5.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '"+str(overflow)+"'. Possible policies are: "+str(OVERFLOW_POLICIES))
+        if int(queueSize) < 1:
+            raise ValueError("The queue needs at least one place")
+        # The finalizer of LogManager refers to the queue
+        self.queue = Queue.Queue(int(queueSize))
+        LogManager.__init__(self, logHandlerTypeList, maxOpenFiles, flushPeriod)
+        self.overflow = overflow
+        self.dropped = 0
+        self.maxDepth = 0
+        self.writer = LogWriter(self.queue, self.logHandlers, self.filePool, flushPeriod)
+        self.writer.start()
+
+    def _getFinalizer(self):
+        queue = self.queue
+        def finalize():
+            queue.put(None)
+        return finalize
+
+    def takeOver(self, other):
+        LogManager.takeOver(self, other)
+        # The writer hasn't got anything to write yet
+        self.writer.logHandlers = self.logHandlers
+        self.writer.filePool = self.filePool
+
+    def __put(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(record)
+                    break
+                except Queue.Full:
+                    if self.overflow == 'drop':
+                        self.dropped += 1
+                        break
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except Queue.Empty:
+                        pass
+        self.maxDepth = max(self.maxDepth, self.queue.qsize())
+
+    def createLog(self, timestamp):
+        if self.isLogDue(timestamp):
+            self.prevLogTimestamp = timestamp
+            self.__put((timestamp, [(logHandler, logHandler.sample()) for logHandler in self.logHandlers]))
+
+    def flush(self):
+        if not self.writer.is_alive():
+            return
+        done = threading.Event()
+        # A flush is never dropped
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        if not self.writer.is_alive():
+            return
+        self.queue.put(None)
+        self.writer.join()
+
+    def getMetrics(self):
+        return {'depth':self.queue.qsize(), 'maxdepth':self.maxDepth, 'capacity':self.queue.maxsize, 'overflow':self.overflow,
+                'written':self.writer.written, 'dropped':self.dropped, 'writetime':self.writer.writeTime}
+
+COLUMNAR_LOG_NAME = "signals.col"
+
+CHUNK_MAGIC = 'FSLC'
+CHUNK_VERSION = 1
+CHUNK_HEADER = struct.Struct('<4sIIII')  # magic, version, rows, columns, schema length
+
+class ColumnarLogStore(object):
+    """
+    The logs of every monitored object in one file, the signals are named '<ID>.<key>'.
+    The file is a sequence of chunks of at most chunkRows rows. A chunk is
+        the header (CHUNK_HEADER), the schema (the signal names as a JSON list, padded to 8 bytes),
+        the timestamps, then the values of every signal, column by column, as little-endian doubles.
+    The schema only grows, so a chunk has the signals of the chunks before it, and the signals
+    added later are NaN in it. A row is written when its chunk is full, or by flush().
+    A store is a handler type of LogManager: LogManager([ColumnarLogStore(filename)]).
+    """
+    def __init__(self, filename, chunkRows=4096):
+        requireNumpy()
+        self.filename = filename
+        self.chunkRows = int(chunkRows)
+        self.names = []
+        self.columns = {}  # signal name -> column index
+        self.rows = []  # the rows of the chunk, a row is [timestamp, value of column 0, ...]
+        self.f = open(filename, 'wb')
+
+    def __call__(self, prefix, logID, fluidSimObject, filePool):
+        return ColumnarLogHandler(self, logID, fluidSimObject)
+
+    def addSignals(self, names):
+        """ Returns the column indices of the signals, a monitored object again gets its earlier columns """
+        for name in names:
+            if name not in self.columns:
+                self.columns[name] = len(self.names)
+                self.names.append(name)
+        return [self.columns[name] for name in names]
+
+    def write(self, timestamp, columns, values):
+        if not self.rows or self.rows[-1][0] != timestamp:
+            if len(self.rows) >= self.chunkRows:
+                self.__writeChunk()
+            self.rows.append([timestamp] + [float('nan')]*len(self.names))
+        row = self.rows[-1]
+        if len(row) <= len(self.names):
+            row.extend([float('nan')]*(len(self.names) + 1 - len(row)))
+        for column, value in zip(columns, values):
+            row[column + 1] = value
+
+    def __writeChunk(self):
+        if not self.rows:
+            return
+        table = numpy.empty((len(self.names) + 1, len(self.rows)))
+        table.fill(numpy.nan)
+        for i, row in enumerate(self.rows):
+            table[:len(row), i] = row
+        schema = json.dumps(self.names)
+        schema += ' '*(-(CHUNK_HEADER.size + len(schema)) % 8)
+        self.f.write(CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, len(self.rows), len(self.names), len(schema)))
+        self.f.write(schema)
+        self.f.write(table.astype('<f8').tostring())
+        self.rows = []
+
+    def flush(self):
+        self.__writeChunk()
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class ColumnarLogHandler(object):
+    """ The columns of one object in a ColumnarLogStore """
+    def __init__(self, store, logID, fluidSimObject):
+        self.store = store
+        self.fluidSimObject = fluidSimObject
+        self.keys = fluidSimObject.log().keys()
+        self.columns = store.addSignals([str(logID)+"."+str(key) for key in self.keys])
+
+    def sample(self):
+        actLog = self.fluidSimObject.log()
+        return [actLog[key] for key in self.keys]
+
+    def write(self, timestamp, values):
+        self.store.write(timestamp, self.columns, values)
+
+    def createLog(self, timestamp):
+        self.write(timestamp, self.sample())
+
+    def flush(self):
+        self.store.flush()
+
+class ColumnarLogReader(object):
+    """
+    Reads a file of ColumnarLogStore. Only the chunk headers are parsed,
+    the columns are read from the memory map of the file.
+    An incomplete chunk at the end (of a store which is still writing) is left out.
+    """
+    def __init__(self, filename):
+        requireNumpy()
+        self.chunks = []  # (rows, the column indices of the signals, offset of the timestamps)
+        self.names = []
+        columns = {}
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            size = f.tell()
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else ''
+        offset = 0
+        while offset + CHUNK_HEADER.size <= size:
+            magic, version, rows, columnCount, schemaLength = CHUNK_HEADER.unpack_from(self.data, offset)
+            if magic != CHUNK_MAGIC or version != CHUNK_VERSION:
+                raise ValueError(filename+" isn't a columnar log at offset "+str(offset))
+            dataOffset = offset + CHUNK_HEADER.size + schemaLength
+            end = dataOffset + 8*rows*(columnCount + 1)
+            if end > size:
+                break
+            names = json.loads(self.data[offset + CHUNK_HEADER.size:dataOffset])
+            for name in names:
+                if name not in columns:
+                    columns[name] = len(self.names)
+                    self.names.append(name)
+            self.chunks.append((rows, dict((name, i) for i, name in enumerate(names)), dataOffset))
+            offset = end
+
+    def getSignals(self):
+        return list(self.names)
+
+    def __column(self, rows, dataOffset, column):
+        return numpy.frombuffer(self.data, dtype='<f8', count=rows, offset=dataOffset + 8*rows*column)
+
+    def read(self, signals=None, start=None, end=None):
+        """
+        Returns the timestamps in [start, end] and a dict of the values of the signals (every signal without signals).
+        The values of a signal before it was monitored are NaN.
+        """
+        if signals is None:
+            signals = self.names
+        unknown = [name for name in signals if name not in self.names]
+        if unknown:
+            raise ValueError("Unknown signals: "+str(unknown))
+        timestampParts = []
+        valueParts = dict((name, []) for name in signals)
+        for rows, columns, dataOffset in self.chunks:
+            timestamps = self.__column(rows, dataOffset, 0)
+            first = 0 if start is None else numpy.searchsorted(timestamps, start, 'left')
+            last = rows if end is None else numpy.searchsorted(timestamps, end, 'right')
+            if first >= last:
+                continue
+            timestampParts.append(timestamps[first:last])
+            for name in signals:
+                if name in columns:
+                    valueParts[name].append(self.__column(rows, dataOffset, columns[name] + 1)[first:last])
+                else:
+                    valueParts[name].append(numpy.empty(last - first) + numpy.nan)
+        if not timestampParts:
+            return numpy.zeros(0), dict((name, numpy.zeros(0)) for name in signals)
+        return numpy.concatenate(timestampParts), dict((name, numpy.concatenate(parts)) for name, parts in valueParts.items())
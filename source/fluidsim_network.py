@@ -0,0 +1,473 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Struct-of-arrays view of the fluidsim object graph.
+# The objects in fluidsim_core remain the reference model. This module compiles
+# the same containers and pipes into NumPy arrays, so every flow and every
+# volume/temperature update of a step is a handful of vectorized operations.
+#
+# The incidence matrix of the graph is stored in coordinate form: pipe k goes
+# from container fromIndex[k] to container toIndex[k]. Summing along it is done
+# with numpy.bincount, which is the same as multiplying by the sparse matrix.
+#
+# The arrays of a NetworkState may have a leading batch dimension (one row for
+# every member of an ensemble, see fluidsim_ensemble), so the per-container and
+# per-pipe values are always indexed along the last axis.
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from fluidsim_core import StaticFluid, Pipe, Valve, Pump, TabulatedPressureCalculator, LinearRamp, SecondOrderDiffRamp, getSecondOrderTransition
+from utilities import PhysConsts
+
+class NumpyIsMissing(Exception):
+    pass
+
+def requireNumpy():
+    if numpy is None:
+        raise NumpyIsMissing("This feature needs the numpy package")
+
+def scatterAdd(indices, values, size):
+    """ Sums the values into a 'size' long array, values[..., k] goes to indices[k] """
+    if values.ndim == 1:
+        return numpy.bincount(indices, weights=values, minlength=size)
+    # Every row gets its own range of bins
+    rows = values.reshape(-1, values.shape[-1])
+    offsets = numpy.arange(len(rows))[:, numpy.newaxis] * size + indices
+    sums = numpy.bincount(offsets.ravel(), weights=rows.ravel(), minlength=len(rows) * size)
+    return sums.reshape(values.shape[:-1] + (size,))
+
+def conjugateGradient(matvec, rhs, diagonal, x0, tolerance=1e-12, maxIterations=None):
+    """
+    Solves a symmetric positive definite system given only by its product function,
+    with a Jacobi (diagonal) preconditioner.
+    """
+    x = x0.copy()
+    r = rhs - matvec(x)
+    z = r / diagonal
+    p = z.copy()
+    rz = numpy.dot(r, z)
+    limit = tolerance * max(numpy.sqrt(numpy.dot(rhs, rhs)), 1e-300)
+    maxIterations = maxIterations or 2 * len(rhs) + 10
+    for i in range(0, maxIterations):
+        if numpy.sqrt(numpy.dot(r, r)) <= limit:
+            break
+        Ap = matvec(p)
+        alpha = rz / numpy.dot(p, Ap)
+        x += alpha * p
+        r -= alpha * Ap
+        z = r / diagonal
+        rzNew = numpy.dot(r, z)
+        p = z + (rzNew / rz) * p
+        rz = rzNew
+    return x
+
+def labelComponents(count, fromIndex, toIndex, edgeMask=None, nodeMask=None):
+    """
+    Union-find over the pipes. Returns a component label for every container.
+    Only the pipes of edgeMask are followed, and a pipe merges its containers only if both are in nodeMask.
+    """
+    parents = range(0, count)
+
+    def find(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for k in range(0, len(fromIndex)):
+        if edgeMask is not None and not edgeMask[k]:
+            continue
+        a, b = int(fromIndex[k]), int(toIndex[k])
+        if nodeMask is not None and not (nodeMask[a] and nodeMask[b]):
+            continue
+        rootA, rootB = find(a), find(b)
+        if rootA != rootB:
+            parents[max(rootA, rootB)] = min(rootA, rootB)
+    return numpy.array([find(node) for node in range(0, count)], dtype=int)
+
+class RampBank(object):
+    """
+    The ramps of the valves and pumps of a network as arrays, advanced together.
+    The LinearRamp-s are clamped linear moves. The SecondOrderDiffRamp-s use the transition
+    matrices of fluidsim_core, gathered into coefficient arrays once for every dT.
+    """
+    def __init__(self, values, derivatives, setpoints, isLinear, deltas, alphas, betas):
+        self.values = values
+        self.derivatives = derivatives
+        self.setpoints = setpoints
+        self.isLinear = isLinear
+        self.deltas = deltas
+        self.alphas = alphas
+        self.betas = betas
+        self.linear = numpy.flatnonzero(isLinear)
+        self.secondOrder = numpy.flatnonzero(~isLinear)
+        self.transitionDT = None
+        self.transitions = None
+
+    @staticmethod
+    def fromRamps(ramps):
+        for ramp in ramps:
+            if not isinstance(ramp, (LinearRamp, SecondOrderDiffRamp)):
+                raise TypeError("The ramp can't be batched: "+type(ramp).__name__)
+        isLinear = numpy.array([isinstance(ramp, LinearRamp) for ramp in ramps], dtype=bool)
+        return RampBank(numpy.array([ramp.getActValue() for ramp in ramps], dtype=float),
+                        numpy.array([getattr(ramp, 'actDerivative', 0.0) for ramp in ramps], dtype=float),
+                        numpy.array([ramp.getSetpoint() for ramp in ramps], dtype=float),
+                        isLinear,
+                        numpy.array([getattr(ramp, 'delta', 0.0) for ramp in ramps], dtype=float),
+                        numpy.array([getattr(ramp, 'alpha', 0.0) for ramp in ramps], dtype=float),
+                        numpy.array([getattr(ramp, 'beta', 0.0) for ramp in ramps], dtype=float))
+
+    def copy(self):
+        bank = RampBank(self.values.copy(), self.derivatives.copy(), self.setpoints.copy(),
+                        self.isLinear, self.deltas, self.alphas, self.betas)
+        bank.transitionDT = self.transitionDT
+        bank.transitions = self.transitions
+        return bank
+
+    def writeBack(self, ramps):
+        for index, ramp in enumerate(ramps):
+            if self.isLinear[index]:
+                ramp.setState((float(self.values[index]),))
+            else:
+                ramp.setState((float(self.values[index]), float(self.derivatives[index])))
+
+    def __getTransitions(self, dT):
+        if self.transitionDT != dT:
+            cache = {}
+            coefficients = []
+            for index in self.secondOrder:
+                key = (self.alphas[index], self.betas[index])
+                if key not in cache:
+                    cache[key] = getSecondOrderTransition(float(key[0]), float(key[1]), dT)
+                coefficients.append(cache[key])
+            self.transitions = numpy.array(coefficients, dtype=float).reshape(len(self.secondOrder), 4).T
+            self.transitionDT = dT
+        return self.transitions
+
+    def advance(self, dT):
+        linear = self.linear
+        if len(linear):
+            values = self.values[..., linear]
+            setpoints = self.setpoints[..., linear]
+            difference = self.deltas[linear] * dT
+            self.values[..., linear] = numpy.where(values < setpoints,
+                                                   numpy.minimum(values + difference, setpoints),
+                                                   numpy.maximum(values - difference, setpoints))
+        secondOrder = self.secondOrder
+        if len(secondOrder):
+            a, b, c, d = self.__getTransitions(dT)
+            setpoints = self.setpoints[..., secondOrder]
+            deviations = self.values[..., secondOrder] - setpoints
+            derivatives = self.derivatives[..., secondOrder]
+            self.values[..., secondOrder] = setpoints + a*deviations + b*derivatives
+            self.derivatives[..., secondOrder] = c*deviations + d*derivatives
+
+    def settle(self):
+        self.values[:] = self.setpoints
+        self.derivatives[:] = 0
+
+    def isSettled(self, tolerance):
+        return bool((abs(self.values - self.setpoints) <= tolerance).all() and (abs(self.derivatives) <= tolerance).all())
+
+# Below this many ramps the fixed cost of the array operations is bigger than the recalc calls
+MIN_BATCHED_RAMPS = 16
+
+class ActuatorBank(object):
+    """
+    The ramps of the valves and pumps of the object engines, advanced together in a RampBank.
+    advance() writes the new ramp states and the valve radii back to the objects in bulk,
+    so the pipes can flow without their own advanceActuator. The ramp arithmetic is the same
+    as in recalc, so the result is identical to the stepping of the objects.
+    The bank is gathered from the objects, it has to be gathered again when they are changed by others.
+    """
+    def __init__(self, elements):
+        self.elements = elements
+        self.ramps = [element.ramp for element in elements]
+        self.valves = [element for element in elements if isinstance(element, Valve)]
+        self.valveRampIndices = numpy.array([k for k, element in enumerate(elements) if isinstance(element, Valve)], dtype=int)
+        self.valveMinRadii = numpy.array([valve.minRadius for valve in self.valves], dtype=float)
+        self.valveMaxRadii = numpy.array([valve.maxRadius for valve in self.valves], dtype=float)
+        self.bank = None
+        self.linearRamps = None
+        self.secondOrderRamps = None
+
+    @staticmethod
+    def create(activeElements):
+        """ Returns the bank of the batchable valves and pumps, None if it wouldn't be faster """
+        if numpy is None:
+            return None
+        elements = [element for element in activeElements if type(element) in (Valve, Pump) and
+                    type(element.ramp) in (LinearRamp, SecondOrderDiffRamp)]
+        if len(elements) < MIN_BATCHED_RAMPS:
+            return None
+        return ActuatorBank(elements)
+
+    def gather(self):
+        """ Reads the states, setpoints and parameters of the ramps """
+        self.bank = RampBank.fromRamps(self.ramps)
+        self.linearRamps = [self.ramps[k] for k in self.bank.linear]
+        self.secondOrderRamps = [self.ramps[k] for k in self.bank.secondOrder]
+
+    def advance(self, dT):
+        bank = self.bank
+        bank.advance(dT)
+        for ramp, value in zip(self.linearRamps, bank.values[bank.linear].tolist()):
+            ramp.actValue = value
+        secondOrder = bank.secondOrder
+        for ramp, value, derivative in zip(self.secondOrderRamps, bank.values[secondOrder].tolist(), bank.derivatives[secondOrder].tolist()):
+            ramp.actValue = value
+            ramp.actDerivative = derivative
+        # Valve.getRadiusFor
+        radii = (self.valveMaxRadii - self.valveMinRadii)/100.0*bank.values[self.valveRampIndices] + self.valveMinRadii
+        for valve, radius in zip(self.valves, radii.tolist()):
+            valve.radius = radius
+
+class NetworkState(object):
+    """
+    The mutable part of a compiled network.
+    Everything else in CompiledNetwork is topology and stays constant between two recompilations.
+    """
+    def __init__(self, volumes, temperatures, radii, pumpPressures, ramps):
+        self.volumes = volumes
+        self.temperatures = temperatures
+        self.radii = radii
+        self.pumpPressures = pumpPressures
+        self.ramps = ramps
+
+    def copy(self):
+        return NetworkState(self.volumes.copy(), self.temperatures.copy(), self.radii.copy(), self.pumpPressures.copy(), self.ramps.copy())
+
+class CompiledNetwork(object):
+    def __init__(self, containers, activeElements):
+        requireNumpy()
+        self.containers = [container for container in containers if container is not None]
+        self.activeElements = [element for element in activeElements if element is not None]
+        for element in self.activeElements:
+            if not isinstance(element, Pipe):
+                raise TypeError("The element can't be compiled: "+type(element).__name__)
+            if element.delayLine is not None:
+                raise TypeError("A pipe with a delay can't be compiled")
+        self.containerIndex = dict((id(container), index) for index, container in enumerate(self.containers))
+        self.activeElementIndex = dict((id(element), index) for index, element in enumerate(self.activeElements))
+
+        containers = self.containers
+        elements = self.activeElements
+        self.containerCount = len(containers)
+        self.pipeCount = len(elements)
+
+        # Container parameters
+        self.areas = numpy.array([c.pressureCalculator.area for c in containers], dtype=float)
+        self.rhos = numpy.array([c.fluid.rho() for c in containers], dtype=float)
+        self.etas = numpy.array([c.fluid.eta() for c in containers], dtype=float)
+        self.isStatic = numpy.array([isinstance(c.fluid, StaticFluid) for c in containers], dtype=bool)
+        self.isDynamic = ~self.isStatic
+
+        # The level tables of the TabulatedPressureCalculator-s, concatenated
+        tabulated = [(index, c.pressureCalculator) for index, c in enumerate(containers)
+                     if isinstance(c.pressureCalculator, TabulatedPressureCalculator)]
+        self.tabulatedIndices = numpy.array([index for index, calculator in tabulated], dtype=int)
+        self.volumeSteps = numpy.array([calculator.volumeStep for index, calculator in tabulated], dtype=float)
+        self.tableLengths = numpy.array([len(calculator.levelTable) for index, calculator in tabulated], dtype=int)
+        self.tableOffsets = numpy.cumsum(self.tableLengths) - self.tableLengths
+        self.levelTable = numpy.array([level for index, calculator in tabulated for level in calculator.levelTable], dtype=float)
+
+        # Pipe parameters and the incidence matrix
+        self.fromIndex = numpy.array([self.containerIndex[id(e.getContainer1())] for e in elements], dtype=int)
+        self.toIndex = numpy.array([self.containerIndex[id(e.getContainer2())] for e in elements], dtype=int)
+        self.fromJointHeights = numpy.array([e.jointHeights[0] for e in elements], dtype=float)
+        self.toJointHeights = numpy.array([e.jointHeights[1] for e in elements], dtype=float)
+        self.lengths = numpy.array([e.length for e in elements], dtype=float)
+
+        # The hydrostatic pressure of the joints doesn't change, it's subtracted once
+        self.fromJointPressures = self.rhos[self.fromIndex] * PhysConsts.g * self.fromJointHeights
+        self.toJointPressures = self.rhos[self.toIndex] * PhysConsts.g * self.toJointHeights
+
+        self.valves = [(index, e) for index, e in enumerate(elements) if isinstance(e, Valve)]
+        self.pumps = [(index, e) for index, e in enumerate(elements) if isinstance(e, Pump)]
+
+        # The ramps are in the RampBank of the state: first the valves, then the pumps
+        self.valveIndices = numpy.array([index for index, valve in self.valves], dtype=int)
+        self.valveMinRadii = numpy.array([valve.minRadius for index, valve in self.valves], dtype=float)
+        self.valveMaxRadii = numpy.array([valve.maxRadius for index, valve in self.valves], dtype=float)
+        self.pumpIndices = numpy.array([index for index, pump in self.pumps], dtype=int)
+        self.pumpMaxPressures = numpy.array([pump.maxPressure for index, pump in self.pumps], dtype=float)
+        self.valveRamps = slice(0, len(self.valves))
+        self.pumpRamps = slice(len(self.valves), len(self.valves) + len(self.pumps))
+        # The setpoints go up to 100, down to 0 for the valves (Valve.setPermeability) and to -100 for the pumps (Pump.setPerformance)
+        self.minSetpoints = numpy.array([0.0]*len(self.valves) + [-100.0]*len(self.pumps))
+
+    def getRamps(self):
+        return [element.ramp for index, element in self.valves + self.pumps]
+
+    def gatherState(self):
+        """ Reads the actual state of the objects into a new NetworkState """
+        volumes = numpy.array([c.fluid.volume() for c in self.containers], dtype=float)
+        temperatures = numpy.array([c.fluid.temperature() for c in self.containers], dtype=float)
+        radii = numpy.array([e.radius for e in self.activeElements], dtype=float)
+        state = NetworkState(volumes, temperatures, radii, numpy.zeros(self.pipeCount), RampBank.fromRamps(self.getRamps()))
+        self.updateActuators(state)
+        return state
+
+    def scatterState(self, state):
+        """ Writes the state back to the objects """
+        for index in numpy.flatnonzero(self.isDynamic):
+            fluid = self.containers[index].fluid
+            fluid.setVolume(state.volumes[index])
+            fluid.setTemperature(state.temperatures[index])
+        state.ramps.writeBack(self.getRamps())
+        for index, valve in self.valves:
+            valve.radius = float(state.radii[index])
+
+    def updateActuators(self, state):
+        """ Computes the valve radii and the pump pressures from the ramps of the state """
+        ramps = state.ramps
+        state.radii[..., self.valveIndices] = (self.valveMaxRadii - self.valveMinRadii) / 100.0 * ramps.values[..., self.valveRamps] + self.valveMinRadii
+        state.pumpPressures[..., self.pumpIndices] = self.pumpMaxPressures * ramps.values[..., self.pumpRamps] / 100.0
+
+    def setActuatorsToSetpoints(self, state):
+        """ Puts every valve and pump of the state to the end of its ramp """
+        state.ramps.settle()
+        self.updateActuators(state)
+
+    def advanceActuators(self, state, dT):
+        state.ramps.advance(dT)
+        self.updateActuators(state)
+
+    def __lookupTables(self, volumes):
+        """ The index of the table segment and the position inside it, for the volumes of the tabulated containers """
+        x = volumes / self.volumeSteps
+        segments = numpy.clip(numpy.floor(x).astype(int), 0, self.tableLengths - 2)
+        return self.tableOffsets + segments, x - segments
+
+    def getLevels(self, state):
+        levels = state.volumes / self.areas
+        if len(self.tabulatedIndices):
+            indices, fractions = self.__lookupTables(state.volumes[..., self.tabulatedIndices])
+            table = self.levelTable
+            levels[..., self.tabulatedIndices] = table[indices] + fractions * (table[indices + 1] - table[indices])
+        return levels
+
+    def getAreas(self, state):
+        """ The cross-section at the actual level: dVolume/dLevel """
+        areas = self.areas * numpy.ones_like(state.volumes)
+        if len(self.tabulatedIndices):
+            indices, fractions = self.__lookupTables(state.volumes[..., self.tabulatedIndices])
+            areas[..., self.tabulatedIndices] = self.volumeSteps / (self.levelTable[indices + 1] - self.levelTable[indices])
+        return areas
+
+    def getPipePressures(self, state):
+        """ Returns the pressures on the two ends of every pipe (pump pressure included) """
+        basePressures = self.rhos * PhysConsts.g * self.getLevels(state)
+        p0 = basePressures[..., self.fromIndex] - self.fromJointPressures + state.pumpPressures
+        p1 = basePressures[..., self.toIndex] - self.toJointPressures
+        return p0, p1
+
+    def getConductances(self, state, p0, p1):
+        """ stream = conductance * (p0 - p1), the viscosity comes from the source side """
+        # Same as Pipe._getFluidQuantity: v*dT*r^2*pi, where v = r^2*(p0-p1)/(8*eta*l)
+        etas = numpy.where(p1 < p0, self.etas[self.fromIndex], self.etas[self.toIndex])
+        return math.pi / 8.0 * state.radii ** 4 / (etas * self.lengths)
+
+    def getStreams(self, state):
+        """ The volume per second flowing from the first container of each pipe to the second one, without clamping """
+        p0, p1 = self.getPipePressures(state)
+        return self.getConductances(state, p0, p1) * (p0 - p1)
+
+    def getTimeConstants(self, state):
+        """ storage / sum of the conductances around every container: the time scale of its level, inf if unconnected """
+        p0, p1 = self.getPipePressures(state)
+        conductances = self.getConductances(state, p0, p1)
+        count = self.containerCount
+        totals = scatterAdd(self.fromIndex, conductances, count) + scatterAdd(self.toIndex, conductances, count)
+        storage = self.getAreas(state) / (self.rhos * PhysConsts.g)
+        with numpy.errstate(divide='ignore'):
+            return numpy.where(totals > 0, storage / totals, numpy.inf)
+
+    def computeImplicitFlows(self, state, dT):
+        """
+        Backward Euler flows: the streams are evaluated with the water levels at the end of the step.
+        The streams are linear in the hydrostatic pressures u = rho*g*level, so with the conductances
+        of the actual state the new pressures come from the symmetric positive definite system
+            (A/(rho*g) + dT * B' C B) u_new = A/(rho*g) u - dT * B' C c
+        where B is the incidence matrix, C the conductances and c the constant pressure terms
+        (joint heights and pumps). The static containers are fixed boundaries.
+        """
+        p0, p1 = self.getPipePressures(state)
+        conductances = self.getConductances(state, p0, p1)
+        weights = dT * conductances
+        storage = self.getAreas(state) / (self.rhos * PhysConsts.g)
+        count = self.containerCount
+        dynamic = self.isDynamic
+
+        pressures = self.rhos * PhysConsts.g * self.getLevels(state)
+        constants = state.pumpPressures - self.fromJointPressures + self.toJointPressures
+        staticPressures = numpy.where(dynamic, 0, pressures)
+        boundaryTerms = constants + staticPressures[self.fromIndex] - staticPressures[self.toIndex]
+
+        def divergence(pipeValues):
+            return scatterAdd(self.fromIndex, pipeValues, count) - scatterAdd(self.toIndex, pipeValues, count)
+
+        def matvec(x):
+            x = numpy.where(dynamic, x, 0)
+            y = storage * x + divergence(weights * (x[self.fromIndex] - x[self.toIndex]))
+            return numpy.where(dynamic, y, 0)
+
+        diagonal = storage + scatterAdd(self.fromIndex, weights, count) + scatterAdd(self.toIndex, weights, count)
+        rhs = numpy.where(dynamic, storage * pressures - divergence(weights * boundaryTerms), 0)
+        newPressures = conjugateGradient(matvec, rhs, diagonal, numpy.where(dynamic, pressures, 0))
+        newPressures = numpy.where(dynamic, newPressures, pressures)
+
+        flows = weights * (newPressures[self.fromIndex] - newPressures[self.toIndex] + constants)
+        return self.clampFlows(state, flows)
+
+    def computeFlows(self, state, dT):
+        """
+        Returns the volume moved by every pipe in dT, positive from the first container to the second.
+        The flows are computed from one snapshot.
+        """
+        return self.clampFlows(state, self.getStreams(state) * dT)
+
+    def clampFlows(self, state, flows):
+        """
+        If a container can't give enough fluid for all of its outgoing pipes, all of them are
+        scaled down (Fluid.remove clamps the same way for one pipe).
+        """
+        outflows = scatterAdd(self.fromIndex, numpy.maximum(flows, 0), self.containerCount) + \
+                   scatterAdd(self.toIndex, numpy.maximum(-flows, 0), self.containerCount)
+        scales = numpy.ones_like(state.volumes)
+        short = self.isDynamic & (outflows > state.volumes)
+        scales[short] = numpy.maximum(state.volumes[short], 0) / outflows[short]
+        return numpy.where(flows > 0, flows * scales[..., self.fromIndex], flows * scales[..., self.toIndex])
+
+    def applyFlows(self, state, flows):
+        """ Moves the fluid and mixes the temperatures like Fluid.remove and Fluid.add """
+        forward = numpy.maximum(flows, 0)
+        backward = numpy.maximum(-flows, 0)
+        count = self.containerCount
+
+        inVolumes = scatterAdd(self.toIndex, forward, count) + scatterAdd(self.fromIndex, backward, count)
+        inHeats = scatterAdd(self.toIndex, forward * state.temperatures[..., self.fromIndex], count) + \
+                  scatterAdd(self.fromIndex, backward * state.temperatures[..., self.toIndex], count)
+        outVolumes = scatterAdd(self.fromIndex, forward, count) + scatterAdd(self.toIndex, backward, count)
+
+        remaining = numpy.maximum(state.volumes - outVolumes, 0)
+        newVolumes = remaining + inVolumes
+        mixable = self.isDynamic & (newVolumes > 0)
+        state.temperatures[mixable] = (remaining[mixable] * state.temperatures[mixable] + inHeats[mixable]) / newVolumes[mixable]
+        state.volumes[..., self.isDynamic] = newVolumes[..., self.isDynamic]
+
+    def isQuiescent(self, state, tolerance):
+        """ True if every ramp is at its setpoint and no pipe moves more than tolerance volume per second """
+        if not state.ramps.isSettled(tolerance):
+            return False
+        return self.pipeCount == 0 or abs(self.computeFlows(state, 1.0)).max() <= tolerance
+
+    def step(self, state, dT):
+        self.advanceActuators(state, dT)
+        self.applyFlows(state, self.computeFlows(state, dT))
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Evaluation of candidate control sequences for model-predictive controllers.
+# Every candidate is a member of an Ensemble started from the actual state of the
+# simulator, so the simulator itself doesn't change. The candidates are split into
+# chunks, and the chunks are stepped by a pool of worker threads.
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from fluidsim_network import numpy
+from fluidsim_ensemble import InvalidParameter
+
+COST_TYPES = ('level', 'temperature', 'effort')
+
+# Below this the per-step overhead of a chunk is bigger than its array work,
+# so the default worker count gives every worker at least this many candidates
+MIN_CHUNK_SIZE = 256
+
+class RolloutEvaluator(object):
+    """
+    A candidate is a sequence of moves, a move is one setpoint for every actuator in actuatorIDs.
+    The moves divide the horizon into equal intervals. The cost of a candidate is the sum of its cost terms:
+        {'type':'level' or 'temperature', 'objectid':containerID, 'target':x, 'weight':w}
+            w * integral of (quantity - x)^2 over the horizon
+        {'type':'effort', 'weight':w}
+            w * sum of the squared setpoint changes, the first move is compared to the actual setpoints
+    """
+    def __init__(self, actuatorIDs, horizon, deltaT, costTerms, workers=None):
+        self.actuatorIDs = [int(ID) for ID in actuatorIDs]
+        self.horizon = float(horizon)
+        self.deltaT = float(deltaT)
+        self.workers = int(workers) if workers else None
+        self.trackingTerms = []
+        self.effortWeight = 0.0
+        for term in costTerms:
+            termType = term.get('type')
+            weight = float(term.get('weight', 1.0))
+            if termType == 'effort':
+                self.effortWeight += weight
+            elif termType in ('level', 'temperature'):
+                quantity = 'waterlevel' if termType == 'level' else 'temperature'
+                self.trackingTerms.append((int(term['objectid']), quantity, float(term['target']), weight))
+            else:
+                raise InvalidParameter("Unknown cost type '"+str(termType)+"'. Possible types are: "+str(COST_TYPES))
+        if self.deltaT <= 0 or self.horizon < self.deltaT:
+            raise InvalidParameter("The horizon has to be at least one step")
+
+    def __getMoves(self, candidates):
+        moves = numpy.asarray(candidates, dtype=float)
+        if moves.ndim == 2:
+            # One move for the whole horizon
+            moves = moves[:, numpy.newaxis, :]
+        if moves.ndim != 3 or moves.shape[2] != len(self.actuatorIDs):
+            raise InvalidParameter("Every move needs one setpoint for each of the "+str(len(self.actuatorIDs))+" actuators")
+        return moves
+
+    def _evaluateChunk(self, args):
+        ensemble, moves = args
+        # The setpoints are clipped like the actuators do (the pumps can reverse), so the effort is of the real moves
+        lows, highs = numpy.array([ensemble.getSetpointRange(ID) for ID in self.actuatorIDs]).T
+        moves = numpy.clip(moves, lows, highs)
+        moveCount = moves.shape[1]
+        stepsPerMove = max(1, int(round(self.horizon / moveCount / self.deltaT)))
+        costs = numpy.zeros(ensemble.size)
+        previous = numpy.array([ensemble.getResult(ID, 'setpoint') for ID in self.actuatorIDs]).T
+        for k in range(0, moveCount):
+            for j, ID in enumerate(self.actuatorIDs):
+                ensemble.setParameter(ID, 'setpoint', moves[:, k, j])
+            costs += self.effortWeight * ((moves[:, k, :] - previous) ** 2).sum(axis=1)
+            previous = moves[:, k, :]
+            for step in range(0, stepsPerMove):
+                ensemble.run(self.deltaT)
+                for ID, quantity, target, weight in self.trackingTerms:
+                    costs += weight * self.deltaT * (ensemble.getResult(ID, quantity) - target) ** 2
+        return costs
+
+    def evaluate(self, createEnsemble, candidates):
+        """ createEnsemble(size) has to return an Ensemble of the actual state. Returns one cost per candidate. """
+        moves = self.__getMoves(candidates)
+        if len(moves) == 0:
+            return []
+        if self.workers is None:
+            chunkCount = min(cpu_count(), -(-len(moves) // MIN_CHUNK_SIZE))
+        else:
+            chunkCount = min(self.workers, len(moves))
+        chunks = numpy.array_split(moves, chunkCount)
+        args = [(createEnsemble(len(chunk)), chunk) for chunk in chunks]
+        if chunkCount == 1:
+            results = [self._evaluateChunk(args[0])]
+        else:
+            pool = ThreadPool(chunkCount)
+            try:
+                results = pool.map(self._evaluateChunk, args)
+            finally:
+                pool.close()
+        return [float(cost) for cost in numpy.concatenate(results)]
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Finds the operating point of a network without simulating the transient.
+# The valves and pumps are taken at their setpoints. The pipe streams are linear in the
+# hydrostatic pressures, so the balance equations are solved directly; an outer fixed-point
+# loop refreshes the upwind viscosities and removes the containers which run empty.
+
+from fluidsim_network import numpy, requireNumpy, scatterAdd, conjugateGradient, labelComponents
+from utilities import PhysConsts
+
+class SteadyStateSolver(object):
+    def __init__(self, network, tolerance=1e-10, maxIterations=50):
+        requireNumpy()
+        if len(network.tabulatedIndices):
+            # The balance is solved with linear storages
+            raise TypeError("The steady state can be solved only for prismatic containers")
+        self.network = network
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+
+    def __divergence(self, pipeValues):
+        network = self.network
+        count = network.containerCount
+        return scatterAdd(network.fromIndex, pipeValues, count) - scatterAdd(network.toIndex, pipeValues, count)
+
+    def __solvePressures(self, pressures, conductances, constants, unknown):
+        """ Solves divergence(C*(B u + c)) = 0 on the unknown containers, the others are fixed """
+        network = self.network
+        fixedPressures = numpy.where(unknown, 0, pressures)
+        boundaryTerms = constants + fixedPressures[network.fromIndex] - fixedPressures[network.toIndex]
+
+        def matvec(x):
+            x = numpy.where(unknown, x, 0)
+            y = self.__divergence(conductances * (x[network.fromIndex] - x[network.toIndex]))
+            return numpy.where(unknown, y, 0)
+
+        count = network.containerCount
+        diagonal = scatterAdd(network.fromIndex, conductances, count) + scatterAdd(network.toIndex, conductances, count)
+        diagonal[diagonal == 0] = 1
+        rhs = numpy.where(unknown, -self.__divergence(conductances * boundaryTerms), 0)
+        x = conjugateGradient(matvec, rhs, diagonal, numpy.where(unknown, pressures, 0), self.tolerance)
+        return numpy.where(unknown, x, pressures)
+
+    def __conserveClosedVolumes(self, pressures, volumes, storage, conductances, unknown):
+        """
+        A component without static containers keeps its fluid, its pressures are
+        determined only up to a constant. The constant comes from the volume.
+        The components are taken with the conductances of the empty containers too,
+        so the fluid of an emptied container stays on the rest of its component.
+        """
+        network = self.network
+        conducting = conductances > 0
+        labels = labelComponents(network.containerCount, network.fromIndex, network.toIndex, conducting, network.isDynamic)
+        opened = numpy.zeros(network.containerCount, dtype=bool)
+        touchesStatic = conducting & (network.isStatic[network.fromIndex] | network.isStatic[network.toIndex])
+        opened[labels[network.fromIndex[touchesStatic]]] = True
+        opened[labels[network.toIndex[touchesStatic]]] = True
+        closed = network.isDynamic & ~opened[labels]
+
+        count = network.containerCount
+        targetVolumes = numpy.bincount(labels[closed], weights=volumes[closed], minlength=count)
+        members = closed & unknown
+        actualVolumes = numpy.bincount(labels[members], weights=(storage * pressures)[members], minlength=count)
+        storages = numpy.bincount(labels[members], weights=storage[members], minlength=count)
+        shifts = numpy.zeros(count)
+        solvable = storages > 0
+        shifts[solvable] = (targetVolumes[solvable] - actualVolumes[solvable]) / storages[solvable]
+        pressures = pressures.copy()
+        pressures[members] += shifts[labels[members]]
+        return pressures, labels, closed
+
+    def __mixTemperatures(self, state, streams, labels, closed):
+        network = self.network
+        temperatures = state.temperatures.copy()
+        count = network.containerCount
+
+        # A closed component with circulation is stirred, the heat is conserved.
+        # Where nothing flows, the temperatures depend on the transient, they are left as they are.
+        circulating = numpy.zeros(count, dtype=bool)
+        flowing = numpy.abs(streams) > self.tolerance
+        circulating[labels[network.fromIndex[flowing]]] = True
+        stirred = closed & circulating[labels]
+        heats = numpy.bincount(labels[stirred], weights=(state.volumes * state.temperatures)[stirred], minlength=count)
+        volumes = numpy.bincount(labels[stirred], weights=state.volumes[stirred], minlength=count)
+        mixable = stirred & (volumes[labels] > 0)
+        temperatures[mixable] = heats[labels[mixable]] / volumes[labels[mixable]]
+
+        # The open containers with throughflow take the mixed temperature of their inflows
+        forward = streams > 0
+        sources = numpy.where(forward, network.fromIndex, network.toIndex)
+        destinations = numpy.where(forward, network.toIndex, network.fromIndex)
+        moved = numpy.abs(streams)
+        inflows = scatterAdd(destinations, moved, count)
+        throughflow = network.isDynamic & ~closed & (inflows > self.tolerance)
+        for i in range(0, count + 1):  # without loops the heat reaches every container in this many rounds
+            mixed = scatterAdd(destinations, moved * temperatures[sources], count)
+            newTemperatures = temperatures.copy()
+            newTemperatures[throughflow] = mixed[throughflow] / inflows[throughflow]
+            change = numpy.abs(newTemperatures - temperatures).max() if count else 0
+            temperatures = newTemperatures
+            if change < self.tolerance:
+                break
+        return temperatures
+
+    def solve(self, state):
+        """ Returns the equilibrium as a new NetworkState and the pipe streams (volume per second) """
+        network = self.network
+        state = state.copy()
+        network.setActuatorsToSetpoints(state)
+        storage = network.areas / (network.rhos * PhysConsts.g)
+        constants = state.pumpPressures - network.fromJointPressures + network.toJointPressures
+        pressures = network.rhos * PhysConsts.g * network.getLevels(state)
+        empty = numpy.zeros(network.containerCount, dtype=bool)
+
+        for iteration in range(0, self.maxIterations):
+            current = state.copy()
+            current.volumes = numpy.where(network.isDynamic, pressures * storage, state.volumes)
+            p0, p1 = network.getPipePressures(current)
+            allConductances = network.getConductances(current, p0, p1)
+            conductances = numpy.where(empty[network.fromIndex] | empty[network.toIndex], 0, allConductances)
+            unknown = network.isDynamic & ~empty
+
+            newPressures = self.__solvePressures(pressures, conductances, constants, unknown)
+            newPressures, labels, closed = self.__conserveClosedVolumes(newPressures, state.volumes, storage, allConductances, unknown)
+            negative = unknown & (newPressures < -self.tolerance)
+            converged = numpy.abs(newPressures - pressures).max() <= self.tolerance * (1 + numpy.abs(pressures).max()) if len(pressures) else True
+            pressures = newPressures
+            if negative.any():
+                empty |= negative
+                pressures[empty] = 0
+            elif converged:
+                break
+
+        streams = conductances * (pressures[network.fromIndex] - pressures[network.toIndex] + constants)
+        result = state.copy()
+        result.volumes = numpy.where(network.isDynamic, numpy.maximum(pressures, 0) * storage, state.volumes)
+        result.temperatures = self.__mixTemperatures(result, streams, labels, closed)
+        return result, streams
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from DirectSyncronizedSimulatorFacade import DirectSyncronizedSimulatorFacade
+
+def buildSimulator():
+    """ A source filling two containers through a valve and a pump """
+    global idSource, idCont1, idCont2, valve1, pump1
+    simulator = DirectSyncronizedSimulatorFacade()
+    simulator.logManager.logHandlerTypes = []
+    simulator.setStepEngine("vectorized")
+    idSource = simulator.addContainer(10, 100, True)
+    idCont1 = simulator.addContainer(10, 2, False)
+    idCont2 = simulator.addContainer(10, 2, False)
+    simulator.setContainerState(idSource, 40, 5)
+    simulator.setContainerState(idCont1, 10, 1)
+    valve1 = simulator.addValve(idSource, idCont1, 0, 0.05, 1, 0)
+    pump1 = simulator.addPump(idCont1, idCont2, 0.05, 1, 0, 1)
+    simulator.setValveState(valve1, 50)
+    simulator.run(0.1, 10)
+    return simulator
+
+def getState(simulator):
+    return [(simulator.getFluidsimObjectDescription(objectID)['volume'], simulator.getFluidsimObjectDescription(objectID)['temperature'])
+            for objectID in (idCont1, idCont2)]
+
+print "Testing the independence of the forks"
+simulator = buildSimulator()
+startState = getState(simulator)
+fork1, fork2 = simulator.forkMany(2)
+assert getState(fork1) == startState, "The fork didn't start from the state of the simulator"
+fork1.setValveState(valve1, 100)
+fork1.setPumpPerformance(pump1, 100)
+fork1.run(0.1, 100)
+print "  --- The changed fork: ", getState(fork1)
+assert getState(fork1) != startState, "The fork didn't run"
+assert getState(fork2) == startState, "The run of a fork changed the other fork"
+assert getState(simulator) == startState, "The run of a fork changed the simulator"
+fork3 = fork1.fork()
+fork3.run(0.1, 10)
+assert getState(fork3) != getState(fork1), "The fork of a fork didn't run"
+
+print ""
+print "Testing that a fork runs like the simulator"
+fork2.run(0.1, 100)
+simulator.run(0.1, 100)
+print "  --- Fork: ", getState(fork2), ", simulator: ", getState(simulator)
+assert getState(fork2) == getState(simulator), "The fork differs from the vectorized engine of the simulator"
+simulator.setContainerState(idCont2, 20, 3)
+assert getState(fork2) != getState(simulator), "Setting the simulator changed the fork"
+
+print ""
+print "Testing the independence of the members of an ensemble"
+simulator = buildSimulator()
+startState = getState(simulator)
+ensemble = simulator.createEnsemble(3)
+ensemble.setParameter(valve1, 'setpoint', [50, 0, 100])
+ensemble.setParameter(pump1, 'setpoint', [0, 0, 100])
+ensemble.run(0.1, 100)
+volumes = ensemble.getResult(idCont1, 'volume')
+print "  --- Volumes of the members: ", volumes
+assert volumes[1] < startState[0][0] < volumes[0], "The setpoints of the members were mixed up"
+assert ensemble.getResult(idCont2, 'volume')[2] > ensemble.getResult(idCont2, 'volume')[0], "The pump of the third member didn't run"
+assert getState(simulator) == startState, "The ensemble changed the simulator"
+simulator.run(0.1, 100)
+assert abs(volumes[0] - getState(simulator)[0][0]) < 1e-12, "The unchanged member differs from the simulator"
+
+print ""
+print "        !!!!!!!!!!!!!!!!!!    The test was succesful    !!!!!!!!!!!!!!!!!!"
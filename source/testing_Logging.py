@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from DirectSyncronizedSimulatorFacade import DirectSyncronizedSimulatorFacade
+from fluidsim_logging import ColumnarLogReader, COLUMNAR_LOG_NAME
+
+def buildSimulator(directory, logFormat, queueSize=None):
+    """ Logs into directory, every object is monitored in the given format """
+    global idSource, idCont1, valve1
+    simulator = DirectSyncronizedSimulatorFacade()
+    simulator.logManager.prefix = directory + os.sep
+    simulator.setLogFormat(logFormat)
+    if queueSize is not None:
+        simulator.setAsyncLogging(queueSize)
+    idSource = simulator.addContainer(10, 100, True)
+    idCont1 = simulator.addContainer(10, 2, False)
+    simulator.setContainerState(idSource, 40, 5)
+    valve1 = simulator.addValve(idSource, idCont1, 0, 0.05, 1, 0)
+    simulator.setValveState(valve1, 100)
+    return simulator
+
+def readCsvLog(filename):
+    """ The timestamps and the columns of a CSV log """
+    with open(filename) as f:
+        keys = f.readline().strip().split(",")
+        rows = [[float(value) for value in line.strip().split(",")] for line in f if line.strip()]
+    return [row[0] for row in rows], dict((key, [row[i] for row in rows]) for i, key in enumerate(keys) if key != "timestamp")
+
+directory = tempfile.mkdtemp()
+try:
+    print "Testing the columnar logs against the CSV logs"
+    os.mkdir(os.path.join(directory, "csv"))
+    os.mkdir(os.path.join(directory, "columnar"))
+    os.mkdir(os.path.join(directory, "async"))
+    csvSimulator = buildSimulator(os.path.join(directory, "csv"), 'csv')
+    columnarSimulator = buildSimulator(os.path.join(directory, "columnar"), 'columnar')
+    asyncSimulator = buildSimulator(os.path.join(directory, "async"), 'columnar', 16)
+    for simulator in (csvSimulator, columnarSimulator, asyncSimulator):
+        simulator.run(0.01, 2000)
+        simulator.flushLogs()
+
+    reader = ColumnarLogReader(os.path.join(directory, "columnar", COLUMNAR_LOG_NAME))
+    print "  --- Signals: ", reader.getSignals()
+    timestamps, values = reader.read()
+    for objectID in (idSource, idCont1, valve1):
+        csvTimestamps, csvValues = readCsvLog(os.path.join(directory, "csv", str(objectID)+".log"))
+        assert len(csvTimestamps) == len(timestamps) > 10, "The number of the logs differs"
+        assert max(abs(a - b) for a, b in zip(csvTimestamps, timestamps)) < 1e-9, "The timestamps differ"
+        for key, column in csvValues.items():
+            signal = str(objectID)+"."+key
+            assert signal in values, "The columnar log has no "+signal
+            # The CSV has 12 significant digits
+            assert max(abs(a - b) for a, b in zip(column, values[signal])) < 1e-9 * max(1, max(abs(a) for a in column)), "The values of "+signal+" differ"
+    print "  --- The", len(timestamps), "logs are the same"
+
+    assert timestamps[-1] > 20 - 2 * columnarSimulator.logManager.logPeriod, "The last logs are missing"
+
+    print ""
+    print "Testing the logs of the writer thread"
+    asyncTimestamps, asyncValues = ColumnarLogReader(os.path.join(directory, "async", COLUMNAR_LOG_NAME)).read()
+    assert list(asyncTimestamps) == list(timestamps), "The writer thread lost logs"
+    for signal in values:
+        assert list(asyncValues[signal]) == list(values[signal]), "The writer thread changed the values of "+signal
+
+    print ""
+    print "Testing a part of the columnar log"
+    partTimestamps, partValues = reader.read([str(idCont1)+".volume"], 5, 10)
+    print "  --- Timestamps: ", list(partTimestamps)
+    assert len(partTimestamps) and min(partTimestamps) >= 5 and max(partTimestamps) <= 10, "The part has logs outside the range"
+    assert list(partValues.keys()) == [str(idCont1)+".volume"], "The part has other signals"
+finally:
+    shutil.rmtree(directory)
+
+print ""
+print "        !!!!!!!!!!!!!!!!!!    The test was succesful    !!!!!!!!!!!!!!!!!!"
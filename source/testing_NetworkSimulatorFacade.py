@@ -276,5 +276,8 @@ print ""
 print ""
 print ""
 print ""
+print ""
+print ""
+print ""
 
 print "        !!!!!!!!!!!!!!!!!!    The test was succesful    !!!!!!!!!!!!!!!!!!"
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import fluidsim_server
+from DirectSyncronizedSimulatorFacade import DirectSyncronizedSimulatorFacade
+from SocketHandler import SocketHandler
+from Commands import *
+import thread
+import random
+from socket import socket
+import time
+
+port = random.randint(8000,10000)
+
+print "Starting server..."
+serverSimulator = DirectSyncronizedSimulatorFacade()
+serverSimulator.logManager.logHandlerTypes = []
+server = fluidsim_server.Server('localhost', port, serverSimulator)
+thread.start_new_thread(server.start, ())
+time.sleep(0.1)
+print "Server started"
+
+s = socket()
+s.connect(("localhost", port))
+# A dropped connection fails the test instead of blocking it
+s.settimeout(60)
+socketHandler = SocketHandler(s)
+
+def send(packet):
+    print "  --- Sending: ", packet
+    response = socketHandler.sendPacketAndGetAnswer(packet)
+    print "  --- Response: ", response
+    return response
+
+def sendWithForkID(packet, forkID):
+    packet['forkid'] = forkID
+    return send(packet)
+
+def checkError(response, problem):
+    assert 'error' in response, problem
+    # The connection has to survive the error
+    assert 'idlist' in send(GetListOfIdsCommand.buildDict()), "The connection didn't survive: "+problem
+
+print "Creating a model with a junction"
+idCont1 = send(AddContainerCommand.buildDict(10, 2, False))['containerid']
+idCont2 = send(AddContainerCommand.buildDict(10, 2, False))['containerid']
+idCont3 = send(AddContainerCommand.buildDict(10, 2, False))['containerid']
+send(SetContainerStateCommand.buildDict(idCont1, 20, 4))
+valve1 = send(AddValveCommand.buildDict(idCont1, idCont2, 0, 0.05, 1, 0))['actuatorid']
+junction1 = send(AddJunctionCommand.buildDict([idCont1, idCont2, idCont3], [0.05, 0.05, 0.05], [1, 1, 1], 0))['actuatorid']
+
+print ""
+print "Testing the steady state of a model the solver doesn't support"
+checkError(send(SolveSteadyStateCommand.buildDict(False)), "Solving a junction model didn't answer with an error")
+
+print ""
+print "Testing the step engines which can't step a junction"
+for engineName in ("vectorized", "multirate", "adaptive", "implicit"):
+    checkError(send(SetStepEngineCommand.buildDict(engineName)), "The "+engineName+" engine accepted a junction model")
+    assert 'error' not in send(RunNextStepCommand.buildDict(0.1, 10)), "The refused "+engineName+" engine was selected"
+
+print ""
+print "Testing the adaptive run of a model the adaptive engine doesn't support"
+send(ControlValveCommand.buildDict(valve1, ControlValveCommand.SET_ACTION, 100))
+checkError(send(RunAdaptiveCommand.buildDict(1, 0.001)), "The adaptive run of a junction model didn't answer with an error")
+send(ControlValveCommand.buildDict(valve1, ControlValveCommand.SET_ACTION, 0))
+
+print ""
+print "Testing the rollouts of a model the ensembles don't support"
+costTerms = [{'type':'level', 'objectid':idCont2, 'target':1}]
+checkError(send(EvaluateRolloutsCommand.buildDict([valve1], [[0], [100]], 1, 0.1, costTerms)), "The rollouts of a junction model didn't answer with an error")
+
+print ""
+print "Testing the forks of a model the forks don't support"
+checkError(send(ForkCommand.buildDict(2)), "Forking a junction model didn't answer with an error")
+
+print ""
+print "Removing the junction"
+send(DeleteObjectCommand.buildDict(junction1))
+pipe1 = send(AddPipeCommand.buildDict(idCont2, idCont3, 0.05, 1, 0))['actuatorid']
+
+print ""
+print "Testing the topology changes a compiled step engine can't step"
+send(SetStepEngineCommand.buildDict("vectorized"))
+checkError(send(AddJunctionCommand.buildDict([idCont1, idCont2, idCont3], [0.05, 0.05, 0.05], [1, 1, 1], 0)), "A junction was added under a compiled engine")
+checkError(send(SetPipeDelayCommand.buildDict(pipe1, 1)), "A delay was set under a compiled engine")
+assert 'error' not in send(RunNextStepCommand.buildDict(0.1, 10)), "The refused changes broke the compiled engine"
+send(SetStepEngineCommand.buildDict("sequential"))
+
+print ""
+print "Testing the commands sent to a fork"
+startVolume = send(GetStateCommand.buildDict(idCont2))['descriptor']['volume']
+forkIDs = send(ForkCommand.buildDict(2))['forkids']
+checkError(sendWithForkID(GetStateCommand.buildDict(idCont1), 1000), "An unknown fork id was accepted")
+checkError(sendWithForkID(GetStateCommand.buildDict(idCont1), "fork"), "A malformed fork id was accepted")
+for packet in (SetStepEngineCommand.buildDict("vectorized"), RunUntilCommand.buildDict(0.1, [], 1), SolveSteadyStateCommand.buildDict(False),
+               FlushLogsCommand.buildDict(), SerializeCommand.buildDict(), AddContainerCommand.buildDict(10, 2, False)):
+    checkError(sendWithForkID(packet, forkIDs[0]), "A fork accepted the '"+packet['command']+"' command")
+checkError(sendWithForkID(ControlValveCommand.buildDict(1000, ControlValveCommand.SET_ACTION, 100), forkIDs[0]), "A fork accepted a wrong actuator id")
+sendWithForkID(ControlValveCommand.buildDict(valve1, ControlValveCommand.SET_ACTION, 100), forkIDs[0])
+sendWithForkID(RunNextStepCommand.buildDict(0.1, 100), forkIDs[0])
+forkVolume = sendWithForkID(GetStateCommand.buildDict(idCont2), forkIDs[0])['descriptor']['volume']
+assert forkVolume > startVolume, "The valve of the fork didn't open"
+assert sendWithForkID(GetStateCommand.buildDict(idCont2), forkIDs[1])['descriptor']['volume'] == startVolume, "The forks aren't independent"
+assert send(GetStateCommand.buildDict(idCont2))['descriptor']['volume'] == startVolume, "The fork changed the simulator"
+send(DropForksCommand.buildDict(forkIDs))
+checkError(sendWithForkID(GetStateCommand.buildDict(idCont1), forkIDs[0]), "A dropped fork id was accepted")
+
+socketHandler.sendPacket(QuitCommand.buildDict(True))
+s.close()
+
+print ""
+print "        !!!!!!!!!!!!!!!!!!    The test was succesful    !!!!!!!!!!!!!!!!!!"
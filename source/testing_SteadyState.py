@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from DirectSyncronizedSimulatorFacade import DirectSyncronizedSimulatorFacade
+
+def createSimulator():
+    simulator = DirectSyncronizedSimulatorFacade()
+    simulator.logManager.logHandlerTypes = []
+    return simulator
+
+def checkAgainstSimulation(simulator, containerIDs, deltaT, repeat, tolerance):
+    """ The steady state has to be where a long simulation gets to, and solving it mustn't change the model """
+    steadyState = simulator.solveSteadyState(False)
+    print "  --- Steady state: ", steadyState
+    simulator.run(deltaT, repeat)
+    for containerID in containerIDs:
+        level = simulator.getFluidsimObjectDescription(containerID)['waterlevel']
+        steadyLevel = steadyState['containers'][containerID]['waterlevel']
+        print "  --- Level of", containerID, "after", deltaT*repeat, "seconds: ", level, ", in the steady state: ", steadyLevel
+        assert abs(level - steadyLevel) < tolerance, "The simulation didn't get to the steady state: "+str(level - steadyLevel)
+    return steadyState
+
+print "Testing the steady state of a closed system where a pump empties a container"
+simulator = createSimulator()
+idSource = simulator.addContainer(10, 2, False)
+idTarget = simulator.addContainer(10, 3, False)
+pump1 = simulator.addPump(idSource, idTarget, 0.05, 1, 0, 100000)
+simulator.setPumpPerformance(pump1, 100)
+simulator.setContainerState(idSource, 20, 4)
+simulator.setContainerState(idTarget, 20, 1)
+steadyState = checkAgainstSimulation(simulator, [idSource, idTarget], 0.01, 1000, 0.00001)
+steadyVolume = sum(container['volume'] for container in steadyState['containers'].values())
+assert abs(steadyVolume - 11) < 0.00001, "The amount of water changed in the steady state: "+str(steadyVolume - 11)
+assert steadyState['containers'][idSource]['volume'] == 0, "The pump didn't empty the source"
+
+print ""
+print "Testing the steady state of a chain between a high and a low static container"
+simulator = createSimulator()
+idHigh = simulator.addContainer(10, 100, True)
+idLow = simulator.addContainer(10, 100, True)
+idCont1 = simulator.addContainer(10, 1, False)
+idCont2 = simulator.addContainer(10, 1, False)
+simulator.setContainerState(idHigh, 20, 6)
+simulator.setContainerState(idLow, 20, 1)
+simulator.addPipe(idHigh, idCont1, 0.05, 1, 0)
+valve1 = simulator.addValve(idCont1, idCont2, 0, 0.1, 1, 0)
+simulator.setValveState(valve1, 50)
+simulator.addPipe(idCont2, idLow, 0.05, 2, 0)
+simulator.setStepEngine("implicit")
+checkAgainstSimulation(simulator, [idCont1, idCont2], 0.5, 20000, 0.0001)
+
+print ""
+print "Testing the models the steady state solver doesn't support"
+for unsupported in ("junction", "delay", "geometry"):
+    simulator = createSimulator()
+    idCont1 = simulator.addContainer(10, 2, False)
+    idCont2 = simulator.addContainer(10, 2, False)
+    pipe1 = simulator.addPipe(idCont1, idCont2, 0.05, 1, 0)
+    if unsupported == "junction":
+        simulator.addJunction([idCont1, idCont2], [0.05, 0.05], [1, 1], 0)
+    elif unsupported == "delay":
+        simulator.setPipeDelay(pipe1, 1)
+    else:
+        simulator.setContainerGeometry(idCont1, [0, 10], [0, 20])
+    try:
+        simulator.solveSteadyState(False)
+    except TypeError as e:
+        print "  --- The", unsupported, "is refused: ", e
+    else:
+        assert False, "The steady state solver accepted a model with a "+unsupported
+
+print ""
+print "        !!!!!!!!!!!!!!!!!!    The test was succesful    !!!!!!!!!!!!!!!!!!"
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from DirectSyncronizedSimulatorFacade import DirectSyncronizedSimulatorFacade
+
+def buildSimulator():
+    """ The model of testing_NetworkSimulatorFacade: two sources, a valve and a pump """
+    global idCont2, idCont3, idCont4, valve1, pump1
+    simulator = DirectSyncronizedSimulatorFacade()
+    simulator.logManager.logHandlerTypes = []
+    idCont1_1 = simulator.addContainer(50, 100.0, True)
+    idCont1_2 = simulator.addContainer(50, 100.0, True)
+    idCont2 = simulator.addContainer(50, 100.0, False)
+    idCont3 = simulator.addContainer(50, 10, False)
+    idCont4 = simulator.addContainer(50, 10, False)
+    simulator.setContainerState(idCont1_1, 30, 50)
+    simulator.setContainerState(idCont1_2, 0, 50)
+    simulator.setContainerState(idCont4, 30, 0)
+    simulator.addPipe(idCont1_1, idCont2, 0.05, 5, 0)
+    simulator.addPipe(idCont1_2, idCont2, 0.1, 5, 0)
+    valve1 = simulator.addValve(idCont2, idCont3, 0, 0.5, 5, 0)
+    simulator.setValveState(valve1, 100)
+    pump1 = simulator.addPump(idCont3, idCont4, 0.1, 5, 0, 0.5)
+    return simulator
+
+def getLevels(simulator, ids):
+    return [simulator.getFluidsimObjectDescription(objectID)['waterlevel'] for objectID in ids]
+
+def getVolumesAndTemperatures(simulator, ids):
+    descriptions = [simulator.getFluidsimObjectDescription(objectID) for objectID in ids]
+    return [(description['volume'], description['temperature']) for description in descriptions]
+
+def getTotalVolume(simulator, containerIDs, elementIDs):
+    """ The fluid in the containers and on the way in the delayed pipes """
+    return sum(simulator.getFluidsimObjectDescription(objectID)['volume'] for objectID in containerIDs) + \
+           sum(simulator.getFluidsimObjectDescription(objectID)['intransit'] for objectID in elementIDs)
+
+def buildClosedSimulator(engineName):
+    """ Three closed containers, the fluid of the first one flows into the others """
+    global idClosed1, idClosed2, idClosed3
+    simulator = DirectSyncronizedSimulatorFacade()
+    simulator.logManager.logHandlerTypes = []
+    simulator.setStepEngine(engineName)
+    idClosed1 = simulator.addContainer(10, 2, False)
+    idClosed2 = simulator.addContainer(10, 3, False)
+    idClosed3 = simulator.addContainer(10, 1, False)
+    simulator.setContainerState(idClosed1, 40, 5)
+    simulator.setContainerState(idClosed2, 10, 1)
+    return simulator
+
+print "Testing the adaptive step engine against a fine fixed step reference"
+simulator = buildSimulator()
+simulator.run(0.0001, 100000)
+referenceLevels = getLevels(simulator, [idCont2, idCont3, idCont4])
+print "  --- Reference levels: ", referenceLevels
+for tolerance in (1e-4, 1e-3, 1e-2):
+    simulator = buildSimulator()
+    steps = simulator.runAdaptive(10, tolerance)
+    levels = getLevels(simulator, [idCont2, idCont3, idCont4])
+    print "  --- Tolerance", tolerance, "in", steps, "steps: ", levels
+    assert steps > 1, "The adaptive engine took the whole run in one step"
+    for level, referenceLevel in zip(levels, referenceLevels):
+        assert abs(level - referenceLevel) < tolerance, "The adaptive engine missed its tolerance: "+str(level - referenceLevel)
+
+print ""
+print "Testing the step engines against the sequential engine"
+simulator = buildSimulator()
+simulator.setPumpPerformance(pump1, 50)
+simulator.run(0.01, 1000)
+reference = getVolumesAndTemperatures(simulator, [idCont2, idCont3, idCont4])
+print "  --- Sequential: ", reference
+# The engines which step the objects in the same order give the same numbers,
+# the simultaneous updates differ slightly, but they mustn't drift away
+for engineName, options, identical in (("sleeping", None, True), ("jit", None, True), ("components", None, True),
+                                       ("jacobi", None, False), ("jacobi", {'workers':3}, False), ("vectorized", None, False),
+                                       ("multirate", None, False), ("implicit", None, False)):
+    simulator = buildSimulator()
+    simulator.setStepEngine(engineName, options)
+    simulator.setPumpPerformance(pump1, 50)
+    simulator.run(0.01, 1000)
+    result = getVolumesAndTemperatures(simulator, [idCont2, idCont3, idCont4])
+    print "  --- "+engineName, options, ": ", result
+    if identical:
+        assert result == reference, "The "+engineName+" engine differs from the sequential engine"
+    else:
+        for (volume, temperature), (referenceVolume, referenceTemperature) in zip(result, reference):
+            assert abs(volume - referenceVolume) < 0.005, "The volumes of the "+engineName+" engine drifted away: "+str(volume - referenceVolume)
+            assert abs(temperature - referenceTemperature) < 0.001, "The temperatures of the "+engineName+" engine drifted away: "+str(temperature - referenceTemperature)
+
+print ""
+print "Testing the volume of the delayed pipes"
+for engineName in ("sequential", "sleeping", "jacobi", "components"):
+    simulator = buildClosedSimulator(engineName)
+    pipe1 = simulator.addPipe(idClosed1, idClosed2, 0.05, 1, 0)
+    pipe2 = simulator.addPipe(idClosed2, idClosed3, 0.05, 1, 0)
+    simulator.setPipeDelay(pipe1, 2)
+    simulator.setPipeDelay(pipe2, 0.5)
+    containerIDs = [idClosed1, idClosed2, idClosed3]
+    startVolume = getTotalVolume(simulator, containerIDs, [pipe1, pipe2])
+    for i in range(0, 10):
+        simulator.run(0.1, 7)
+        inTransit = getTotalVolume(simulator, containerIDs, [pipe1, pipe2]) - getTotalVolume(simulator, containerIDs, [])
+        volume = getTotalVolume(simulator, containerIDs, [pipe1, pipe2])
+        assert abs(volume - startVolume) < 0.000001, "The "+engineName+" engine lost fluid in the delayed pipes: "+str(volume - startVolume)
+    assert inTransit > 0, "Nothing travelled in the delayed pipes"
+    simulator.setPipeDelay(pipe1, 0)
+    simulator.setPipeDelay(pipe2, 0)
+    volume = getTotalVolume(simulator, containerIDs, [])
+    print "  --- "+engineName+": ", startVolume, volume
+    assert abs(volume - startVolume) < 0.000001, "Removing the delays lost fluid: "+str(volume - startVolume)
+
+print ""
+print "Testing the mass balance of the junctions"
+for engineName in ("sequential", "sleeping", "jit", "jacobi", "components"):
+    simulator = buildClosedSimulator(engineName)
+    simulator.addJunction([idClosed1, idClosed2, idClosed3], [0.1, 0.1, 0.1], [1, 2, 1], 0)
+    containerIDs = [idClosed1, idClosed2, idClosed3]
+    startVolume = getTotalVolume(simulator, containerIDs, [])
+    simulator.run(0.1, 2000)
+    volume = getTotalVolume(simulator, containerIDs, [])
+    levels = getLevels(simulator, containerIDs)
+    print "  --- "+engineName+": ", volume, levels
+    assert abs(volume - startVolume) < 0.000001, "The junction changed the amount of water: "+str(volume - startVolume)
+    assert max(levels) - min(levels) < 0.01, "The junction didn't level the containers"
+
+print ""
+print "        !!!!!!!!!!!!!!!!!!    The test was succesful    !!!!!!!!!!!!!!!!!!"